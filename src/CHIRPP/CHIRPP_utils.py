@@ -4,6 +4,7 @@ import subprocess
 import os
 import numpy as np
 from glob import glob
+from tim import read_flag, rename_toas
 from write_scripts import *
 
 
@@ -87,6 +88,18 @@ def edit_lines(fname, param_dict):
     subprocess.run(f"mv {fname_new} {fname}", shell=True)
 
 
+def get_config_value(param, fname="config.sh"):
+    # Value of a '{param}={value}' line, without quotes or trailing comments
+    cf = open(fname, "r")
+    cfr = cf.read()
+    cf.close()
+    for line in cfr.split("\n"):
+        if line.split("=")[0].strip() == param:
+            value = line.split("=", 1)[1].split("#")[0].strip()
+            return value.strip('"').strip("'")
+    return None
+
+
 def get_nbin_dm(outfile_paramcheck):
     template_nbin = int(
         subprocess.run(
@@ -148,6 +161,63 @@ def check_num_files(ext_1, ext_2, logfile=None, force_proceed=False):
             exit(1)
 
 
+def use_scrunch_level(nchan, extension=".ftp"):
+    """
+    Replace each *{extension} file with its pre-computed {nchan}-subband level
+    (written by scrunch.py --min_nchan). Returns False, without touching any
+    files, if some file has no such level.
+    """
+    files = glob(f"*{extension}")
+    levels = [f"{f}.{nchan}ch" for f in files]
+    if len(files) == 0 or not all(os.path.exists(level) for level in levels):
+        return False
+    for f, level in zip(files, levels):
+        os.replace(level, f)
+    print(f"\nSwitched {len(files)} *{extension} files to {nchan} subbands.\n")
+    return True
+
+
+def get_scrunch_nchan(fname="scrunch.txt"):
+    # Number of subbands the scrunch commands currently produce
+    scrunch_txt = open(fname, "r")
+    scr_line1 = [x for x in scrunch_txt.read().split("\n") if "--setnchn" in x][0]
+    scrunch_txt.close()
+    return int(scr_line1.split("--setnchn")[1].split()[0])
+
+
+def set_nsubbands(new_nchan, base_jobname, tjob_scrunch, pulsar):
+    """
+    Point config.sh and scrunch.txt at new_nchan subbands, then produce the
+    scrunched files: from a pre-computed level if available, otherwise by
+    running the scrunch job again.
+    """
+    scrunch_dict = dict([("nsubbands", new_nchan)])
+    edit_lines("config.sh", scrunch_dict)
+
+    # Edit scrunch.txt to use new nchan
+    fname = "scrunch.txt"
+    f = open(fname, "r")
+    fr = f.read()
+    f.close()
+    fname_new = f"scrunch_new.txt"
+    fnew = open(fname_new, "w")  # Temporary version of file to be edited
+    for line in [x for x in fr.split("\n") if len(x) > 0]:
+        left = line.split("--setnchn")[0]
+        right = line.split("-e")[1]
+        newline = f"{left}--setnchn {new_nchan} -e{right}\n"
+        fnew.write(newline)
+    fnew.close()
+    # Replace file with edited version
+    subprocess.run(f"mv {fname_new} {fname}", shell=True)
+
+    print("config.sh and scrunch.txt edited to reflect new # of subbands.\n")
+
+    # Switch to the pre-computed subband level if the scrunch step wrote one,
+    # otherwise run scrunch again, scrunching further in frequency this time.
+    if not use_scrunch_level(new_nchan):
+        processing_scrunch(base_jobname, tjob_scrunch, pulsar)
+
+
 def processing_scrunch(base_jobname, tjob_scrunch, pulsar, newdata=False):
     exp_scrunch = [
         "Scrunch in frequency, time, and polarization.",
@@ -165,7 +235,7 @@ def processing_scrunch(base_jobname, tjob_scrunch, pulsar, newdata=False):
 
 
 def make_template(
-    tjob_template, email, pulsar, force_proceed=False, force_overwrite=False
+    tjob_template, email, pulsar, force_proceed=False, force_overwrite=False, ncpus=1
 ):
     exp_templatecreation = [
         "Run the next generator script to create the next set of files",
@@ -181,6 +251,8 @@ def make_template(
         jobname=jobname_templatecreation,
         outfile=outfile_templatecreation,
         tjob=tjob_template,
+        # The native S/N scan runs in parallel
+        misc=f"-c {ncpus}" if get_config_value("template_select") == "native" else None,
     )
 
     write_template_creation(force_overwrite=force_overwrite)
@@ -190,15 +262,17 @@ def make_template(
         checkcomplete=outfile_templatecreation,
     )
 
+    native = get_config_value("template_engine") == "native"
     exp_templaterun = [
-        "Create the template using autotoa.",
+        f"Create the template using {'template.py' if native else 'autotoa'}.",
         "Adjust tjob with --tjob_template",
     ]
     outfile_templaterun = f"template_run_{pulsar}.out"
     cmd_templaterun = sbatch_cmd(
         "template_run.sh",
         email,
-        mem="126G",
+        # The native builder only holds one profile per file in memory
+        mem="8G" if native else "126G",
         outfile=outfile_templaterun,
         tjob=tjob_template,
     )
@@ -243,15 +317,40 @@ def make_template(
     return outfile_templaterun, templatefile
 
 
-def make_tim(tjob_tim, email, pulsar, ntry, force_overwrite=False, timtype=""):
+def tim_run_output(tim_sh="tim_run.sh"):
+    """The .tim file written by the last line of tim_run.sh."""
+    with open(tim_sh, "r") as f:
+        last = [x for x in f.read().split("\n") if len(x) > 0][-1]
+    # "... > tim", or "... > tim.tmp && mv tim.tmp tim"
+    return last.split(">")[-1].split()[-1]
+
+
+# Tool that tim_run.sh uses for each toa_engine
+TOA_TOOLS = {
+    "pat_sharded": "pat_shards.py",
+}
+# CHIRPP's own TOA engines, which tim_run.sh does not run until toas.py
+# --check_pat agrees with pat on CHIME data (they share its epochs and fit)
+UNCHECKED_TOA_ENGINES = {
+    "native": "toas.py",
+    "xspec": "xspec.py",
+    "wideband": "wideband.py",
+}
+
+
+def make_tim(
+    tjob_tim, email, pulsar, ntry, force_overwrite=False, timtype="", ncpus=1
+):
     exp_timcreation = f"TOA generation: try {ntry}"
     cmd_timcreation = "./tim_creation.sh"
 
     write_tim_creation(force_overwrite=force_overwrite, timtype=timtype)
     my_cmd(cmd_timcreation, exp_timcreation)
 
+    toa_engine = get_config_value("toa_engine") or "pat"
+    toa_cache = get_config_value("toa_cache") == "true"
     exp_timrun = [
-        "Create our .tim file using pat.",
+        f"Create our .tim file using {TOA_TOOLS.get(toa_engine, 'pat')}.",
         "Adjust tjob with --tjob_tim",
     ]
     outfile_timrun = f"tim_run_{pulsar}.out"
@@ -261,6 +360,8 @@ def make_tim(tjob_tim, email, pulsar, ntry, force_overwrite=False, timtype=""):
         mem="66G",
         outfile=outfile_timrun,
         tjob=tjob_tim,
+        # The native and sharded engines time files in parallel
+        misc=f"-c {ncpus}" if toa_engine != "pat" or toa_cache else None,
     )
 
     outfile_timrun = my_cmd(cmd_timrun, exp_timrun, checkcomplete=outfile_timrun)
@@ -268,38 +369,30 @@ def make_tim(tjob_tim, email, pulsar, ntry, force_overwrite=False, timtype=""):
     # Check that 75% of TOAs have S/N >= 8
     # If not, return the scrunch_factor that should make that happen
     # Use the .tim file from tim_run.sh
-    timrun_sh = open("tim_run.sh", "r")
-    trr = timrun_sh.read()
-    timrun_sh.close()
-    timfile = [x.split(">")[-1].strip() for x in trr.split("\n") if len(x) > 0][-1]
+    timfile = tim_run_output()
     if not os.path.exists(timfile):
-        print(f"error: could not find tim file {timfile}!")
+        print(
+            f"error: could not find tim file {timfile}! See log file: {outfile_timrun}"
+        )
         exit(1)
 
-    snr_25pct, snr_mean, _ = get_snr_pct(timfile=timfile)
+    # Keep the TOAs as a columnar store too, for vectorized checks and cuts
+    from toa_store import TOAStore
+
+    store = TOAStore.from_tim(timfile)
+    if len(store) == 0:
+        print(f"error: no TOAs in {timfile}! See log file: {outfile_timrun}")
+        exit(1)
+    storefile = store.save(f"{timfile[:-4]}.npy")
+    snr_25pct, snr_mean, _ = get_snr_pct(timfile=storefile)
     scrunch_factor = get_scrunch_factor(snr_25pct)
 
-    scrunch_txt = open("scrunch.txt", "r")
-    scr_line1 = [x for x in scrunch_txt.read().split("\n") if "--setnchn" in x][0]
-    scrunch_txt.close()
-    tim_nchan = int(scr_line1.split("--setnchn")[1].split()[0])
+    tim_nchan = get_scrunch_nchan()
 
     # Rename TOAs with lowercase "chime_" so tempo2 doesn't think every line is a comment
-    tim = open(timfile, "r")
-    tfr = tim.read()
-    tim.close()
-    lines = tfr.split("\n")
-    newlines = [
-        f"chime{x.lstrip('CHIME')}\n" if x.startswith("CHIME") else f"{x}\n"
-        for x in lines
-    ]
-    timfile_new = f"{timfile[:-4]}_new.tim"
-    tim_new = open(timfile_new, "w")
-    for newline in newlines:
-        tim_new.write(newline)
-    tim_new.close()
-    # Replace file with edited version
-    subprocess.run(f"mv {timfile_new} {timfile}", shell=True)
+    # (pat_shards.py and toa_cache.py already renamed them)
+    if toa_engine != "pat_sharded" and not toa_cache:
+        rename_toas(timfile)
 
     return (
         timfile,
@@ -308,7 +401,7 @@ def make_tim(tjob_tim, email, pulsar, ntry, force_overwrite=False, timtype=""):
         snr_25pct,
         snr_mean,
         scrunch_factor,
-        len(newlines),
+        len(store),
     )
 
 
@@ -371,22 +464,19 @@ def get_scrunch_factor(snr_25pct, snr_threshold=8, mean_nsubint=1):
 def get_snr_pct(percentile=25, extension=".bmwt.zap", max_subint=3600.0, timfile=None):
     """
     Determine the S/N value that excludes {percentile}% of the distribution,
-    given either a .tim file or a collection of profiles.
+    given either a .tim file (or a TOA store .npy) or a collection of profiles.
     Also return the mean S/N and the mean number of subints per file (if applicable)
     """
-    if timfile:
-        tim = open(timfile, "r")
-        tfr = tim.read()
-        tim.close()
-        snrs = np.array(
-            [
-                float(line.split("-snr")[1].split()[0])
-                for line in tfr.split("\n")
-                if "-snr" in line
-                and (not line.startswith("C") or line.startswith("CHIME"))
-            ]
-        )
-        snrs = np.array([x for x in snrs if not np.isnan(x)])
+    if timfile and timfile.endswith(".npy"):
+        # Columnar TOA store (see toa_store.py)
+        from toa_store import TOAStore
+
+        snrs = np.asarray(TOAStore.load(timfile).toas["snr"])
+        snrs = snrs[~np.isnan(snrs)]
+        return np.percentile(snrs, percentile), np.mean(snrs), 1
+    elif timfile:
+        snrs = read_flag(timfile, "-snr")
+        snrs = snrs[~np.isnan(snrs)]
         return np.percentile(snrs, percentile), np.mean(snrs), 1
     else:
         subprocess.run(
@@ -399,6 +489,68 @@ def get_snr_pct(percentile=25, extension=".bmwt.zap", max_subint=3600.0, timfile
         return np.percentile(snrs, percentile), np.mean(snrs), mean_nsubint
 
 
+def weighted_percentile(values, weights, percentile):
+    # Percentile of values where each value counts weights times
+    order = np.argsort(values)
+    values = np.asarray(values)[order]
+    cumw = np.cumsum(np.asarray(weights, dtype=float)[order])
+    return values[np.searchsorted(cumw, percentile / 100.0 * cumw[-1])]
+
+
+def predict_snr_pct(snrs, lengths, nchan, percentile=25, max_subint=3600.0):
+    """
+    Predicted {percentile}-th percentile of per-TOA S/N if every file were
+    scrunched to nchan subbands, given each file's fully scrunched S/N.
+    S/N scales as sqrt(bandwidth * integration time), and each file
+    contributes nchan * nsub TOAs to the distribution.
+    """
+    nsub = (np.asarray(lengths) / max_subint).astype(int) + 1
+    toa_snrs = np.asarray(snrs) / np.sqrt(nchan * nsub)
+    return weighted_percentile(toa_snrs, nchan * nsub, percentile)
+
+
+def predict_nchan(
+    snrs,
+    lengths,
+    snr_threshold=8.0,
+    min_nchan=8,
+    max_nchan=64,
+    max_subint=3600.0,
+    percentile=25,
+):
+    """
+    Largest power-of-two number of subbands (between min_nchan and max_nchan)
+    for which the predicted {percentile}-th percentile TOA S/N passes
+    snr_threshold, i.e. 75% of TOAs survive a S/N cut by default.
+    Also returns the prediction for each candidate nchan.
+    """
+    predictions = {}
+    nchan = max_nchan
+    while nchan >= min_nchan:
+        predictions[nchan] = predict_snr_pct(
+            snrs, lengths, nchan, percentile=percentile, max_subint=max_subint
+        )
+        nchan //= 2
+    passing = [n for n, snr_pct in predictions.items() if snr_pct >= snr_threshold]
+    best = max(passing) if len(passing) > 0 else min(predictions)
+    return best, predictions
+
+
+def adaptive_nchan(
+    snr, length, snr_threshold=8.0, min_nchan=8, max_nchan=64, max_subint=3600.0
+):
+    """
+    Per-observation number of subbands: the largest power of two (between
+    min_nchan and max_nchan) at which this file's TOAs are predicted to reach
+    snr_threshold, given its fully scrunched S/N.
+    """
+    nsub = int(length / max_subint) + 1
+    nchan = max_nchan
+    while nchan > min_nchan and snr / np.sqrt(nchan * nsub) < snr_threshold:
+        nchan //= 2
+    return max(nchan, min_nchan)
+
+
 def get_nchan(scrunch_factor, min_nchan=4, nchan_initial=1024):
     scrunch_factor = min(scrunch_factor, nchan_initial // min_nchan)
     if nchan_initial % scrunch_factor != 0:
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                Compressed storage of intermediate archives          ##
+#########################################################################
+
+Full-resolution intermediates (e.g. .bmwt.clfd) can be stored with their
+DATA column compressed one subint at a time (see psrfits.py). The file keeps
+its name and every header, so CHIRPP's reader (scrunch.py, snr.py, ...) uses it
+unchanged, only paying the CPU cost of decompressing the subints it reads.
+PSRCHIVE tools cannot read these files: decompress them first with -d.
+
+Whether compression pays off depends on how fast the disk is compared to
+zlib. --benchmark measures both sides for a sample file at each level.
+
+Run from the command line with:
+python compress.py -l 6 CHIME*.bmwt.clfd
+python compress.py -d CHIME*.bmwt.clfd
+python compress.py --benchmark CHIME_J0000+0000_beam_2_60000_00000.bmwt.clfd
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from psrfits import compress_archive, decompress_archive, open_archive
+from retention import format_size
+
+# zlib compression levels tried by --benchmark
+BENCHMARK_LEVELS = [1, 3, 6, 9]
+
+
+def read_time(fname):
+    """Seconds to read and scale every subint of fname, one at a time."""
+    start = perf_counter()
+    with open_archive(fname) as ar:
+        for isub in range(ar.nsub):
+            ar.data[isub]
+    return perf_counter() - start
+
+
+def benchmark(fname, levels=BENCHMARK_LEVELS):
+    """
+    Compress a copy of fname at each level and report the size, the time to
+    compress and the time to read it back. Reading the uncompressed copy again
+    right after writing it is served from the page cache, so the difference in
+    read time is the CPU cost of decompression. The break-even bandwidth is the
+    disk speed below which reading fewer bytes saves more than that cost.
+    """
+    size = os.path.getsize(fname)
+    rows = []
+    with tempfile.TemporaryDirectory(dir=".") as tmpdir:
+        plain = os.path.join(tmpdir, "plain")
+        shutil.copyfile(fname, plain)
+        decompress_archive(plain)
+        size = os.path.getsize(plain)
+        t_plain = read_time(plain)
+        for level in levels:
+            packed = os.path.join(tmpdir, f"level{level}")
+            start = perf_counter()
+            _, packed_size = compress_archive(plain, packed, level=level)
+            t_compress = perf_counter() - start
+            t_read = read_time(packed)
+            cpu = max(t_read - t_plain, 1e-9)
+            rows.append(
+                {
+                    "level": level,
+                    "size": packed_size,
+                    "ratio": size / packed_size,
+                    "compress": t_compress,
+                    "read": t_read,
+                    "break_even": (size - packed_size) / cpu,
+                }
+            )
+
+    print(f"\n{fname}: {format_size(size)} uncompressed, read in {t_plain:.2f} s\n")
+    print(
+        f"{'level':>5} {'size':>9} {'ratio':>6} {'compress (s)':>13} {'read (s)':>9} {'break-even I/O':>15}"
+    )
+    for row in rows:
+        print(
+            f"{row['level']:5d} {format_size(row['size']):>9} {row['ratio']:6.2f}"
+            + f" {row['compress']:13.2f} {row['read']:9.2f} {format_size(row['break_even']) + '/s':>15}"
+        )
+    print(
+        "\nCompression speeds up reading when the disk delivers less than the break-even"
+        + " bandwidth, and saves disk space either way.\n"
+    )
+    return rows
+
+
+def _convert_one(job):
+    fname, level, decompress = job
+    try:
+        if decompress:
+            decompress_archive(fname)
+            return fname, None, None
+        return fname, compress_archive(fname, level=level), None
+    except Exception as err:
+        return fname, None, f"{type(err).__name__}: {err}"
+
+
+def convert_files(files, level=6, decompress=False, nproc=1):
+    """Compress (or decompress) files in place. Returns the files that failed."""
+    jobs = [(fname, level, decompress) for fname in files]
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            results = list(pool.map(_convert_one, jobs))
+    else:
+        results = [_convert_one(job) for job in jobs]
+
+    failed = []
+    before, after = 0, 0
+    for fname, sizes, error in results:
+        if error:
+            print(f"error: could not convert {fname}: {error}")
+            failed.append(fname)
+        elif sizes:
+            before += sizes[0]
+            after += sizes[1]
+    if not decompress and after > 0:
+        print(
+            f"Compressed {len(files) - len(failed)} files from {format_size(before)} to {format_size(after)}."
+        )
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compress intermediate PSRFITS archives in place for CHIRPP's reader, or restore them for PSRCHIVE."
+    )
+    parser.add_argument("files", nargs="+", help="Archives to convert.")
+    parser.add_argument(
+        "-l",
+        "--level",
+        type=int,
+        default=6,
+        choices=range(1, 10),
+        metavar="{1..9}",
+        help="zlib compression level: 1 is fastest, 9 is smallest (6 by default).",
+    )
+    parser.add_argument(
+        "-d",
+        "--decompress",
+        action="store_true",
+        help="Restore standard PSRFITS files that PSRCHIVE can read.",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help=f"Report size, compression time and read time of the first file at levels {BENCHMARK_LEVELS}, without modifying it.",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of files to convert in parallel (1 by default).",
+    )
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.files[0])
+        exit(0)
+
+    failed = convert_files(
+        args.files, level=args.level, decompress=args.decompress, nproc=args.nproc
+    )
+    if len(failed) > 0:
+        exit(1)
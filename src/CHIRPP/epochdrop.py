@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##             Shared-memory epoch-drop test (epochalyptica)           ##
+#########################################################################
+
+pint_pal's epochalyptica refits all TOAs once per epoch (TOAs of one file, by
+their -name flag) left out, and cuts the epochs whose removal improves the
+chi^2 by more than chance would (F-test probability below a threshold). Here
+the fit is instead linearized once, at the model fit to all TOAs. With the
+whitened design matrix A (the free timing parameters, then the basis of the
+correlated noise, ECORR included), the prior precision P of the noise basis
+(zero for timing parameters) and the whitened residuals e of the linear fit,
+the chi^2 of the refit without the k TOAs of an epoch follows from a rank-k
+downdate of the normal matrix S = A^T A + P (Woodbury identity):
+    chi2_drop = chi2 - e_k^T (I - H_k)^-1 e_k,    H_k = A_k S^-1 A_k^T
+which only needs the columns of S^-1 where the epoch's rows of A are non-zero
+(the timing parameters, the red noise, and its own ECORR and DMX), so each
+epoch costs O(k m^2) for m such columns instead of a full refit. Timing
+parameters that only this epoch constrains (e.g. its DMX) are lost with it:
+they show up as unit eigenvalues of H_k, and are given back to the degrees
+of freedom. Being linearized, chi2_drop differs from a refit only by terms of
+second order in the parameter changes.
+
+S^-1, the epochs' rows of A and e are put in shared memory once and the
+epochs are shared over a process pool. Every finished epoch is appended to a
+checkpoint file (name, chi2_drop, ndof_drop, ntoas; by default
+outlier/<source>.nb/epochdrop_checkpoint.txt), headed by a hash of the fit it
+belongs to, so a killed run resumes where it stopped; a checkpoint of a
+different fit is started again. The finished file is the table of results.
+As epochalyptica does, dropped epochs are cut and the excise .tim written.
+
+Narrowband TOAs only; for wideband TOAs use epochalyptica.
+
+Run from the command line with:
+python epochdrop.py -c J0000+0000.yaml -j 8
+python epochdrop.py -c J0000+0000.yaml -j 8 --checkpoint J0000+0000_epochdrop.txt --threshold 1e-6
+"""
+
+import argparse
+import hashlib
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from scipy.linalg import cho_factor, cho_solve, eigh
+from pint.fitter import ConvergenceFailure
+from pint.utils import FTest
+from pint_pal.dmx_utils import setup_dmx
+from pint_pal.lite_utils import write_tim
+from pint_pal.utils import apply_cut_flag, apply_cut_select
+
+FTEST_THRESHOLD = 1.0e-6
+# Epochs per task handed to a worker
+BATCH = 32
+# Eigenvalues of I - H_k below this count as a parameter lost with the epoch
+LOST_TOL = 1.0e-8
+
+
+class SharedArrays:
+    """
+    Named numpy arrays in one shared memory block. Created by the parent with
+    create(), re-opened by workers with attach(spec).
+    """
+
+    def __init__(self, shm, arrays):
+        self.shm = shm
+        self.arrays = arrays
+
+    @classmethod
+    def create(cls, **arrays):
+        layout = {}
+        size = 0
+        for name, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            layout[name] = (size, a.shape, a.dtype.str)
+            size += max(a.nbytes, 1)
+            # Keep every array 8-byte aligned
+            size += -size % 8
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self = cls(shm, {})
+        self.layout = layout
+        self._view()
+        for name, a in arrays.items():
+            self.arrays[name][...] = a
+        return self
+
+    @classmethod
+    def attach(cls, spec):
+        name, layout = spec
+        self = cls(shared_memory.SharedMemory(name=name), {})
+        self.layout = layout
+        self._view()
+        return self
+
+    def _view(self):
+        for name, (offset, shape, dtype) in self.layout.items():
+            self.arrays[name] = np.ndarray(
+                shape, dtype=dtype, buffer=self.shm.buf, offset=offset
+            )
+
+    @property
+    def spec(self):
+        return (self.shm.name, self.layout)
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def linearized_fit(model, toas):
+    """
+    The whitened linear system at model: A (timing parameters then noise
+    basis), the prior precision of its columns, the TOA uncertainties used to
+    whiten it, and the number and names of the timing columns.
+    """
+    M, params, units = model.designmatrix(toas)
+    sigma = model.scaled_toa_uncertainty(toas).to_value("s")
+    columns = [M]
+    prior = [np.zeros(M.shape[1])]
+    if model.has_correlated_errors:
+        columns.append(model.noise_model_designmatrix(toas))
+        prior.append(1.0 / model.noise_model_basis_weight(toas))
+    A = np.hstack(columns) / sigma[:, None]
+    return A, np.concatenate(prior), sigma, M.shape[1], params
+
+
+def fit_system(A, prior, r):
+    """
+    Solve the whitened linear fit once: returns S^-1 (S = A^T A + P), the
+    residuals e of the fit and its chi^2 (including the noise prior term).
+    Columns are normalized for the solve and S^-1 returned in those units,
+    along with the normalization.
+    """
+    norm = np.sqrt((A**2).sum(axis=0) + prior)
+    norm[norm == 0] = 1.0
+    An = A / norm
+    S = An.T @ An + np.diag(prior / norm**2)
+    factor = cho_factor(S)
+    x = cho_solve(factor, An.T @ r)
+    e = r - An @ x
+    chi2 = float(e @ e + x @ (prior / norm**2 * x))
+    cov = cho_solve(factor, np.eye(len(S)))
+    return cov, e, chi2, norm
+
+
+def pack_epochs(An, names):
+    """
+    Group the rows of An by epoch name, keeping only each epoch's non-zero
+    columns. Returns the epoch names, the packed rows, and per epoch the row
+    indices (into e), their offsets, the kept columns and their offsets.
+    """
+    epochs, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(len(epochs) + 1))
+    blocks, cols = [], []
+    block_off, col_off = [0], [0]
+    for i in range(len(epochs)):
+        rows = order[bounds[i] : bounds[i + 1]]
+        sub = An[rows]
+        keep = np.nonzero(np.any(sub != 0, axis=0))[0]
+        blocks.append(sub[:, keep].ravel())
+        cols.append(keep)
+        block_off.append(block_off[-1] + len(rows) * len(keep))
+        col_off.append(col_off[-1] + len(keep))
+    return (
+        epochs,
+        np.concatenate(blocks) if blocks else np.zeros(0),
+        order,
+        bounds,
+        np.concatenate(cols).astype(np.int64) if cols else np.zeros(0, np.int64),
+        np.array(block_off),
+        np.array(col_off),
+    )
+
+
+def drop_one(shared, i, ntiming):
+    """chi^2 decrease and parameters lost when epoch i is left out."""
+    a = shared.arrays
+    rows = a["order"][a["bounds"][i] : a["bounds"][i + 1]]
+    cols = a["cols"][a["col_off"][i] : a["col_off"][i + 1]]
+    Ak = a["blocks"][a["block_off"][i] : a["block_off"][i + 1]].reshape(
+        len(rows), len(cols)
+    )
+    ek = a["e"][rows]
+    H = Ak @ a["cov"][np.ix_(cols, cols)] @ Ak.T
+    # I - H_k is symmetric; its (near) null space is what the epoch alone fits
+    w, V = eigh(np.eye(len(rows)) - H)
+    lost = int(np.sum(w < LOST_TOL))
+    keep = w >= LOST_TOL
+    proj = V[:, keep].T @ ek
+    decrease = float(proj @ (proj / w[keep]))
+    # Only timing parameters can be lost; noise columns keep their prior
+    return decrease, min(lost, ntiming), len(rows)
+
+
+_shared = None
+
+
+def _init_worker(spec):
+    global _shared
+    _shared = SharedArrays.attach(spec)
+
+
+def _drop_batch(job):
+    batch, ntiming = job
+    return [(i, *drop_one(_shared, i, ntiming)) for i in batch]
+
+
+def fit_stamp(e, epochs, params):
+    sha = hashlib.sha1(np.ascontiguousarray(e).tobytes())
+    sha.update(" ".join(params).encode())
+    sha.update(" ".join(epochs).encode())
+    return sha.hexdigest()
+
+
+def read_checkpoint(checkpoint, stamp):
+    """Results in checkpoint if it belongs to the fit with this stamp."""
+    done = {}
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return done
+    with open(checkpoint, "r") as f:
+        header = f.readline().split()
+        if header[:2] != ["#", "epochdrop"] or header[2:3] != [stamp]:
+            return {}
+        for line in f:
+            fields = line.split()
+            if len(fields) == 4 and not line.startswith("#"):
+                done[fields[0]] = (float(fields[1]), int(fields[2]), int(fields[3]))
+    return done
+
+
+def drop_epochs(
+    A, prior, r, names, params, ntiming, ndof, nproc=1, checkpoint=None, only=None
+):
+    """
+    chi^2 and degrees of freedom of the fit to all TOAs, and {epoch: (chi2,
+    ndof, ntoas)} of the fits without each epoch (each epoch in only, if
+    given), resuming from (and writing to) checkpoint.
+    """
+    global _shared
+    cov, e, chi2, norm = fit_system(A, prior, r)
+    An = A / norm
+    epochs, blocks, order, bounds, cols, block_off, col_off = pack_epochs(An, names)
+    del An
+    stamp = fit_stamp(e, epochs, params)
+    done = read_checkpoint(checkpoint, stamp)
+    tested = [i for i, name in enumerate(epochs) if only is None or name in only]
+    todo = [i for i in tested if epochs[i] not in done]
+    print(f"{len(tested)} epochs to test, {len(tested) - len(todo)} checkpointed.")
+
+    out = None
+    if checkpoint is not None:
+        fresh = not done
+        out = open(checkpoint, "w" if fresh else "a")
+        if fresh:
+            out.write(f"# epochdrop {stamp} {chi2!r} {ndof}\n")
+            out.write("# name chi2 ndof ntoas\n")
+            out.flush()
+
+    def record(results):
+        for i, decrease, lost, k in results:
+            entry = (chi2 - decrease, int(ndof) - k + lost, k)
+            done[epochs[i]] = entry
+            if out is not None:
+                out.write(f"{epochs[i]} {entry[0]!r} {entry[1]} {entry[2]}\n")
+        if out is not None:
+            out.flush()
+
+    shared = SharedArrays.create(
+        cov=cov,
+        e=e,
+        blocks=blocks,
+        order=order,
+        bounds=bounds,
+        cols=cols,
+        block_off=block_off,
+        col_off=col_off,
+    )
+    del cov, blocks
+    try:
+        jobs = [(todo[i : i + BATCH], ntiming) for i in range(0, len(todo), BATCH)]
+        if nproc > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(
+                max_workers=nproc, initializer=_init_worker, initargs=(shared.spec,)
+            ) as pool:
+                for future in as_completed([pool.submit(_drop_batch, j) for j in jobs]):
+                    record(future.result())
+        else:
+            _shared = shared
+            for job in jobs:
+                record(_drop_batch(job))
+    finally:
+        _shared = None
+        shared.close(unlink=True)
+        if out is not None:
+            out.close()
+    return chi2, ndof, {name: done[name] for name in epochs[tested]}
+
+
+def dropped_epochs(chi2, ndof, results, ftest_threshold=FTEST_THRESHOLD):
+    """Epochs whose removal improves the fit beyond ftest_threshold."""
+    return {
+        name
+        for name, (chi2_drop, ndof_drop, ntoas) in results.items()
+        if FTest(chi2, ndof, chi2_drop, ndof_drop) < ftest_threshold
+    }
+
+
+def fit_uncut(model, toas, tc):
+    """A fitter of the config, fit to the TOAs that are not cut."""
+    fo = tc.construct_fitter(toas, model)
+    try:
+        fo.fit_toas(maxiter=tc.get_niter())
+    except ConvergenceFailure:
+        print("Fitter failed to converge; moving on with best result.")
+    return fo
+
+
+def outlier_dir(tc):
+    """Where pint_pal's outlier analysis writes its results."""
+    return f"outlier/{tc.get_outfile_basename()}"
+
+
+def cut_epochs(toas, epochs, flag="epochdrop", reason="epoch drop analysis"):
+    """Cut (as pint_pal does, in toas.orig_table) all TOAs of epochs."""
+    names = np.array([f["name"] for f in toas.orig_table["flags"]])
+    drop = np.where(np.isin(names, list(epochs)))[0]
+    if len(drop):
+        apply_cut_flag(toas, drop, flag)
+        apply_cut_select(toas, reason=reason)
+
+
+def write_excise_tim(model, toas, tc):
+    """All TOAs, with their -cut (and -pout) flags, as epochalyptica writes them."""
+    toas.table = toas.orig_table
+    fo = tc.construct_fitter(toas, model)
+    excise_timfile = f"{outlier_dir(tc)}/{tc.get_outfile_basename()}_excise.tim"
+    write_tim(fo, toatype=tc.get_toa_type(), outfile=excise_timfile)
+    apply_cut_select(toas, reason="resumption after write_tim (excise)")
+    return excise_timfile
+
+
+def epochdrop(
+    model,
+    toas,
+    tc,
+    ftest_threshold=FTEST_THRESHOLD,
+    nproc=1,
+    checkpoint=None,
+    only=None,
+):
+    """
+    In place of epochalyptica: fit the TOAs that are not cut, cut (flag
+    "epochdrop") the epochs (of those in only, if given) whose removal
+    improves the fit with an F-test probability below ftest_threshold, and
+    write the excise .tim. Returns the TOAs, the dropped epochs and the
+    results of drop_epochs.
+    """
+    os.makedirs(outlier_dir(tc), exist_ok=True)
+    if checkpoint is None:
+        checkpoint = f"{outlier_dir(tc)}/epochdrop_checkpoint.txt"
+    fo = fit_uncut(model, toas, tc)
+    A, prior, sigma, ntiming, params = linearized_fit(fo.model, fo.toas)
+    r = fo.resids.time_resids.to_value("s") / sigma
+    names = fo.toas.get_flag_value("name")[0]
+    chi2, ndof, results = drop_epochs(
+        A, prior, r, names, params, ntiming, fo.resids.dof, nproc, checkpoint, only
+    )
+    bad = dropped_epochs(chi2, ndof, results, ftest_threshold)
+    print(f"{len(bad)} of {len(results)} epochs dropped.")
+    if bad:
+        cut_epochs(toas, bad)
+        toas = setup_dmx(
+            model, toas, frequency_ratio=tc.get_fratio(), max_delta_t=tc.get_sw_delay()
+        )
+    write_excise_tim(model, toas, tc)
+    return toas, bad, (chi2, ndof, results)
+
+
+if __name__ == "__main__":
+    from pint_pal.timingconfiguration import TimingConfiguration
+
+    parser = argparse.ArgumentParser(
+        description="Epoch-drop test of the TOAs of a pulsar config by rank-k downdates of one linearized fit."
+    )
+    parser.add_argument(
+        "-c", "--config", required=True, help="Pulsar config (.yaml) file."
+    )
+    parser.add_argument(
+        "-p", "--par_directory", default=None, help=".par file location."
+    )
+    parser.add_argument(
+        "-t", "--tim_directory", default=None, help=".tim file location."
+    )
+    parser.add_argument(
+        "-j", "--nproc", type=int, default=1, help="Number of parallel processes."
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=None,
+        help="Checkpoint/results file (default: outlier/<source>.nb/epochdrop_checkpoint.txt).",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=FTEST_THRESHOLD,
+        help="F-test probability below which an epoch is dropped.",
+    )
+    args = parser.parse_args()
+
+    tc = TimingConfiguration(
+        args.config, par_directory=args.par_directory, tim_directory=args.tim_directory
+    )
+    mo, to = tc.get_model_and_toas(apply_initial_cuts=True)
+    to = setup_dmx(
+        mo, to, frequency_ratio=tc.get_fratio(), max_delta_t=tc.get_sw_delay()
+    )
+    epochdrop(
+        mo,
+        to,
+        tc,
+        ftest_threshold=args.threshold,
+        nproc=args.nproc,
+        checkpoint=args.checkpoint,
+    )
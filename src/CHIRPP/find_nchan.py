@@ -12,10 +12,18 @@ Using the scaling: N_subbands = (x/8)**2 ∝ sqrt(BandWidth) at 25th percentile.
 Run from the command line with: 
 python find_nchan.py  # Uses the default '*.bmwt.zap'
 python find_nchan.py -e clfd # Specify which extension to run on
+python find_nchan.py -e .ftp --predict # Predict the per-TOA S/N distribution from each file's S/N
+python find_nchan.py -e .bmwt.clfd -n 64 --manifest nchan_manifest.txt # Choose nchan per observation
 """
 
 import argparse
-from CHIRPP_utils import get_nchan, get_scrunch_factor, get_snr_pct
+from CHIRPP_utils import (
+    adaptive_nchan,
+    get_nchan,
+    get_scrunch_factor,
+    get_snr_pct,
+    predict_nchan,
+)
 
 if __name__ == "__main__":
     # Set up argparse to handle command line input
@@ -64,8 +72,75 @@ if __name__ == "__main__":
         default=3600.0,
         help="Maximum subint duration in seconds (3600.0 by default), if providing a file extension.",
     )
+    parser.add_argument(
+        "--predict",
+        action="store_true",
+        help="With -e, predict the per-TOA S/N distribution for every power-of-two nchan from each file's fully scrunched S/N.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="With -e, write the number of subbands chosen for each observation (up to -n) to this file.",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes used to measure S/N with --predict or --manifest (1 by default).",
+    )
     args = parser.parse_args()
 
+    if args.manifest and args.extension:
+        from glob import glob
+        from snr import measure_files
+        from scrunch import write_nchan_manifest
+
+        files = sorted(glob(f"*{args.extension}"))
+        stats = measure_files(files, nproc=args.nproc)
+        nchans = {
+            fname: adaptive_nchan(
+                x["snr"],
+                x["length"],
+                snr_threshold=args.snr_threshold,
+                min_nchan=args.min_nchan,
+                max_nchan=args.nchan,
+                max_subint=args.max_subint,
+            )
+            for fname, x in stats.items()
+        }
+        write_nchan_manifest(nchans, args.manifest)
+        print(f"Number of subbands chosen for {len(nchans)} observations:")
+        for nchan in sorted(set(nchans.values()), reverse=True):
+            count = list(nchans.values()).count(nchan)
+            print(f"    {nchan:5d}: {count} files")
+        print(f"\nManifest written to {args.manifest}\n")
+        exit(0)
+
+    if args.predict and args.extension:
+        from glob import glob
+        from snr import measure_files
+
+        files = sorted(glob(f"*{args.extension}"))
+        stats = list(measure_files(files, nproc=args.nproc).values())
+        if len(stats) == 0:
+            print(f"error: no readable files with extension {args.extension}!")
+            exit(1)
+        nchan_scrunched, predictions = predict_nchan(
+            [x["snr"] for x in stats],
+            [x["length"] for x in stats],
+            snr_threshold=args.snr_threshold,
+            min_nchan=args.min_nchan,
+            max_nchan=args.nchan,
+            max_subint=args.max_subint,
+        )
+        print("Predicted 25th-percentile TOA S/N by number of subbands:")
+        for nchan, snr_pct in predictions.items():
+            print(f"    {nchan:5d}: {snr_pct:.2f}")
+        print(f"\nRecommended number of subbands: {nchan_scrunched}\n")
+        exit(0)
+
     # Use file extension or .tim file provided via command-line argument
     snr_25pct, snr_mean, mean_nsubint = get_snr_pct(
         25, extension=args.extension, timfile=args.tim
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##              Warm-started timing fits for appended TOAs             ##
+#########################################################################
+
+timing_fit.py re-centres the epochs, rebuilds every DMX window and fits all
+free parameters from the configured .par. With --incremental, the solution of
+the last fit is kept in <source>.nb_fit.npz (its .par, the covariance of its
+fitted parameters, and the TOAs it was fit to) and the next fit starts from it:
+    - the model is the last fit's, so its epochs and DMX windows are kept;
+      windows are only added for new TOAs outside every existing one (as
+      setup_dmx would make them, cutting those failing the frequency ratio);
+    - the fitter is warm-started from the last solution, so it converges in
+      fewer iterations;
+    - with --quick, the fitter is not run at all: the last solution and its
+      covariance are the prior of a single linear (Kalman) update with the new
+      TOAs only. Parameters not fit last time (e.g. new DMX) are unconstrained
+      a priori, and the correlated noise of the new TOAs is given its prior;
+      the red-noise coefficients of the last fit are not carried over, so
+      this is a quick-look solution, and the next full fit refines it.
+If the configured .par is neither the one the state started from nor the one
+the last fit wrote, or there is no state, all TOAs are fit as before.
+
+Run from the command line with:
+python timing_fit.py J0000+0000.yaml --incremental  # After new_data.py adds TOAs
+python timing_fit.py J0000+0000.yaml --incremental --quick
+"""
+
+import io
+import os
+import astropy.units as u
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve, pinvh
+from pint.models import get_model
+from pint.models.noise_model import EcorrNoise
+from pint.residuals import Residuals
+from pint_pal.dmx_utils import (
+    add_dmx,
+    check_frequency_ratio,
+    check_solar_wind,
+    get_dmx_mask,
+    get_dmx_ranges,
+)
+from pint_pal.utils import apply_cut_flag, apply_cut_select
+from incremental_outliers import dmx_windows, toa_keys
+from pint_cache import file_sha1
+
+# setup_dmx's default DMX window (d)
+DMX_BIN_WIDTH = 6.5
+
+
+def state_path(tc):
+    return f"{tc.get_outfile_basename()}_fit.npz"
+
+
+def load_fit_state(path):
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as f:
+        return {k: f[k] for k in f.files}
+
+
+def save_fit_state(path, model, toas, params, cov, par_sha):
+    """Save the fit (par_sha: SHA-1s of the .par it started from and wrote)."""
+    # Written under a temporary name, so a crash never leaves a partial state
+    tmp = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp,
+        par=np.array(model.as_parfile()),
+        params=np.array(params),
+        cov=np.asarray(cov, dtype=float),
+        keys=np.array(toa_keys(toas.table)),
+        par_sha=np.array(par_sha),
+    )
+    os.replace(tmp, path)
+
+
+def state_matches(state, par_path):
+    """True if the configured .par is one the state started from or wrote."""
+    return file_sha1(par_path) in state["par_sha"].tolist()
+
+
+def warm_model(state):
+    """The model of the last fit."""
+    return get_model(io.StringIO(str(state["par"])), allow_name_mixing=True)
+
+
+def new_toas(toas, state):
+    """Mask of the uncut TOAs the last fit did not have."""
+    return ~np.isin(toa_keys(toas.table), state["keys"])
+
+
+def add_new_dmx(model, toas, new, frequency_ratio=1.1, max_delta_t=0.1):
+    """
+    Add DMX windows for the new TOAs outside every window of model, as
+    setup_dmx makes them; TOAs in windows failing its frequency ratio check
+    are cut. Returns the TOAs and the number of windows added.
+    """
+    if "DispersionDMX" not in model.components:
+        add_dmx(model, DMX_BIN_WIDTH)
+    covered = np.zeros(len(toas), dtype=bool)
+    for r1, r2 in dmx_windows(model):
+        covered |= get_dmx_mask(toas, r1, r2)
+    outside = new & ~covered
+    if not outside.any():
+        return toas, 0
+    sub = toas[outside]
+    ranges = get_dmx_ranges(sub, bin_width=DMX_BIN_WIDTH, pad=0.05, check=False)
+    ranges = check_solar_wind(
+        sub,
+        ranges,
+        model,
+        max_delta_t=max_delta_t,
+        bin_width=0.5,
+        pad=0.05,
+        check=False,
+        quiet=True,
+    )
+    _, iranges = check_frequency_ratio(
+        sub, ranges, frequency_ratio=frequency_ratio, quiet=True
+    )
+    ftoas, _ = check_frequency_ratio(
+        sub, ranges, frequency_ratio=frequency_ratio, quiet=True, invert=True
+    )
+    fratio_inds = sub.table["index"][ftoas]
+    if len(fratio_inds):
+        apply_cut_flag(toas, fratio_inds, "dmx")
+        apply_cut_select(toas, reason="frequency ratio check")
+    dmx = model.components["DispersionDMX"]
+    start = max(dmx.get_indices(), default=0) + 1
+    # New windows start from the DMX of the latest window before them
+    previous = sorted(
+        (model[f"DMXR2_{i:04d}"].value, model[f"DMX_{i:04d}"].value)
+        for i in dmx.get_indices()
+    )
+    ranges = sorted(np.array(ranges)[iranges].tolist())
+    for i, (r1, r2) in enumerate(ranges):
+        before = [value for end, value in previous if end <= r1]
+        dmx.add_DMX_range(
+            r1, r2, index=start + i, dmx=before[-1] if before else 0.0, frozen=False
+        )
+    return toas, len(ranges)
+
+
+def fit_covariance(fo):
+    """Names and covariance (in their units) of the parameters fo fit."""
+    cov = fo.parameter_covariance_matrix
+    params = cov.get_label_names(axis=0)
+    return params, cov.get_label_matrix(params).matrix
+
+
+def precision(cov):
+    """Inverse of a covariance matrix of parameters of very different scales."""
+    scale = np.sqrt(np.diag(cov))
+    scale[scale == 0] = 1.0
+    return pinvh(cov / np.outer(scale, scale)) / np.outer(scale, scale)
+
+
+def noise_basis(model, toas, rows):
+    """
+    Basis of the correlated noise at the TOAs rows and its prior precision.
+    ECORR is evaluated on those TOAs only; the other bases span the whole data
+    set (their frequencies depend on it), so they are evaluated on all TOAs.
+    """
+    sub = toas[rows]
+    bases, precisions = [], []
+    for basis_weight in model.basis_funcs:
+        if isinstance(getattr(basis_weight, "__self__", None), EcorrNoise):
+            U, phi = basis_weight(sub)
+        else:
+            U, phi = basis_weight(toas)
+            U = U[rows]
+        bases.append(U)
+        precisions.append(np.diag(1.0 / phi) if np.ndim(phi) == 1 else precision(phi))
+    if not bases:
+        return np.zeros((rows.sum(), 0)), np.zeros((0, 0))
+    sizes = [len(p) for p in precisions]
+    P = np.zeros((sum(sizes), sum(sizes)))
+    for offset, p in zip(np.cumsum([0] + sizes), precisions):
+        P[offset : offset + len(p), offset : offset + len(p)] = p
+    return np.hstack(bases), P
+
+
+def sequential_update(model, toas, new, params, cov):
+    """
+    Update model, at the last fit's solution with covariance cov of params,
+    with the TOAs where new is True: one linear (Kalman) update whose prior is
+    the last fit. Parameters are moved and their uncertainties set in place.
+    Returns the names and covariance of the updated parameters.
+    """
+    M, names, units = model.designmatrix(toas[new])
+    sigma = model.scaled_toa_uncertainty(toas).to_value("s")
+    # Residuals are referenced to the last fit's TOAs, whose weighted mean the
+    # last fit made zero, so its Offset stays meaningful
+    r = Residuals(toas, model, subtract_mean=False).time_resids.to_value("s")
+    r = (r[new] - np.average(r[~new], weights=sigma[~new] ** -2)) / sigma[new]
+    sigma = sigma[new]
+    U, noise_precision = noise_basis(model, toas, new)
+    ntiming = M.shape[1]
+    A = np.hstack([M, U]) / sigma[:, None]
+    P = np.zeros((A.shape[1], A.shape[1]))
+    P[ntiming:, ntiming:] = noise_precision
+    # The last fit's marginal covariance is the prior
+    old = {p: i for i, p in enumerate(params)}
+    prior = [i for i, p in enumerate(names) if p in old]
+    if prior:
+        iold = [old[names[i]] for i in prior]
+        P[np.ix_(prior, prior)] = precision(cov[np.ix_(iold, iold)])
+    # Columns nothing constrains (e.g. new windows without TOAs) are left alone
+    norm = np.sqrt((A**2).sum(axis=0) + np.diag(P))
+    keep = norm > 0
+    An = A[:, keep] / norm[keep]
+    S = An.T @ An + P[np.ix_(keep, keep)] / np.outer(norm[keep], norm[keep])
+    factor = cho_factor(S)
+    x = np.zeros(A.shape[1])
+    x[keep] = cho_solve(factor, An.T @ r) / norm[keep]
+    new_cov = np.zeros((A.shape[1], A.shape[1]))
+    new_cov[np.ix_(keep, keep)] = cho_solve(factor, np.eye(len(S))) / np.outer(
+        norm[keep], norm[keep]
+    )
+    # Columns are in s per units[i], so the steps are in s / units[i], which
+    # need not be the parameter's own unit (as in PINT's fitters)
+    for i, p in enumerate(names):
+        if p == "Offset" or not keep[i]:
+            continue
+        model[p].quantity = model[p].quantity + x[i] * u.s / units[i]
+        model[p].uncertainty = np.sqrt(new_cov[i, i]) * u.s / units[i]
+    return names, new_cov[:ntiming, :ntiming]
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##              Incremental outlier analysis for new TOAs              ##
+#########################################################################
+
+After new_data.py adds TOAs, outlier_excision.py would compute outlier
+probabilities (pout) and run the epoch-drop test for every TOA again. Here
+the results of the last run are kept in outlier/<source>.nb/outliers.json
+(pout of every TOA, and for every epoch its DMX window and whether it was
+dropped) and carried forward:
+    - TOAs seen before keep their pout; if there are new TOAs, pout is
+      computed with calculate_pout (the configured outlier model, on all
+      current TOAs) and only the new TOAs' values are kept;
+    - epochs seen before keep their epoch-drop result, unless the DMX window
+      they are in changed; new epochs and those are tested with epochdrop.py.
+Only the epoch-drop test is incremental. Whenever there are new TOAs, the
+outlier model (HMC or Gibbs) is run over the whole data set, so the pout
+step, usually the most expensive one, costs as much as in a full run; it is
+only skipped when no TOAs were added.
+make_pout_cuts then cuts on pout as usual, and all TOAs, with their -pout_*
+and -cut flags, are written to the excise .tim as epochalyptica writes it
+(outlier/<source>.nb/<source>.nb_excise.tim). Without a state file, pout is
+computed with calculate_pout and every epoch tested, and the state written.
+
+Narrowband TOAs only.
+
+Run from the command line with:
+python incremental_outliers.py -c J0000+0000.yaml -j 8
+"""
+
+import argparse
+import json
+import os
+import numpy as np
+from pint_pal.dmx_utils import setup_dmx
+from pint_pal.outlier_utils import calculate_pout, make_pout_cuts
+from pint_pal.timingconfiguration import TimingConfiguration
+from epochdrop import cut_epochs, epochdrop, outlier_dir, write_excise_tim
+
+
+def toa_keys(table):
+    """A key per TOA of a PINT TOA table, from its file, frequency and MJD."""
+    names = [f["name"] for f in table["flags"]]
+    freqs = np.asarray(table["freq"], dtype=float)
+    mjds = np.asarray(table["mjd_float"], dtype=float)
+    return [f"{n} {f:.4f} {m:.9f}" for n, f, m in zip(names, freqs, mjds)]
+
+
+def dmx_windows(model):
+    """[DMXR1, DMXR2] of every DMX window of model."""
+    if "DispersionDMX" not in model.components:
+        return []
+    return [
+        [getattr(model, f"DMXR{j}_{i:04d}").value for j in [1, 2]]
+        for i in sorted(model.get_prefix_mapping("DMXR1_"))
+    ]
+
+
+def epoch_windows(toas, windows):
+    """{epoch: DMX window containing its mean MJD, or None} of the uncut TOAs."""
+    names = np.array([f["name"] for f in toas.table["flags"]])
+    mjds = np.asarray(toas.table["mjd_float"], dtype=float)
+    found = {}
+    for name in np.unique(names):
+        mjd = mjds[names == name].mean()
+        found[str(name)] = next((w for w in windows if w[0] <= mjd <= w[1]), None)
+    return found
+
+
+def flagged_pouts(table, pout_flag, keys=None):
+    """{key: pout} of the TOAs of table with a pout flag (and one of keys)."""
+    return {
+        k: float(f[pout_flag])
+        for k, f in zip(toa_keys(table), table["flags"])
+        if pout_flag in f and (keys is None or k in keys)
+    }
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    # Written under a temporary name, so a crash never leaves a partial state
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def run_incremental_outlier_analysis(
+    config, par_directory=None, tim_directory=None, nproc=1, state_path=None
+):
+    tc = TimingConfiguration(
+        config, par_directory=par_directory, tim_directory=tim_directory
+    )
+    if tc.get_toa_type() == "WB":
+        print("error: incremental outlier analysis is for narrowband TOAs only.")
+        exit(1)
+    os.makedirs(outlier_dir(tc), exist_ok=True)
+    state_path = state_path or f"{outlier_dir(tc)}/outliers.json"
+    # The flag pint_pal's prob-outlier cut reads
+    pout_flag = f"pout_{tc.get_outlier_method().lower()}"
+    mo, to = tc.get_model_and_toas(apply_initial_cuts=True)
+    to = setup_dmx(
+        mo, to, frequency_ratio=tc.get_fratio(), max_delta_t=tc.get_sw_delay()
+    )
+    windows = epoch_windows(to, dmx_windows(mo))
+    state = load_state(state_path)
+
+    # Outlier probabilities: carried forward, or computed for new TOAs only
+    if state is None:
+        print(f"No state in {state_path}: analysing all TOAs.")
+        tc.check_outlier()
+        calculate_pout(mo, to, tc)
+        pouts = flagged_pouts(to.orig_table, pout_flag)
+        recheck = None
+        carried = set()
+    else:
+        uncut = toa_keys(to.table)
+        pouts = {k: state["pout"][k] for k in uncut if k in state["pout"]}
+        new = set(uncut) - set(pouts)
+        if new:
+            # The same outlier model as a full run; the old TOAs keep theirs
+            tc.check_outlier()
+            calculate_pout(mo, to, tc)
+            pouts.update(flagged_pouts(to.orig_table, pout_flag, new))
+        print(f"{len(new)} new TOAs of {len(uncut)}.")
+        for key, flags in zip(toa_keys(to.orig_table), to.orig_table["flags"]):
+            if key in pouts:
+                flags[pout_flag] = str(pouts[key])
+        # New epochs, and those whose DMX window changed
+        recheck = {
+            name
+            for name, window in windows.items()
+            if state["epochs"].get(name, {}).get("dmx", False) != window
+        }
+        carried = {
+            name
+            for name, old in state["epochs"].items()
+            if old["dropped"] and name in windows and name not in recheck
+        }
+        print(f"{len(recheck)} epochs to (re)test; {len(carried)} stay dropped.")
+
+    make_pout_cuts(mo, to, tc, outpct_threshold=8.0)
+    cut_epochs(to, carried, reason="epoch drop analysis (carried forward)")
+    dropped = set(carried)
+    if recheck is None or recheck:
+        to, bad, results = epochdrop(mo, to, tc, nproc=nproc, only=recheck)
+        dropped |= bad
+    else:
+        write_excise_tim(mo, to, tc)
+    save_state(
+        state_path,
+        {
+            "pout": pouts,
+            "epochs": {
+                name: {"dmx": window, "dropped": name in dropped}
+                for name, window in windows.items()
+            },
+        },
+    )
+    print(f"State saved to {state_path}.")
+    return to, tc, mo
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Outlier analysis that carries forward pout and epoch-drop results, keeping new results only for new TOAs and epochs."
+    )
+    parser.add_argument(
+        "-c", "--config", required=True, help="Pulsar config (.yaml) file."
+    )
+    parser.add_argument(
+        "-p", "--par_directory", default=None, help=".par file location."
+    )
+    parser.add_argument(
+        "-t", "--tim_directory", default=None, help=".tim file location."
+    )
+    parser.add_argument(
+        "-j", "--nproc", type=int, default=1, help="Number of parallel processes."
+    )
+    parser.add_argument(
+        "--state",
+        default=None,
+        help="State of the last run (default: outlier/<source>.nb/outliers.json).",
+    )
+    args = parser.parse_args()
+
+    run_incremental_outlier_analysis(
+        args.config,
+        par_directory=args.par_directory,
+        tim_directory=args.tim_directory,
+        nproc=args.nproc,
+        state_path=args.state,
+    )
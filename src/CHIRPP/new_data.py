@@ -6,6 +6,8 @@ import os
 import numpy as np
 from datetime import datetime
 from CHIRPP_utils import *
+from retention import manage_intermediates, parse_keep
+from tim import copy_toas
 
 
 current_dir = subprocess.check_output("pwd", shell=True, text=True).strip("\n")
@@ -41,6 +43,17 @@ parser.add_argument(
 parser.add_argument(
     "-p", "--template", type=str, help="Path to this pulsar's standard template."
 )
+parser.add_argument(
+    "--template_state",
+    type=str,
+    help="Path to the template_state.npz from this pulsar's native template build. New high-S/N profiles are folded into it, updating it in place, and the template is re-smoothed once its S/N has grown enough. The re-smoothed template is only written out: these TOAs still use the configured template, and switching to it needs a full re-time.",
+)
+parser.add_argument(
+    "--template_min_snr",
+    type=float,
+    default=20.0,
+    help="Minimum S/N of new profiles added to the template with --template_state (20 by default).",
+)
 parser.add_argument(
     "-l",
     "--paramlist",
@@ -169,6 +182,19 @@ if skipnum == -1:
     )
 
 processingjob_base = sbatch_cmd(None, email, mem="12G")
+keep_intermediates = parse_keep(get_config_value("keep_intermediates"))
+disk_budget = get_config_value("disk_budget")
+compress_level = int(get_config_value("compress_level") or 0)
+if get_config_value("toa_engine") in UNCHECKED_TOA_ENGINES:
+    print(
+        f"error: {UNCHECKED_TOA_ENGINES[get_config_value('toa_engine')]} has not yet been checked against pat on CHIME data; set toa_engine to pat or pat_sharded in config.sh."
+    )
+    exit(1)
+if compress_level > 0 and get_config_value("scrunch_engine") != "native":
+    print(
+        "error: compressed .bmwt.clfd files can only be read by the native scrunch engine (scrunch_engine=\"native\" in config.sh)."
+    )
+    exit(1)
 
 if skipnum < 1:
     exp_ephemNconvert = [
@@ -184,6 +210,12 @@ if skipnum < 1:
     )
 
 if skipnum < 2:
+    manage_intermediates(
+        "clean5G",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     exp_clean5G = [
         "Zap known bad channels.",
         "Adjust tjob with --tjob_clean5G",
@@ -197,6 +229,12 @@ if skipnum < 2:
     check_num_files(".ar", ".zap", logfile=outfile_clean5G)
 
 if skipnum < 3:
+    manage_intermediates(
+        "clean",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     exp_clean = [
         "Run clfd.",
         "Adjust tjob with --tjob_clean",
@@ -209,6 +247,12 @@ if skipnum < 3:
     check_num_files(".zap", ".zap.clfd", logfile=outfile_clean)
 
 if skipnum < 4:
+    manage_intermediates(
+        "beamWeight",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     exp_beamWeight = [
         "Run beam weighting.",
         "Adjust tjob with --tjob_beamweight",
@@ -227,6 +271,12 @@ if skipnum < 4:
     )
 
 if skipnum < 5:
+    manage_intermediates(
+        "scrunch",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     write_scrunch(force_overwrite=args.force_overwrite)
     outfile_scrunch = processing_scrunch(
         f"{processingjob_base} -J scrunch_{args.pulsar} ",
@@ -236,6 +286,47 @@ if skipnum < 5:
     )
     check_num_files(".bmwt.clfd", ".ftp", logfile=outfile_scrunch)
 
+if args.template_state:
+    # Fold the new profiles into the running template, aligning only them
+    from template import (
+        load_profiles,
+        load_state,
+        save_state,
+        smoothing_due,
+        update_template,
+        write_template,
+    )
+
+    state = load_state(args.template_state)
+    files = sorted(glob(f"*{get_config_value('template_ext')}"))
+    names, profiles = load_profiles(files, len(state["total"]))
+    added = update_template(state, profiles, names, min_snr=args.template_min_snr)
+    print(
+        f"\nAdded {len(added)} new profiles with S/N >= {args.template_min_snr} to the template."
+    )
+    if len(added) > 0 and smoothing_due(state):
+        print(
+            "The template S/N has grown enough since it was last smoothed; re-smoothing.\n"
+        )
+        write_template(state["total"] / state["weight"], added[-1], "added.trimmed")
+        if get_config_value("smooth_engine") == "native":
+            from smooth import smooth_file
+
+            smooth_file("added.trimmed")
+        else:
+            my_cmd("psrsmooth -W added.trimmed", "Smooth the updated template.")
+        template_base = f"{args.pulsar}.Rcvr_CHIME.CHIME.{today}.sum"
+        my_cmd(f"mv added.trimmed {template_base}", "")
+        my_cmd(f"mv added.trimmed.sm {template_base}.sm", "")
+        # The old TOAs were measured with the current template, so the new
+        # ones are too; switching only at a full re-time keeps the .tim
+        # free of a template offset
+        print(
+            f"The updated template is {template_base}.sm. It is not used for these TOAs: to switch to it, set template={template_base}.sm in config.sh and re-time all of this pulsar's files with new_pulsar.py --skip tim.\n"
+        )
+        state["snr2_smoothed"] = state["snr2"]
+    save_state(args.template_state, **state)
+
 exp_timcreation = [
     "TOA generation using new data",
     "Adjust tjob with --tjob_tim",
@@ -256,28 +347,25 @@ cmd_newtim = sbatch_cmd(
 )
 outfile_newtim = my_cmd(cmd_newtim, exp_newtim, checkcomplete=outfile_newtim)
 
-timrun_sh = open("tim_run.sh", "r")
-trr = timrun_sh.read()
-timrun_sh.close()
-newtimfile = [x.split(">")[-1].strip() for x in trr.split("\n") if len(x) > 0][-1]
+newtimfile = tim_run_output()
 if not os.path.exists(newtimfile):
-    print(f"error: could not find tim file {newtimfile}!")
+    print(
+        f"error: could not find tim file {newtimfile}! See log file: {outfile_newtim}"
+    )
     exit(1)
 
-# Rename TOAs with lowercase "chime_" so tempo2 doesn't think every line is a comment
-newtim = open(newtimfile, "r")
-tfr = newtim.read()
-newtim.close()
-lines = tfr.split("\n")
-newlines = [
-    f"chime{x.lstrip('CHIME')}\n" if x.startswith("CHIME") else "" for x in lines
-]
-
 newnewtimfile = f"{args.pulsar}.Rcvr_CHIME.CHIME.{today}.newtoas-all.nb.tim"
-my_cmd(f"cp {args.tim} {newnewtimfile}", "")
+if get_config_value("toa_cache") == "true":
+    # Merge in MJD order, leaving out files that already have TOAs in the old .tim
+    from toa_cache import merge_tim_files
+
+    print(f"Merging new TOAs with {args.tim} into {newnewtimfile}.\n")
+    with open(newnewtimfile, "w") as out:
+        merge_tim_files([args.tim, newtimfile], out)
+else:
+    my_cmd(f"cp {args.tim} {newnewtimfile}", "")
 
-newtim = open(newnewtimfile, "a")
-print(f"Writing new TOAs to {newnewtimfile}.\n")
-for newline in newlines:
-    newtim.write(newline)
-newtim.close()
+    # Rename TOAs with lowercase "chime_" so tempo2 doesn't think every line is a comment
+    print(f"Writing new TOAs to {newnewtimfile}.\n")
+    with open(newnewtimfile, "a") as out:
+        copy_toas(newtimfile, out)
@@ -8,6 +8,7 @@ import astropy.units as u
 from glob import glob
 from time import sleep
 from CHIRPP_utils import *
+from retention import manage_intermediates, parse_keep
 
 
 current_dir = subprocess.check_output("pwd", shell=True, text=True).strip("\n")
@@ -150,6 +151,80 @@ parser.add_argument(
     default=None,
     help="Maximum number of subbands to scrunch to (64 by default).",
 )
+parser.add_argument(
+    "--toa_engine",
+    choices=["pat", "pat_sharded"],
+    default=None,
+    help="Generate TOAs with pat, or with pat on parallel shards of the files ('pat' by default). CHIRPP's own TOA engines (toas.py, xspec.py and wideband.py) are not offered until toas.py --check_pat agrees with pat on CHIME data.",
+)
+parser.add_argument(
+    "--toa_cache",
+    action="store_true",
+    help="Cache TOAs per file (keyed by file and template contents) so that re-runs only time new or changed files.",
+)
+parser.add_argument(
+    "--template_engine",
+    choices=["autotoa", "native"],
+    default=None,
+    help="Align and add the template with autotoa or CHIRPP's template.py ('autotoa' by default).",
+)
+parser.add_argument(
+    "--smooth_engine",
+    choices=["psrsmooth", "native"],
+    default=None,
+    help="Smooth the template with psrsmooth -W or CHIRPP's wavelet smooth.py ('psrsmooth' by default).",
+)
+parser.add_argument(
+    "--template_select",
+    choices=["psrstat", "native"],
+    default=None,
+    help="Rank files for the template with psrstat or CHIRPP's parallel, cached template_select.py ('psrstat' by default).",
+)
+parser.add_argument(
+    "--scrunch_engine",
+    choices=["pam", "native"],
+    default=None,
+    help="Scrunch with PSRCHIVE's pam or CHIRPP's in-process scrunch.py ('pam' by default).",
+)
+parser.add_argument(
+    "--scrunch_levels",
+    action="store_true",
+    help="With the native scrunch engine, also write every power-of-two subband count down to --min_nchan, so that retrying with fewer subbands does not re-scrunch.",
+)
+parser.add_argument(
+    "--predict_nchan",
+    action="store_true",
+    help="Choose the number of subbands from each file's S/N before the first TOA generation, instead of only by trial.",
+)
+parser.add_argument(
+    "--adaptive_nchan",
+    action="store_true",
+    help="Choose a power-of-two number of subbands for each observation from its own S/N (requires the native scrunch engine).",
+)
+parser.add_argument(
+    "--rm_intermediates",
+    action="store_true",
+    help="Remove .zap and .zap.clfd files once every stage that reads them has succeeded.",
+)
+parser.add_argument(
+    "--disk_budget",
+    type=str,
+    default=None,
+    help="Disk budget for intermediate products, e.g. 500G. If a stage's output would not fit, .bmwt.clfd files are compressed first (with --compress_level), and the pipeline stops if it still does not fit.",
+)
+parser.add_argument(
+    "--stage_files",
+    action="store_true",
+    help="Run per-file steps through node-local disk ($SLURM_TMPDIR), with read-ahead and bulk write-back.",
+)
+parser.add_argument(
+    "--compress_level",
+    type=int,
+    default=None,
+    choices=range(0, 10),
+    metavar="{0..9}",
+    help="Store .bmwt.clfd files compressed at this zlib level, 0 for uncompressed (requires the native scrunch engine; 0 by default).",
+)
 parser.add_argument(
     "-f",
     "--force_proceed",
@@ -518,6 +593,19 @@ param_names = [
     "dm",
     "max_subint",
     "nsubbands",
+    "toa_engine",
+    "toa_cache",
+    "template_engine",
+    "smooth_engine",
+    "template_select",
+    "scrunch_engine",
+    "min_nchan",
+    "scrunch_levels",
+    "nchan_manifest",
+    "keep_intermediates",
+    "disk_budget",
+    "compress_level",
+    "stage_files",
 ]
 param_values = [
     args.data_directory,
@@ -528,9 +616,38 @@ param_values = [
     dm,
     max_subint,
     args.max_nchan,
+    args.toa_engine,
+    "true" if args.toa_cache else None,
+    args.template_engine,
+    args.smooth_engine,
+    args.template_select,
+    args.scrunch_engine,
+    args.min_nchan,
+    "true" if args.scrunch_levels else None,
+    "nchan_manifest.txt" if args.adaptive_nchan else None,
+    ".ar .bmwt.clfd .ftp" if args.rm_intermediates else None,
+    args.disk_budget,
+    args.compress_level,
+    "true" if args.stage_files else None,
 ]
 config_dict = dict(zip(param_names, param_values))
 edit_lines("config.sh", config_dict)
+keep_intermediates = parse_keep(get_config_value("keep_intermediates"))
+disk_budget = get_config_value("disk_budget")
+compress_level = int(get_config_value("compress_level") or 0)
+if get_config_value("toa_engine") in UNCHECKED_TOA_ENGINES:
+    print(
+        f"error: {UNCHECKED_TOA_ENGINES[get_config_value('toa_engine')]} has not yet been checked against pat on CHIME data; use --toa_engine pat or pat_sharded."
+    )
+    exit(1)
+if (
+    compress_level > 0
+    and get_config_value("scrunch_engine") != "native"
+):
+    print(
+        "error: compressed .bmwt.clfd files can only be read by the native scrunch engine (--scrunch_engine native)."
+    )
+    exit(1)
 
 if skipnum < 7:
     exp_processing_creation = (
@@ -556,6 +673,12 @@ if skipnum < 3:
     )
 
 if skipnum < 4:
+    manage_intermediates(
+        "clean5G",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     exp_clean5G = [
         "Zap known bad channels on all archive files (*.ar).",
         "Adjust tjob with --tjob_clean5G",
@@ -570,6 +693,12 @@ if skipnum < 4:
     )
 
 if skipnum < 5:
+    manage_intermediates(
+        "clean",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     exp_clean = [
         "Run clfd.",
         "Adjust tjob with --tjob_clean",
@@ -583,6 +712,12 @@ if skipnum < 5:
     )
 
 if skipnum < 6:
+    manage_intermediates(
+        "beamWeight",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     exp_beamWeight = [
         "Run beam weighting.",
         "Adjust tjob with --tjob_beamweight",
@@ -603,17 +738,32 @@ if skipnum < 6:
         "\nBefore we scrunch the data, view some diagnostic plots in another window as a sanity check.\n"
     )
     print("Recommended: use these commands to inspect sets of six random plots:\n")
-    print('pav -N 3,2 -dGTp $(find . -name "*.bmwt.clfd" | shuf | head -n 6)')
+    if compress_level > 0:
+        # PSRCHIVE cannot read the compressed files, so pav gets restored copies
+        print(
+            "The .bmwt.clfd files are compressed (compress_level in config.sh), which pav cannot read; restore copies of six of them first:\n"
+        )
+        print(
+            'check=$(mktemp -d) && cp $(find . -name "*.bmwt.clfd" | shuf | head -n 6) $check && compress.py -d $check/*.bmwt.clfd\n'
+        )
+        print("pav -N 3,2 -dGTp $check/*.bmwt.clfd")
+    else:
+        print('pav -N 3,2 -dGTp $(find . -name "*.bmwt.clfd" | shuf | head -n 6)')
     print(
         "-dGTp:  Time/polarization-scrunched, dedispersed, frequency vs. phase plot.\n"
     )
-    print('pav -N 3,2 -dYFp $(find . -name "*.bmwt.clfd" | shuf | head -n 6)')
+    if compress_level > 0:
+        print("pav -N 3,2 -dYFp $check/*.bmwt.clfd")
+    else:
+        print('pav -N 3,2 -dYFp $(find . -name "*.bmwt.clfd" | shuf | head -n 6)')
     print(
         "-dYFp:  Frequency/polarization-scrunched, dedispersed, integration time vs. phase plot."
     )
     print(
         "To collect more sets of six plots to view in sequence, use head -n 12 or higher."
     )
+    if compress_level > 0:
+        print("Remove the restored copies afterwards with: rm -r $check")
     print(
         "If the pulsar signal is difficult to see, try scrunching by a few times in time (e.g. -t 4), frequency (-f 4), or phase bins (-b 4).\n"
     )
@@ -624,7 +774,29 @@ if skipnum < 6:
             "If you don't notice any drifting in pulse phase in both sets of plots, press Enter to continue...\n"
         )
 
+if skipnum < 7 and args.adaptive_nchan:
+    if get_config_value("scrunch_engine") != "native":
+        print(
+            "error: --adaptive_nchan requires the native scrunch engine (--scrunch_engine native)."
+        )
+        exit(1)
+    exp_manifest = [
+        "Choose the number of subbands for each observation from its S/N.",
+        "The scrunch step reads them from nchan_manifest.txt.",
+    ]
+    cmd_manifest = (
+        f"find_nchan.py -e .bmwt.clfd -n {get_config_value('nsubbands')} -m {args.min_nchan} "
+        + f"--max_subint {get_config_value('max_subint')} --manifest {get_config_value('nchan_manifest')} -j {args.max_cpus}"
+    )
+    my_cmd(cmd_manifest, exp_manifest)
+
 if skipnum < 7:
+    manage_intermediates(
+        "scrunch",
+        keep=keep_intermediates,
+        budget=disk_budget,
+        compress_level=compress_level,
+    )
     outfile_scrunch = processing_scrunch(
         paralleljob_base, args.tjob_scrunch, args.pulsar
     )
@@ -639,6 +811,7 @@ if skipnum < 8:
         args.pulsar,
         force_proceed=args.force_proceed,
         force_overwrite=args.force_overwrite,
+        ncpus=args.max_cpus,
     )
 else:
     # Get the template filename from config.sh if skipping template creation
@@ -661,6 +834,31 @@ else:
         )
         exit(1)
 
+if skipnum < 9 and args.predict_nchan and not args.adaptive_nchan:
+    # Choose nsubbands from each file's fully scrunched S/N before running pat
+    from snr import measure_files
+
+    scrunch_nchan = get_scrunch_nchan()
+    max_subint_config = float(get_config_value("max_subint"))
+    files = sorted(glob(f"*{get_config_value('template_ext')}"))
+    stats = list(measure_files(files, nproc=args.max_cpus).values())
+    if len(stats) == 0:
+        print("error: no readable scrunched files to measure S/N from!")
+        exit(1)
+    plan_nchan, predictions = predict_nchan(
+        [x["snr"] for x in stats],
+        [x["length"] for x in stats],
+        min_nchan=args.min_nchan,
+        max_nchan=scrunch_nchan,
+        max_subint=max_subint_config,
+    )
+    print("\nPredicted 25th-percentile TOA S/N by number of subbands:")
+    for nchan, snr_pct in predictions.items():
+        print(f"    {nchan:5d}: {snr_pct:.2f}")
+    print(f"Planned number of subbands: {plan_nchan}\n")
+    if plan_nchan < scrunch_nchan:
+        set_nsubbands(plan_nchan, paralleljob_base, args.tjob_scrunch, args.pulsar)
+
 if skipnum < 9:
     ntry = 1
     timfile, outfile_timrun, tim_nchan, snr_25pct, snr_mean, scrunch_factor, ntoas = (
@@ -670,12 +868,16 @@ if skipnum < 9:
             args.pulsar,
             ntry,
             force_overwrite=args.force_overwrite,
+            ncpus=args.max_cpus,
         )
     )
     # Check if our S/N cut requires we scrunch further in frequency
     new_nchan = get_nchan(
         scrunch_factor, min_nchan=args.min_nchan, nchan_initial=tim_nchan
     )
+    if args.adaptive_nchan:
+        # Each observation already has its own number of subbands
+        new_nchan = tim_nchan
     while new_nchan < tim_nchan:
         print(f"\nToo many low-S/N TOAs: 25th-percentile S/N is {snr_25pct:.2f}")
         print(
@@ -692,31 +894,7 @@ if skipnum < 9:
 
         ntry += 1
 
-        scrunch_dict = dict([("nsubbands", new_nchan)])
-        edit_lines("config.sh", scrunch_dict)
-
-        # Edit scrunch.txt to use new nchan
-        fname = "scrunch.txt"
-        f = open(fname, "r")
-        fr = f.read()
-        f.close()
-        fname_new = f"scrunch_new.txt"
-        fnew = open(fname_new, "w")  # Temporary version of file to be edited
-        for line in [x for x in fr.split("\n") if len(x) > 0]:
-            left = line.split("--setnchn")[0]
-            right = line.split("-e")[1]
-            newline = f"{left}--setnchn {new_nchan} -e{right}\n"
-            fnew.write(newline)
-        fnew.close()
-        # Replace file with edited version
-        a = subprocess.run(f"mv {fname_new} {fname}", shell=True)
-
-        print("config.sh and scrunch.txt edited to reflect new # of subbands.\n")
-
-        # Run scrunch again, scrunching further in frequency this time.
-        outfile_scrunch = processing_scrunch(
-            paralleljob_base, args.tjob_scrunch, args.pulsar
-        )
+        set_nsubbands(new_nchan, paralleljob_base, args.tjob_scrunch, args.pulsar)
         (
             timfile,
             outfile_timrun,
@@ -731,6 +909,7 @@ if skipnum < 9:
             args.pulsar,
             ntry,
             force_overwrite=args.force_overwrite,
+            ncpus=args.max_cpus,
         )
     print(f"\n25th-percentile S/N: {snr_25pct:.2f}")
     print(f"Mean S/N: {snr_mean:.2f}")
@@ -761,6 +940,13 @@ else:
         ntoas = None
 
 
+manage_intermediates(
+    "complete",
+    keep=keep_intermediates,
+    budget=disk_budget,
+    compress_level=compress_level,
+)
+
 print(
     "\n####################################################################################################\n"
 )
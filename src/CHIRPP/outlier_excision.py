@@ -1,18 +1,18 @@
 #!/usr/bin/env python
 
-from pint_pal.lite_utils import *
 # from pint_pal.noise_utils import *
-from pint_pal.par_checker import *
-from pint_pal.utils import *
-from pint_pal.dmx_utils import *
-from pint_pal.timingconfiguration import TimingConfiguration
-from pint_pal.outlier_utils import *
 # from pint_pal.utils import apply_cut_flag, apply_cut_select
-from pint_pal.plot_utils import plot_residuals_time
 # from pint.utils import dmxparse
+# Only what the analysis needs is imported, when it runs; plotting modules are
+# imported by the interactive session below, or by outlier_report.py's workers
 import argparse
 
-def run_outlier_analysis(config, par_directory=None, tim_directory=None, epochdrop_threads=1, load_pout=None):
+def run_outlier_analysis(config, par_directory=None, tim_directory=None, epochdrop_threads=1, load_pout=None, downdate=False):
+    from pint_pal.dmx_utils import setup_dmx
+    from pint_pal.outlier_utils import calculate_pout, epochalyptica, make_pout_cuts
+    from pint_pal.timingconfiguration import TimingConfiguration
+    from epochdrop import epochdrop
+
     tc = TimingConfiguration(config, par_directory=par_directory, tim_directory=tim_directory)
     using_wideband = tc.get_toa_type() == 'WB'
     if not load_pout: # load raw tims unless otherwise noted
@@ -30,7 +30,10 @@ def run_outlier_analysis(config, par_directory=None, tim_directory=None, epochdr
             calculate_pout(mo, to, tc)       
         make_pout_cuts(mo, to, tc, outpct_threshold=8.0)
 
-    epochalyptica(mo,to,tc,nproc=epochdrop_threads)
+    if downdate and not using_wideband: # see epochdrop.py
+        epochdrop(mo,to,tc,nproc=epochdrop_threads)
+    else:
+        epochalyptica(mo,to,tc,nproc=epochdrop_threads)
     return to, tc, mo
 
 if __name__ == "__main__":
@@ -73,6 +76,20 @@ if __name__ == "__main__":
         default=None,
         help=".tim file with pout values already assigned (i.e. if restarting outlier analyses midway through)",
     )
+    parser.add_argument(
+        "-d",
+        "--downdate",
+        action="store_true",
+        default=False,
+        help="Run the epoch-drop test by downdating one linearized fit in shared memory (epochdrop.py), with a checkpoint to resume from, instead of refitting per epoch (narrowband only).",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="With -r, carry forward pout and epoch-drop results from the last run, and only test new epochs (see incremental_outliers.py). The outlier model is still run on all TOAs if any are new, keeping the new TOAs' pout.",
+    )
     parser.add_argument(
         "-r",
         "--run_analysis",
@@ -93,11 +110,52 @@ if __name__ == "__main__":
         default=False,
         help="Analyze post-fit residuals.",
     )
+    parser.add_argument(
+        "--report",
+        type=str,
+        default=None,
+        help="Write all diagnostics to image files in this directory, with an index.html, instead of showing them (see outlier_report.py).",
+    )
+    parser.add_argument(
+        "--archive_dir",
+        type=str,
+        default=".",
+        help="With --report, directory of the archives of auto-excised TOAs.",
+    )
+    parser.add_argument(
+        "-j",
+        "--report_threads",
+        type=int,
+        default=1,
+        help="With --report, number of parallel processes rendering figures.",
+    )
     
     args = parser.parse_args()
-    if args.run_analysis:
-        to, tc, mo = run_outlier_analysis(args.config, args.par_directory, args.tim_directory, args.epochdrop_threads, args.pout)
-    if not args.autorun:
+    if args.autorun or args.report:
+        # Headless: pint_pal's outlier_utils still imports matplotlib
+        import matplotlib
+        matplotlib.use("Agg")
+    if args.report and not args.run_analysis:
+        print("error: --report needs -r, to have TOAs with -cut flags (or use outlier_report.py).")
+        exit(1)
+    if args.run_analysis and args.incremental:
+        from incremental_outliers import run_incremental_outlier_analysis
+        to, tc, mo = run_incremental_outlier_analysis(args.config, args.par_directory, args.tim_directory, args.epochdrop_threads)
+    elif args.run_analysis:
+        to, tc, mo = run_outlier_analysis(args.config, args.par_directory, args.tim_directory, args.epochdrop_threads, args.pout, args.downdate)
+    if args.report:
+        from pint_pal.dmx_utils import setup_dmx
+        from outlier_report import write_report
+        tc.manual_cuts(to)
+        to = setup_dmx(mo,to,frequency_ratio=tc.get_fratio(),max_delta_t=tc.get_sw_delay())
+        write_report(to, mo, tc, args.report, archive_dir=args.archive_dir, nproc=args.report_threads, postfit=args.analyze_postfit)
+    elif not args.autorun:
+        from pint_pal.lite_utils import *
+        from pint_pal.par_checker import *
+        from pint_pal.utils import *
+        from pint_pal.dmx_utils import *
+        from pint_pal.outlier_utils import *
+        from pint_pal.plot_utils import plot_residuals_time
         file_matches, toa_matches = tc.get_investigation_files()
         # Quick breakdown of existing cut flags (automated excision)
         cuts_dict = cut_summary(to,tc)
@@ -110,7 +168,6 @@ if __name__ == "__main__":
         plot_cuts_all_backends(to, save=True)
         
         # Plot residuals vs. time after auto/manual cuts
-        from pint_pal.plot_utils import plot_residuals_time
         fo = tc.construct_fitter(to,mo)
         plot_residuals_time(fo, restype='prefit')
         
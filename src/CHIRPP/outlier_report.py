@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                   Headless outlier analysis report                  ##
+#########################################################################
+
+Renders the diagnostics outlier_excision.py shows interactively to image
+files, and links them from <report>/index.html:
+    - pre-fit residuals (and post-fit ones, with --analyze_postfit), the
+      residuals with automated and manual cuts highlighted, the summary of
+      cuts and the cuts of each backend in the frequency-time plane, drawn
+      with pint_pal's plotting functions;
+    - for every epoch with auto-excised TOAs (outlier*, maxout, epochdrop):
+      its frequency vs. phase image (GTpd), and for every such TOA, its
+      profile next to the epoch's scrunched profile. These are read with
+      psrfits.py from the archives named by the TOAs' -name flags, looked
+      for in --archive_dir, and dedispersed if they are not already.
+Figures are rendered by a pool of worker processes with matplotlib's Agg
+backend, one task per pint_pal figure or epoch. Workers are forked, so the
+TOAs and model are shared with them rather than pickled. matplotlib and
+pint_pal's plotting modules are only imported by the workers.
+
+Run from the command line with:
+python outlier_excision.py -c J0000+0000.yaml -r -d -n 8 --report report/ --archive_dir ../data
+python outlier_report.py -c J0000+0000.yaml --report report/ --archive_dir ../data -j 8  # From the excised .tim
+"""
+
+import argparse
+import html
+import multiprocessing
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from psrfits import open_archive
+from scrunch import dispersion_turns, rotate
+from snr import pscrunch
+
+# Cut flags given by the automated excision
+AUTO_CUTS = ["maxout", "epochdrop"]
+# Cut flags given by manual excision
+MANUAL_CUTS = ["badtoa", "badfile", "badrange"]
+SECTIONS = ["Residuals", "Cuts", "Auto-excised epochs"]
+
+# (toas, model, tc, report directory, archive directory), set before forking
+_report = None
+
+
+def is_auto_cut(cut):
+    return cut is not None and (cut.startswith("outlier") or cut in AUTO_CUTS)
+
+
+def auto_cut_epochs(toas):
+    """{epoch: [(cut, subint, chan), ...]} of the auto-excised TOAs."""
+    epochs = {}
+    for f in toas.orig_table["flags"]:
+        if is_auto_cut(f.get("cut")):
+            epochs.setdefault(f["name"], []).append(
+                (f["cut"], int(f.get("subint", 0)), int(f.get("chan", 0)))
+            )
+    return epochs
+
+
+def find_archive(name, archive_dir):
+    """Path of the archive of a TOA's -name (CHIME... if renamed to chime...)."""
+    names = [name, f"CHIME{name[5:]}"] if name.startswith("chime") else [name]
+    for candidate in names:
+        path = os.path.join(archive_dir, os.path.basename(candidate))
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _pyplot():
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    return plt
+
+
+def _save_open_figures(plt, stem):
+    """Save every open figure as <stem>_<n>.png and close them."""
+    outdir = _report[3]
+    saved = []
+    for i, num in enumerate(plt.get_fignums()):
+        fname = f"{stem}_{i}.png"
+        plt.figure(num).savefig(os.path.join(outdir, fname), dpi=100)
+        saved.append(fname)
+    plt.close("all")
+    return saved
+
+
+def dedispersed_cube(ar):
+    """Total-intensity (nsub, nchan, nbin) data of ar, dedispersed, and its weights."""
+    cube = pscrunch(
+        np.asarray(ar.data, dtype=np.float64),
+        ar.subint.header.get("POL_TYPE", "AA+BB"),
+    )
+    if not ar.dedispersed:
+        turns = dispersion_turns(
+            ar.freqs, float(ar.primary["OBSFREQ"]), ar.dm, ar.periods[:, None]
+        )
+        cube = rotate(cube, turns)
+    return cube, ar.weights
+
+
+def epoch_figures(name, toas_cut, fname):
+    """GTpd image of an epoch, and the profile of each of its cut TOAs."""
+    plt = _pyplot()
+    stem = name.replace("/", "_")
+    with open_archive(fname) as ar:
+        cube, weights = dedispersed_cube(ar)
+        freqs = ar.freqs[0]
+    wsum = weights.sum()
+    scrunched = (cube * weights[..., None]).sum(axis=(0, 1)) / max(wsum, 1e-30)
+    tsum = weights.sum(axis=0)
+    gtpd = (cube * weights[..., None]).sum(axis=0)
+    gtpd /= np.where(tsum > 0, tsum, 1)[:, None]
+    phase = (np.arange(cube.shape[-1]) + 0.5) / cube.shape[-1]
+
+    fig, ax = plt.subplots(figsize=(7, 6))
+    ax.imshow(
+        gtpd,
+        aspect="auto",
+        origin="lower",
+        # Channels in file order, which may be descending in frequency
+        extent=[0, 1, freqs[0], freqs[-1]],
+        interpolation="nearest",
+    )
+    ax.set_xlabel("Phase")
+    ax.set_ylabel("Frequency (MHz)")
+    ax.set_title(f"{name} (GTpd)")
+    figures = [(f"{name}: frequency vs. phase", f"GTpd_{stem}.png")]
+    fig.savefig(os.path.join(_report[3], figures[0][1]), dpi=100)
+    plt.close(fig)
+
+    for cut, isub, ichan in sorted(toas_cut, key=lambda x: (x[1], x[2])):
+        if isub >= cube.shape[0] or ichan >= cube.shape[1]:
+            continue
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
+        ax1.plot(phase, cube[isub, ichan], color="k", lw=0.8)
+        ax1.set_title(f"subint {isub}, chan {ichan} (cut: {cut})")
+        ax2.plot(phase, scrunched, color="k", lw=0.8)
+        ax2.set_title("Scrunched profile")
+        for ax in [ax1, ax2]:
+            ax.set_xlabel("Phase")
+        fig.suptitle(name)
+        out = f"profile_{stem}_{isub}_{ichan}.png"
+        fig.savefig(os.path.join(_report[3], out), dpi=100)
+        plt.close(fig)
+        figures.append((f"{name}: subint {isub}, chan {ichan} ({cut})", out))
+    return figures
+
+
+def pint_pal_figures(kind):
+    """One of the whole-dataset figures, drawn with pint_pal."""
+    plt = _pyplot()
+    toas, model, tc = _report[:3]
+    if kind in ["prefit", "postfit"]:
+        from pint_pal.plot_utils import plot_residuals_time
+
+        fo = tc.construct_fitter(toas, model)
+        if kind == "postfit":
+            fo.model.free_params = tc.get_free_params(fo)
+            fo.fit_toas(maxiter=tc.get_niter())
+            plot_residuals_time(fo, restype="postfit", whitened=True)
+        else:
+            plot_residuals_time(fo, restype="prefit")
+    elif kind == "highlight":
+        from pint_pal.lite_utils import highlight_cut_resids
+
+        cuts = sorted(
+            {f.get("cut") for f in toas.orig_table["flags"] if f.get("cut")}
+            | set(MANUAL_CUTS)
+        )
+        highlight_cut_resids(toas, model, tc, cuts=cuts, ylim_good=True, save=False)
+    elif kind == "summary":
+        from pint_pal.lite_utils import cut_summary
+
+        cut_summary(toas, tc)
+    elif kind == "backends":
+        from pint_pal.lite_utils import plot_cuts_all_backends
+
+        plot_cuts_all_backends(toas, using_wideband=tc.get_toa_type() == "WB")
+    titles = {
+        "prefit": "Pre-fit residuals",
+        "postfit": "Post-fit residuals (whitened)",
+        "highlight": "Residuals with cuts highlighted",
+        "summary": "Summary of cuts",
+        "backends": "Cuts per backend",
+    }
+    return [(titles[kind], f) for f in _save_open_figures(plt, kind)]
+
+
+def _render(job):
+    section, kind, args = job
+    try:
+        if kind == "epoch":
+            figures = epoch_figures(*args)
+        else:
+            figures = pint_pal_figures(kind)
+    except Exception as e:
+        what = args[0] if args else kind
+        return section, [(f"{what}: failed ({e})", None)]
+    return section, figures
+
+
+def write_index(outdir, title, sections):
+    lines = [
+        "<!DOCTYPE html>",
+        f"<html><head><meta charset='utf-8'><title>{html.escape(title)}</title></head>",
+        f"<body><h1>{html.escape(title)}</h1>",
+    ]
+    for section in SECTIONS:
+        if not sections.get(section):
+            continue
+        lines.append(f"<h2>{html.escape(section)}</h2>")
+        for caption, fname in sections[section]:
+            lines.append(f"<p>{html.escape(caption)}</p>")
+            if fname is not None:
+                src = html.escape(fname)
+                lines.append(f"<a href='{src}'><img src='{src}' width='800'></a>")
+    lines.append("</body></html>")
+    index = os.path.join(outdir, "index.html")
+    with open(index, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return index
+
+
+def write_report(toas, model, tc, outdir, archive_dir=".", nproc=1, postfit=False):
+    """Render the outlier diagnostics of toas into outdir; returns index.html."""
+    global _report
+    os.makedirs(outdir, exist_ok=True)
+    _report = (toas, model, tc, outdir, archive_dir)
+    kinds = ["prefit"] + (["postfit"] if postfit else [])
+    jobs = [("Residuals", kind, ()) for kind in kinds + ["highlight"]]
+    jobs += [("Cuts", kind, ()) for kind in ["summary", "backends"]]
+    sections = {}
+    for name, cut in sorted(auto_cut_epochs(toas).items()):
+        fname = find_archive(name, archive_dir)
+        if fname is None:
+            sections.setdefault("Auto-excised epochs", []).append(
+                (f"{name}: archive not found in {archive_dir}", None)
+            )
+        else:
+            jobs.append(("Auto-excised epochs", "epoch", (name, cut, fname)))
+
+    results = [None] * len(jobs)
+    if nproc > 1:
+        # Forked so the workers share _report
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=nproc, mp_context=context) as pool:
+            futures = {pool.submit(_render, job): i for i, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    else:
+        results = [_render(job) for job in jobs]
+    # In the order of the jobs, whichever worker finished first
+    for section, figures in results:
+        sections.setdefault(section, []).extend(figures)
+    nfig = sum(f is not None for figures in sections.values() for _, f in figures)
+    index = write_index(outdir, f"{tc.get_source()} outlier analysis", sections)
+    print(f"{nfig} figures written; see {index}.")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Render outlier analysis diagnostics of the excised TOAs to image files with an index.html."
+    )
+    parser.add_argument(
+        "-c", "--config", required=True, help="Pulsar config (.yaml) file."
+    )
+    parser.add_argument(
+        "-p", "--par_directory", default=None, help=".par file location."
+    )
+    parser.add_argument(
+        "--excised_tim",
+        default=None,
+        help=".tim with -cut flags (default: the config's excised-tim).",
+    )
+    parser.add_argument("--report", required=True, help="Directory to write to.")
+    parser.add_argument(
+        "--archive_dir", default=".", help="Directory of the TOAs' archives."
+    )
+    parser.add_argument(
+        "-j", "--nproc", type=int, default=1, help="Number of parallel processes."
+    )
+    parser.add_argument(
+        "--analyze_postfit",
+        action="store_true",
+        help="Also fit and plot post-fit residuals.",
+    )
+    args = parser.parse_args()
+
+    from pint_pal.timingconfiguration import TimingConfiguration
+
+    tc = TimingConfiguration(args.config, par_directory=args.par_directory)
+    if args.excised_tim is not None:
+        mo, to = tc.get_model_and_toas(pout_tim_path=args.excised_tim)
+    else:
+        mo, to = tc.get_model_and_toas(excised=True)
+    if to is None:
+        print("error: no excised .tim; give one with --excised_tim.")
+        exit(1)
+    write_report(
+        to,
+        mo,
+        tc,
+        args.report,
+        archive_dir=args.archive_dir,
+        nproc=args.nproc,
+        postfit=args.analyze_postfit,
+    )
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                   Sharded, parallel pat TOA generation              ##
+#########################################################################
+
+Equivalent to
+    pat -A FDM -e mcmc=0 -C chan -C subint -C snr -C wt -f tempo2 -X "$tim_flags" -s $template *.ftp
+followed by make_tim()'s renaming of "CHIME..." TOAs to "chime...", but with
+pat running on several shards of the files at once.
+
+The files are split into shards of about equal total size (largest files
+first, each to the currently lightest shard). Each shard's file list is given
+to pat with -M, so the number of files is never limited by the length of a
+command line. Each shard's TOAs are sorted by MJD as soon as pat finishes, and
+the shards are then merged into one .tim in MJD order (ties broken by
+frequency and line), renaming the TOAs in the same pass. The output does not
+depend on the number of shards or on which finishes first.
+
+Run from the command line with:
+python pat_shards.py -j 8 -e .ftp -X "-f CHIME -be CHIME -fe Rcvr_CHIME" -s template.sm > toas.tim
+"""
+
+import argparse
+import heapq
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from tim import chime_prefix, is_toa_line, toa_sort_key
+from toas import PAT_OPTIONS
+
+SHARD_DIR = "tim_shards"
+
+
+def balance_shards(files, nshards):
+    """Split files into at most nshards lists of about equal total size."""
+    nshards = max(1, min(nshards, len(files)))
+    sizes = sorted(((os.path.getsize(f), f) for f in files), reverse=True)
+    heap = [(0, i) for i in range(nshards)]
+    shards = [[] for _ in range(nshards)]
+    for size, fname in sizes:
+        load, i = heapq.heappop(heap)
+        shards[i].append(fname)
+        heapq.heappush(heap, (load + size, i))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def run_shard(job):
+    """Run pat on one shard; returns (sorted .tim of the shard, number of TOAs, error)."""
+    index, files, template, extra_flags, shard_dir = job
+    metafile = os.path.join(shard_dir, f"shard_{index}.txt")
+    timfile = os.path.join(shard_dir, f"shard_{index}.tim")
+    with open(metafile, "w") as f:
+        f.write("".join(f"{fname}\n" for fname in files))
+    command = ["pat", *PAT_OPTIONS.split(), "-s", template, "-M", metafile]
+    if extra_flags.strip():
+        command += ["-X", extra_flags]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        error = f"pat exited with {result.returncode}: {result.stderr.strip()}"
+        return timfile, 0, error
+    lines = sorted(
+        (line for line in result.stdout.splitlines() if is_toa_line(line)),
+        key=toa_sort_key,
+    )
+    with open(timfile, "w") as f:
+        f.write("".join(f"{line}\n" for line in lines))
+    return timfile, len(lines), None
+
+
+def merge_shards(timfiles, out=sys.stdout):
+    """
+    Merge MJD-sorted shard .tim files into out, renaming CHIME TOAs.
+    Returns the number of TOAs.
+    """
+    handles = [open(fname, "r") for fname in timfiles]
+    try:
+        streams = [(line.rstrip("\n") for line in f) for f in handles]
+        out.write("FORMAT 1\n")
+        ntoa = 0
+        for line in heapq.merge(*streams, key=toa_sort_key):
+            out.write(f"{chime_prefix(line)}\n")
+            ntoa += 1
+    finally:
+        for f in handles:
+            f.close()
+    return ntoa
+
+
+def sharded_pat(
+    files,
+    template,
+    nproc=1,
+    nshards=None,
+    extra_flags="",
+    shard_dir=SHARD_DIR,
+    out=sys.stdout,
+):
+    """
+    Run pat over files in nshards (nproc by default) size-balanced shards, nproc
+    at a time, and write the merged .tim to out. If any shard fails, nothing
+    is written, so a partial .tim is never mistaken for a complete one.
+    Returns (number of TOAs, list of errors of failed shards).
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = balance_shards(files, nshards or nproc)
+    jobs = [
+        (i, shard, template, extra_flags, shard_dir) for i, shard in enumerate(shards)
+    ]
+    # Each worker only waits on its pat process, so threads are enough
+    with ThreadPoolExecutor(max_workers=max(1, nproc)) as pool:
+        results = list(pool.map(run_shard, jobs))
+    errors = [f"{timfile}: {error}" for timfile, _, error in results if error]
+    if errors:
+        return 0, errors
+    ntoa = merge_shards([timfile for timfile, _, _ in results], out=out)
+    return ntoa, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run pat on size-balanced shards of the files in parallel and merge the TOAs in MJD order."
+    )
+    parser.add_argument(
+        "-d",
+        "--data_directory",
+        type=str,
+        default=".",
+        help="Directory of the files (the current directory by default).",
+    )
+    parser.add_argument(
+        "-e",
+        "--extension",
+        type=str,
+        default=".ftp",
+        help="Extension of the files to time ('.ftp' by default).",
+    )
+    parser.add_argument(
+        "-s", "--template", type=str, required=True, help="Standard template profile."
+    )
+    parser.add_argument(
+        "-X",
+        "--extra_flags",
+        type=str,
+        default="",
+        help="Flags appended to every TOA line, passed to pat -X.",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of pat processes to run at once (1 by default).",
+    )
+    parser.add_argument(
+        "--nshards",
+        type=int,
+        default=None,
+        help="Number of shards to split the files into (--nproc by default).",
+    )
+    parser.add_argument(
+        "--shard_dir",
+        type=str,
+        default=SHARD_DIR,
+        help=f"Directory for the shards' file lists and TOAs ('{SHARD_DIR}' by default).",
+    )
+    args = parser.parse_args()
+
+    # normpath drops a leading "./", so TOAs are named like pat's would be
+    files = sorted(
+        glob(os.path.normpath(os.path.join(args.data_directory, f"*{args.extension}")))
+    )
+    if len(files) == 0:
+        print(
+            f"error: no *{args.extension} files in {args.data_directory}!",
+            file=sys.stderr,
+        )
+        exit(1)
+    ntoa, errors = sharded_pat(
+        files,
+        args.template,
+        nproc=args.nproc,
+        nshards=args.nshards,
+        extra_flags=args.extra_flags,
+        shard_dir=args.shard_dir,
+    )
+    for error in errors:
+        print(f"error: {error}", file=sys.stderr)
+    if errors:
+        print("error: no TOAs written, as not every shard was timed.", file=sys.stderr)
+        exit(1)
+    print(f"{ntoa} TOAs from {len(files)} files.", file=sys.stderr)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                  Persistent cache of prepared TOAs                  ##
+#########################################################################
+
+Loading TOAs with PINT applies clock corrections and evaluates the ephemeris
+(TDBs, observatory positions) for every TOA, which dominates the run time of
+timing_fit.py for CHIME's TOA counts. Within cached_toas(), pint.toa.get_TOAs
+keeps the TOAs it prepares in <cache>/<key>.pickle.gz, where key hashes what
+the preparation depends on: the .tim file names, the ephemeris, clock and
+planet settings (including EPHEM, CLOCK and PLANET_SHAPIRO of the model; other
+.par values do not change the TOAs, so refining the .par still hits the cache)
+and the PINT version. Each cache also stores the size and SHA-1 of every .tim
+and a stamp of the observatory clock files it was corrected with. When the
+TOAs are loaded again:
+    - if the .tim files and clock files are unchanged, the cached TOAs are used;
+    - if TOAs were only appended to the .tim files (the old content is an
+      unchanged prefix, and the new lines are TOAs only), just the new TOAs are
+      prepared and merged into the cached ones;
+    - otherwise all TOAs are prepared again.
+
+Run from the command line with:
+python pint_cache.py J0000+0000.tim --cache .pint_cache  # Prepare (or update) the cache
+python pint_cache.py J0000+0000.tim --cache .pint_cache --par J0000+0000.par
+"""
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import os
+import pickle
+import tempfile
+import pint
+import pint.toa
+from pint.observatory import bipm_default, get_observatory
+from tim import is_toa_line
+
+PINT_CACHE_VERSION = 1
+# Model parameters that change how TOAs are prepared
+TOA_PARAMS = ["EPHEM", "CLOCK", "PLANET_SHAPIRO"]
+
+
+def file_sha1(fname, size=None):
+    """SHA-1 of the first size bytes of fname (all of it if size is None)."""
+    sha = hashlib.sha1()
+    with open(fname, "rb") as f:
+        remaining = size
+        while remaining is None or remaining > 0:
+            block = f.read(1 << 20 if remaining is None else min(1 << 20, remaining))
+            if not block:
+                break
+            sha.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return sha.hexdigest()
+
+
+def tim_state(fname):
+    return {"size": os.path.getsize(fname), "sha1": file_sha1(fname)}
+
+
+def cache_key(timfiles, settings):
+    text = repr(
+        (
+            PINT_CACHE_VERSION,
+            pint.__version__,
+            [os.path.abspath(f) for f in timfiles],
+            sorted(settings.items()),
+        )
+    )
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def clock_stamp(toas):
+    """
+    What the clock corrections of toas depend on: for each observatory, the
+    last MJD it can be corrected to and a hash of the clock files read for it.
+    """
+    include_bipm = toas.clock_corr_info.get("include_bipm", True)
+    bipm_version = toas.clock_corr_info.get("bipm_version", bipm_default)
+    stamp = {}
+    for name in sorted(toas.observatories):
+        try:
+            obs = get_observatory(name)
+            entry = [
+                obs.last_clock_correction_mjd(
+                    include_bipm=include_bipm, bipm_version=bipm_version
+                )
+            ]
+            if hasattr(obs, "_load_clock_corrections"):
+                obs._load_clock_corrections()
+                for clock in obs._clock or []:
+                    sha = hashlib.sha1(clock.time.mjd.tobytes())
+                    sha.update(clock.clock.value.tobytes())
+                    entry.append((str(clock.friendly_name), sha.hexdigest()))
+        except Exception as e:
+            # Same stamp as long as the same thing fails
+            entry = [f"unavailable: {type(e).__name__}"]
+        stamp[name] = entry
+    return stamp
+
+
+def load_settings(kwargs):
+    """The get_TOAs arguments (and model parameters) that change the TOAs."""
+    settings = {
+        key: kwargs.get(key)
+        for key in [
+            "ephem",
+            "include_bipm",
+            "bipm_version",
+            "planets",
+            "include_pn",
+            "tdb_method",
+            "limits",
+        ]
+    }
+    model = kwargs.get("model")
+    for param in TOA_PARAMS:
+        if model is not None and param in model:
+            settings[param] = str(model[param].value)
+    return settings
+
+
+def appended_lines(fname, old):
+    """
+    The lines appended to fname since it had state old, or None if it was
+    changed in any other way, or the new lines are not all TOAs or comments.
+    """
+    if os.path.getsize(fname) < old["size"]:
+        return None
+    if file_sha1(fname, old["size"]) != old["sha1"]:
+        return None
+    with open(fname, "rb") as f:
+        if old["size"] > 0:
+            # The old content must have ended a line
+            f.seek(old["size"] - 1)
+            if f.read(1) != b"\n":
+                return None
+        lines = f.read().decode().splitlines()
+    new = []
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped.startswith(("#", "C ")):
+            continue
+        # Commands (MODE, JUMP, INCLUDE, ...) would need the whole file
+        if stripped.split()[0] == "FORMAT" or not is_toa_line(stripped):
+            return None
+        new.append(line)
+    return new
+
+
+def read_cache(path):
+    try:
+        with gzip.open(path, "rb") as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+def write_cache(path, entry):
+    # Written under a temporary name, so a crash never leaves a partial cache
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with gzip.open(tmp, "wb") as f:
+        pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def prepare_appended(get_toas, lines, kwargs):
+    """Prepare TOAs from .tim lines with the same settings as the cached ones."""
+    fd, tmp = tempfile.mkstemp(suffix=".tim")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write("FORMAT 1\n")
+            f.writelines(f"{line}\n" for line in lines)
+        return get_toas(tmp, **kwargs)
+    finally:
+        os.remove(tmp)
+
+
+def cached_get_toas(get_toas, cache_dir, timfile, **kwargs):
+    """
+    get_toas(timfile, **kwargs), using and updating the cache in cache_dir.
+    Falls back to get_toas when the TOAs are not read from named files.
+    """
+    if kwargs.get("usepickle") or not (
+        isinstance(timfile, (str, os.PathLike))
+        or (
+            isinstance(timfile, (list, tuple))
+            and all(isinstance(f, (str, os.PathLike)) for f in timfile)
+        )
+    ):
+        return get_toas(timfile, **kwargs)
+    if isinstance(timfile, (list, tuple)):
+        timfiles = [os.fspath(f) for f in timfile]
+    else:
+        timfiles = [os.fspath(timfile)]
+    settings = load_settings(kwargs)
+    path = os.path.join(cache_dir, f"{cache_key(timfiles, settings)}.pickle.gz")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    entry = read_cache(path) if os.path.exists(path) else None
+    states = {f: tim_state(f) for f in timfiles}
+    if entry is not None and entry["clock"] == clock_stamp(entry["toas"]):
+        if entry["files"] == states:
+            print(f"Read {len(entry['toas'])} prepared TOAs from {path}.")
+            return entry["toas"]
+        new = [appended_lines(f, entry["files"][f]) for f in timfiles]
+        if all(lines is not None for lines in new):
+            new = [line for lines in new for line in lines]
+            toas = entry["toas"]
+            if new:
+                added = prepare_appended(get_toas, new, kwargs)
+                toas = pint.toa.merge_TOAs([toas, added])
+                # The merged TOAs are those of the .tim files, not the temporary one
+                toas.filename = timfiles if len(timfiles) > 1 else timfiles[0]
+                toas.table.meta["filename"] = toas.filename
+                toas.hashes = {f: states[f]["sha1"] for f in timfiles}
+            print(f"Prepared {len(new)} appended TOAs; {len(toas)} TOAs in total.")
+            write_cache(
+                path,
+                {"files": states, "clock": entry["clock"], "toas": toas},
+            )
+            return toas
+
+    toas = get_toas(timfile, **kwargs)
+    write_cache(
+        path,
+        {
+            "files": states,
+            "clock": clock_stamp(toas),
+            "toas": toas,
+        },
+    )
+    print(f"Prepared {len(toas)} TOAs, cached in {path}.")
+    return toas
+
+
+@contextlib.contextmanager
+def cached_toas(cache_dir, modules=()):
+    """
+    Within this context, pint.toa.get_TOAs (and the get_TOAs imported by any of
+    modules) uses the cache in cache_dir. Nothing is cached if cache_dir is None.
+    """
+    if cache_dir is None:
+        yield
+        return
+    get_toas = pint.toa.get_TOAs
+
+    def wrapped(timfile, *args, **kwargs):
+        if args:
+            return get_toas(timfile, *args, **kwargs)
+        return cached_get_toas(get_toas, cache_dir, timfile, **kwargs)
+
+    patched = [pint.toa]
+    patched += [m for m in modules if getattr(m, "get_TOAs", None) is get_toas]
+    for module in patched:
+        module.get_TOAs = wrapped
+    try:
+        yield
+    finally:
+        for module in patched:
+            module.get_TOAs = get_toas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Prepare TOAs with PINT and cache them for timing_fit.py."
+    )
+    parser.add_argument("tim", nargs="+", help=".tim file(s).")
+    parser.add_argument(
+        "--cache", required=True, help="Directory of the cached TOAs."
+    )
+    parser.add_argument(
+        "--par",
+        default=None,
+        help="Model whose EPHEM, CLOCK and PLANET_SHAPIRO are used to prepare the TOAs.",
+    )
+    parser.add_argument("--ephem", default=None, help="Solar system ephemeris.")
+    args = parser.parse_args()
+
+    model = None
+    if args.par is not None:
+        from pint.models import get_model
+
+        model = get_model(args.par)
+    with cached_toas(args.cache):
+        pint.toa.get_TOAs(
+            args.tim if len(args.tim) > 1 else args.tim[0],
+            model=model,
+            ephem=args.ephem,
+        )
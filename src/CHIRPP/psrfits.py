@@ -0,0 +1,563 @@
+#! /usr/bin/env python
+
+"""
+Memory-mapped access to fold-mode PSRFITS archives.
+
+The SUBINT DATA column is exposed as a (nsub, npol, nchan, nbin) cube without
+reading the file into memory. Scaling by DAT_SCL/DAT_OFFS is only applied to
+the subints that are actually indexed, so per-subint loops over multi-GB
+archives stay bounded in memory. Reduced cubes (e.g. after scrunching) and new
+weights can be written back without going through PSRCHIVE.
+
+Archives can also be stored compressed: the DATA column becomes a variable-length
+column holding one zlib-compressed (byte-shuffled) chunk per subint, with every
+other column and HDU unchanged. Archive decompresses only the subints that are
+indexed, so downstream CHIRPP stages read these files transparently. PSRCHIVE
+cannot read them; use decompress_archive() first if it needs to.
+"""
+
+import os
+import shutil
+import zlib
+import numpy as np
+from functools import partial
+from astropy.io import fits
+
+# Columns of the SUBINT table that are laid out per channel (and per pol)
+CHANNEL_COLUMNS = ["DATA", "DAT_FREQ", "DAT_WTS", "DAT_OFFS", "DAT_SCL"]
+# Header cards describing the table layout, which astropy regenerates
+LAYOUT_KEYS = (
+    "XTENSION",
+    "BITPIX",
+    "NAXIS",
+    "PCOUNT",
+    "GCOUNT",
+    "TFIELDS",
+    "TTYPE",
+    "TFORM",
+    "TUNIT",
+    "TDIM",
+    "TNULL",
+    "TSCAL",
+    "TZERO",
+    "TDISP",
+)
+
+
+class CompressedData:
+    """
+    Indexable stand-in for the DATA column of a compressed archive, returning
+    int16 arrays like the uncompressed column but decompressing on access.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.shape = (archive.nsub, archive.npol, archive.nchan, archive.nbin)
+        self.ndim = 4
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _row(self, isub):
+        packed = zlib.decompress(self.archive.subint.data["DATA"][isub].tobytes())
+        # Undo the byte shuffle: all high bytes come first, then all low bytes
+        nval = int(np.prod(self.shape[1:]))
+        raw = np.frombuffer(packed, dtype=np.uint8).reshape(2, nval).T.copy()
+        return raw.view(">i2").reshape(self.shape[1:])
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        isub, rest = key[0], key[1:]
+        if isinstance(isub, (int, np.integer)):
+            return self._row(isub)[rest]
+        rows = np.arange(self.shape[0])[isub]
+        return np.stack([self._row(i) for i in rows])[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        cube = self[:]
+        return cube if dtype is None else cube.astype(dtype)
+
+
+class ScaledCube:
+    """
+    Lazily scaled view of the DATA column: indexing returns float32 values
+    raw * DAT_SCL + DAT_OFFS for the requested subints only.
+    """
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.shape = (archive.nsub, archive.npol, archive.nchan, archive.nbin)
+        self.ndim = 4
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        isub, rest = key[0], key[1:]
+        raw = self.archive.raw[isub]
+        scl = self.archive.scales[isub][..., None]
+        offs = self.archive.offsets[isub][..., None]
+        cube = raw.astype(np.float32) * scl + offs
+        if len(rest) == 0:
+            return cube
+        if raw.ndim == 4:
+            return cube[(slice(None),) + rest]
+        return cube[rest]
+
+    def __array__(self, dtype=None, copy=None):
+        cube = self[:]
+        return cube if dtype is None else cube.astype(dtype)
+
+
+class Archive:
+    """
+    A fold-mode PSRFITS archive opened with astropy's memmap.
+
+    Use as a context manager, or call close() when done:
+
+        with Archive("file.ar") as ar:
+            for isub, cube, weights in ar.iter_subints():
+                ...
+    """
+
+    def __init__(self, fname, mode="readonly"):
+        self.fname = fname
+        self.hdul = fits.open(fname, mode=mode, memmap=True)
+        self.primary = self.hdul[0].header
+        self.subint = self.hdul["SUBINT"]
+        hdr = self.subint.header
+        self.nsub = hdr["NAXIS2"]
+        self.npol = hdr["NPOL"]
+        self.nchan = hdr["NCHAN"]
+        self.nbin = hdr["NBIN"]
+        self.compressed = hdr.get("DATACMP", "NONE") == "ZLIB"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.hdul.close()
+
+    def _column(self, name, shape):
+        # Reshaping a field of the memmapped table does not copy it
+        return np.asarray(self.subint.data[name]).reshape(shape)
+
+    @property
+    def raw(self):
+        """Unscaled DATA column, shape (nsub, npol, nchan, nbin)."""
+        if self.compressed:
+            return CompressedData(self)
+        return self._column("DATA", (self.nsub, self.npol, self.nchan, self.nbin))
+
+    @property
+    def data(self):
+        """Scaled DATA column, shape (nsub, npol, nchan, nbin), scaled on access."""
+        return ScaledCube(self)
+
+    @property
+    def weights(self):
+        return self._column("DAT_WTS", (self.nsub, self.nchan))
+
+    @property
+    def scales(self):
+        return self._column("DAT_SCL", (self.nsub, self.npol, self.nchan))
+
+    @property
+    def offsets(self):
+        return self._column("DAT_OFFS", (self.nsub, self.npol, self.nchan))
+
+    @property
+    def freqs(self):
+        return self._column("DAT_FREQ", (self.nsub, self.nchan))
+
+    @property
+    def tsubint(self):
+        return np.asarray(self.subint.data["TSUBINT"], dtype=float)
+
+    @property
+    def length(self):
+        return float(np.sum(self.tsubint))
+
+    @property
+    def dm(self):
+        hdr = self.subint.header
+        if "DM" in hdr:
+            return float(hdr["DM"])
+        return float(self.primary.get("CHAN_DM", 0.0))
+
+    @property
+    def dedispersed(self):
+        """True if the stored profiles have already been dedispersed (HISTORY DEDISP)."""
+        try:
+            history = self.hdul["HISTORY"].data
+        except KeyError:
+            return False
+        if history is None or len(history) == 0 or "DEDISP" not in history.names:
+            return False
+        return bool(history["DEDISP"][-1])
+
+    @property
+    def periods(self):
+        """Topocentric folding period (s) of each subint."""
+        if "PERIOD" in self.subint.columns.names:
+            return np.asarray(self.subint.data["PERIOD"], dtype=float)
+        return np.full(self.nsub, 1.0 / get_param(self, "F0"))
+
+    @property
+    def epochs(self):
+        """
+        Subint mid-times as a two-part MJD: (integer days, fractional days).
+        Kept as two parts so no precision is lost below the nanosecond.
+        """
+        seconds = (
+            float(self.primary["STT_SMJD"])
+            + float(self.primary["STT_OFFS"])
+            + np.asarray(self.subint.data["OFFS_SUB"], dtype=float)
+        )
+        days = np.floor(seconds / 86400.0)
+        imjd = int(self.primary["STT_IMJD"]) + days.astype(np.int64)
+        return imjd, (seconds - days * 86400.0) / 86400.0
+
+    def subint_data(self, isub, weighted=False):
+        """Scaled (npol, nchan, nbin) data for one subint."""
+        cube = self.data[isub]
+        if weighted:
+            cube *= self.weights[isub][None, :, None]
+        return cube
+
+    def iter_subints(self, weighted=False):
+        """Yield (isub, scaled data, weights) one subint at a time."""
+        for isub in range(self.nsub):
+            yield isub, self.subint_data(isub, weighted=weighted), self.weights[isub]
+
+    def write_weights(self, weights, fname=None):
+        """
+        Write new DAT_WTS, shape (nsub, nchan). Updates this file in place if it
+        was opened with mode="update", otherwise copies it to fname first.
+        """
+        weights = np.asarray(weights, dtype=np.float32).reshape(self.nsub, self.nchan)
+        if fname is None:
+            self.subint.data["DAT_WTS"][:] = weights
+            self.hdul.flush()
+            return self.fname
+        shutil.copyfile(self.fname, fname)
+        with fits.open(fname, mode="update", memmap=True) as hdul:
+            hdul["SUBINT"].data["DAT_WTS"][:] = weights
+        return fname
+
+
+def open_archive(fname, mode="readonly"):
+    return Archive(fname, mode=mode)
+
+
+def get_param(archive, name):
+    """Look up a parameter in the ephemeris stored in the PSRPARAM table."""
+    try:
+        lines = archive.hdul["PSRPARAM"].data["PARAM"]
+    except KeyError:
+        raise KeyError(f"{archive.fname} has no PSRPARAM table to read {name} from")
+    for line in lines:
+        fields = str(line).split()
+        if len(fields) > 1 and fields[0] == name:
+            return float(fields[1].replace("D", "E"))
+    raise KeyError(f"{name} not found in the PSRPARAM table of {archive.fname}")
+
+
+def _table(archive, name):
+    # Rows of the named table of archive, or None if it is missing or empty
+    try:
+        data = archive.hdul[name].data
+    except KeyError:
+        return None
+    return data if data is not None and len(data) > 0 else None
+
+
+def _mjd_parts(value):
+    """A long double MJD (or its string) as (integer day, fractional day)."""
+    value = np.longdouble(value)
+    day = np.floor(value)
+    return int(day), value - day
+
+
+def polyco_phase(table, imjd, frac):
+    """
+    Pulse phase (turns, long double) at the two-part MJDs imjd + frac from a
+    PSRFITS POLYCO table, using for each MJD the polyco nearest to it.
+    """
+    ref = [_mjd_parts(mjd) for mjd in table["REF_MJD"]]
+    phase = np.empty(len(imjd), dtype=np.longdouble)
+    for i, (day, part) in enumerate(zip(imjd, frac)):
+        # Minutes from each polyco's reference epoch
+        dt = np.array(
+            [((day - d) + (np.longdouble(part) - f)) * 1440 for d, f in ref],
+            dtype=np.longdouble,
+        )
+        k = int(np.argmin(np.abs(dt)))
+        coeff = np.asarray(table["COEFF"][k][: int(table["NCOEF"][k])], np.longdouble)
+        phase[i] = (
+            np.longdouble(table["REF_PHS"][k])
+            + dt[k] * 60 * np.longdouble(table["REF_F0"][k])
+            + np.polynomial.polynomial.polyval(dt[k], coeff)
+        )
+    return phase
+
+
+def read_cheby_models(lines):
+    """The segments of a tempo2 predictor (T2PREDICT table lines)."""
+    segments, segment = [], None
+    for line in lines:
+        fields = str(line).split()
+        if not fields:
+            continue
+        if fields[:2] == ["ChebyModel", "BEGIN"]:
+            segment = {"coeffs": []}
+        elif fields[:2] == ["ChebyModel", "END"] and segment is not None:
+            ntime, nfreq = segment["NCOEFF_TIME"], segment["NCOEFF_FREQ"]
+            coeffs = segment.pop("coeffs")
+            # One COEFFS line per time coefficient (or per frequency one)
+            if all(len(c) == ntime for c in coeffs) and len(coeffs) == nfreq:
+                coeffs = list(zip(*coeffs))
+            segment["coeffs"] = np.array(coeffs, dtype=np.longdouble).reshape(
+                ntime, nfreq
+            )
+            segments.append(segment)
+            segment = None
+        elif segment is None:
+            continue
+        elif fields[0] == "COEFFS":
+            segment["coeffs"].append([np.longdouble(c) for c in fields[1:]])
+        elif fields[0] in ["TIME_RANGE", "FREQ_RANGE"]:
+            segment[fields[0]] = [np.longdouble(v) for v in fields[1:3]]
+        elif fields[0] in ["NCOEFF_TIME", "NCOEFF_FREQ"]:
+            segment[fields[0]] = int(fields[1])
+        elif fields[0] == "DISPERSION_CONSTANT":
+            segment[fields[0]] = np.longdouble(fields[1])
+    return segments
+
+
+def _chebyshev(coeffs, x):
+    # Chebyshev series with the first coefficient halved, as tempo2 evaluates it
+    coeffs = np.array(coeffs, dtype=np.longdouble)
+    coeffs[0] *= 0.5
+    return np.polynomial.chebyshev.chebval(x, coeffs)
+
+
+def cheby_phase(segments, imjd, frac, freq):
+    """
+    Pulse phase (turns, long double) at the two-part MJDs imjd + frac and the
+    frequency freq (MHz) from tempo2 predictor segments, using for each MJD the
+    segment containing it (or the nearest one).
+    """
+    starts = [_mjd_parts(seg["TIME_RANGE"][0]) for seg in segments]
+    mids = np.array(
+        [(seg["TIME_RANGE"][0] + seg["TIME_RANGE"][1]) / 2 for seg in segments],
+        dtype=np.longdouble,
+    )
+    freq = np.longdouble(freq)
+    phase = np.empty(len(imjd), dtype=np.longdouble)
+    for i, (day, part) in enumerate(zip(imjd, frac)):
+        k = int(np.argmin(np.abs(mids - (day + np.longdouble(part)))))
+        seg = segments[k]
+        t1, t2 = seg["TIME_RANGE"]
+        f1, f2 = seg["FREQ_RANGE"]
+        d, f = starts[k]
+        x = 2 * ((day - d) + (np.longdouble(part) - f)) / (t2 - t1) - 1
+        y = 2 * (min(max(freq, f1), f2) - f1) / (f2 - f1) - 1 if f2 > f1 else 0
+        # Chebyshev series in time of Chebyshev series in frequency
+        phase[i] = _chebyshev([_chebyshev(c, y) for c in seg["coeffs"]], x)
+        if seg.get("DISPERSION_CONSTANT", 0):
+            phase[i] += seg["DISPERSION_CONSTANT"] / freq**2
+    return phase
+
+
+def zero_phase_epochs(archive, freq=None, niter=2):
+    """
+    The subint epochs of archive (see Archive.epochs) moved to the nearest
+    phase zero of its folding predictor (T2PREDICT or POLYCO table) at freq
+    (MHz, OBSFREQ by default), as PSRCHIVE does when it loads a subint: phase
+    zero of the profiles is at these epochs, not at the subint mid-times.
+    """
+    imjd, frac = archive.epochs
+    freq = float(archive.primary.get("OBSFREQ", 0.0)) if freq is None else freq
+    predict, polyco = _table(archive, "T2PREDICT"), _table(archive, "POLYCO")
+    if predict is not None:
+        phase = partial(cheby_phase, read_cheby_models(predict["PREDICT"]), freq=freq)
+    elif polyco is not None:
+        phase = partial(polyco_phase, polyco)
+    else:
+        raise KeyError(f"{archive.fname} has no predictor (T2PREDICT or POLYCO)")
+    periods = archive.periods
+    for _ in range(niter):
+        turns = phase(imjd, frac)
+        turns = np.asarray(turns - np.round(turns), dtype=np.float64)
+        days = frac - turns * periods / 86400.0
+        carry = np.floor(days)
+        imjd = imjd + carry.astype(np.int64)
+        frac = days - carry
+    return imjd, frac
+
+
+def quantize(cube):
+    """
+    Convert a float (nsub, npol, nchan, nbin) cube to int16 with per-profile
+    scales and offsets, spanning the full int16 range like PSRCHIVE does.
+    """
+    cube = np.asarray(cube, dtype=np.float64)
+    vmax = cube.max(axis=-1)
+    vmin = cube.min(axis=-1)
+    offs = 0.5 * (vmax + vmin)
+    scl = (vmax - vmin) / 65534.0
+    scl[scl == 0] = 1.0
+    raw = np.rint((cube - offs[..., None]) / scl[..., None]).astype(np.int16)
+    return raw, scl.astype(np.float32), offs.astype(np.float32)
+
+
+def subint_header(archive):
+    # SUBINT header without the cards describing the table layout
+    hdr = archive.subint.header.copy()
+    for key in list(hdr.keys()):
+        if key.rstrip("0123456789") in LAYOUT_KEYS:
+            del hdr[key]
+    return hdr
+
+
+def replace_data_column(archive, fname, data_column, hdr):
+    """Write archive to fname with its DATA column and SUBINT header replaced."""
+    cols = [
+        data_column if col.name == "DATA" else col.copy()
+        for col in archive.subint.columns
+    ]
+    for col in cols:
+        if col is not data_column:
+            col.array = archive.subint.data[col.name]
+    subint = fits.BinTableHDU.from_columns(cols, header=hdr, name="SUBINT")
+    hdus = [
+        subint if hdu is archive.subint else hdu.copy() for hdu in archive.hdul
+    ]
+    tmpname = f"{fname}.tmp"
+    fits.HDUList(hdus).writeto(tmpname, overwrite=True)
+    os.replace(tmpname, fname)
+    return fname
+
+
+def compress_archive(fname, outname=None, level=6):
+    """
+    Store the DATA column of fname as one zlib chunk per subint, writing to
+    outname (in place by default). Returns (original size, compressed size).
+    """
+    outname = outname or fname
+    size = os.path.getsize(fname)
+    with Archive(fname) as ar:
+        if ar.compressed:
+            return size, size
+        chunks = np.empty(ar.nsub, dtype=object)
+        for isub in range(ar.nsub):
+            raw = np.ascontiguousarray(ar.raw[isub], dtype=">i2")
+            # Byte-shuffle so the slowly varying high bytes compress together
+            shuffled = raw.view(np.uint8).reshape(-1, 2).T.tobytes()
+            chunks[isub] = np.frombuffer(zlib.compress(shuffled, level), dtype=np.uint8)
+        hdr = subint_header(ar)
+        hdr["DATACMP"] = ("ZLIB", "DATA stored as zlib chunks by CHIRPP")
+        data_column = fits.Column(name="DATA", format="PB()", array=chunks)
+        replace_data_column(ar, outname, data_column, hdr)
+    return size, os.path.getsize(outname)
+
+
+def decompress_archive(fname, outname=None):
+    """Convert a compressed archive back to standard PSRFITS (in place by default)."""
+    outname = outname or fname
+    with Archive(fname) as ar:
+        if not ar.compressed:
+            if outname != fname:
+                shutil.copyfile(fname, outname)
+            return outname
+        raw = np.asarray(ar.raw)
+        hdr = subint_header(ar)
+        hdr.pop("DATACMP", None)
+        data_column = fits.Column(
+            name="DATA",
+            format=f"{ar.npol * ar.nchan * ar.nbin}I",
+            dim=f"({ar.nbin},{ar.nchan},{ar.npol})",
+            array=raw.reshape(ar.nsub, -1),
+        )
+        replace_data_column(ar, outname, data_column, hdr)
+    return outname
+
+
+def write_archive(archive, fname, cube, weights, freqs, columns=None):
+    """
+    Write a reduced copy of archive to fname, replacing the SUBINT table.
+
+    cube is a float (nsub, npol, nchan, nbin) array, weights and freqs are
+    (nsub, nchan). Any other per-subint columns are taken from columns (a dict
+    of name: values), or copied from the input if nsub is unchanged.
+    """
+    nsub, npol, nchan, nbin = np.shape(cube)
+    columns = columns or {}
+    raw, scl, offs = quantize(cube)
+    new_values = {
+        "DATA": raw.reshape(nsub, -1),
+        "DAT_FREQ": np.reshape(freqs, (nsub, nchan)),
+        "DAT_WTS": np.reshape(weights, (nsub, nchan)),
+        "DAT_OFFS": offs.reshape(nsub, -1),
+        "DAT_SCL": scl.reshape(nsub, -1),
+    }
+    cols = []
+    for col in archive.subint.columns:
+        if col.name in CHANNEL_COLUMNS:
+            values = new_values[col.name]
+            # DATA may be a compressed variable-length column in the input
+            code = "I" if col.name == "DATA" else col.format.lstrip("0123456789")
+            cols.append(
+                fits.Column(
+                    name=col.name,
+                    format=f"{values.shape[1]}{code}",
+                    unit=col.unit,
+                    dim=f"({nbin},{nchan},{npol})" if col.name == "DATA" else None,
+                    array=values,
+                )
+            )
+        else:
+            if col.name in columns:
+                values = np.asarray(columns[col.name])
+            elif nsub == archive.nsub:
+                values = archive.subint.data[col.name]
+            else:
+                raise ValueError(
+                    f"No values given for SUBINT column {col.name} with {nsub} subints"
+                )
+            cols.append(
+                fits.Column(
+                    name=col.name,
+                    format=col.format,
+                    unit=col.unit,
+                    dim=col.dim,
+                    array=values,
+                )
+            )
+
+    hdr = subint_header(archive)
+    hdr.pop("DATACMP", None)
+    old_nchan = hdr["NCHAN"]
+    hdr["NCHAN"] = nchan
+    hdr["NBIN"] = nbin
+    if npol == 1 and hdr["NPOL"] > 1:
+        # Polarization-scrunched to total intensity
+        hdr["POL_TYPE"] = "AA+BB"
+    hdr["NPOL"] = npol
+    if "CHAN_BW" in hdr:
+        hdr["CHAN_BW"] = hdr["CHAN_BW"] * old_nchan / nchan
+    subint = fits.BinTableHDU.from_columns(cols, header=hdr, name="SUBINT")
+
+    hdus = [
+        subint if hdu is archive.subint else hdu.copy() for hdu in archive.hdul
+    ]
+    fits.HDUList(hdus).writeto(fname, overwrite=True)
+    return fname
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                 Retention of intermediate products                  ##
+#########################################################################
+
+Each processing stage writes a full copy of the data:
+    .ar -> (clean5G) .zap -> (clean) .zap.clfd -> (beamWeight) .bmwt.clfd -> (scrunch) .ftp
+Once every stage that reads an intermediate has succeeded for an observation,
+that observation's intermediate can be released. Before a stage starts, the
+disk budget is checked: releasable files are removed first, then (with a
+compression level) full-resolution products that a stage still reads are
+stored compressed (see compress.py), and if the stage's expected output would
+still exceed the budget, the pipeline stops with an error.
+
+Run from the command line with:
+python retention.py --completed clean5G clean --keep .ar .bmwt.clfd .ftp --dry_run
+python retention.py --next_stage beamWeight --budget 500G
+python retention.py --next_stage scrunch --budget 500G --compress_level 6
+"""
+
+import argparse
+import os
+from glob import glob
+from psrfits import open_archive
+
+# Stages that produce or consume intermediate products, in pipeline order
+STAGES = ["clean5G", "clean", "beamWeight", "scrunch", "tim"]
+# Per-observation output of each stage
+OUTPUTS = {
+    "clean5G": ".zap",
+    "clean": ".zap.clfd",
+    "beamWeight": ".bmwt.clfd",
+    "scrunch": ".ftp",
+}
+# Stages that read each product. The TOA stage can re-scrunch .bmwt.clfd
+# while searching for the right number of subbands, so it is a consumer too.
+CONSUMERS = {
+    ".ar": ["clean5G"],
+    ".zap": ["clean"],
+    ".zap.clfd": ["beamWeight"],
+    ".bmwt.clfd": ["scrunch", "tim"],
+}
+# Stages whose output is as large as their input
+FULL_RESOLUTION = ["clean5G", "clean", "beamWeight"]
+# Products that can be stored compressed while a stage still reads them; only
+# CHIRPP's reader (the native scrunch engine) can read them compressed
+COMPRESSIBLE = [".bmwt.clfd"]
+# Products that are kept unless asked otherwise
+DEFAULT_KEEP = [".ar", ".bmwt.clfd", ".ftp"]
+
+
+def obs_key(fname):
+    # All products of one observation share the file name up to the first "."
+    return os.path.basename(fname).split(".")[0]
+
+
+def products(ext, directory="."):
+    """Dict of observation: file for every file with extension ext."""
+    return {obs_key(f): f for f in glob(os.path.join(directory, f"CHIME*{ext}"))}
+
+
+def file_size(fname, follow_links=False):
+    # Symlinked archives live elsewhere, so by default they cost nothing here
+    if not follow_links and os.path.islink(fname):
+        return 0
+    try:
+        return os.stat(fname).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def parse_size(size):
+    """Bytes in a size such as '500G', '2T' or '1048576'."""
+    if size is None or str(size).strip() == "":
+        return None
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+def format_size(nbytes):
+    for unit in ["B", "K", "M", "G", "T"]:
+        if abs(nbytes) < 1024 or unit == "T":
+            return f"{nbytes:.1f}{unit}"
+        nbytes /= 1024.0
+
+
+def disk_usage(directory="."):
+    """Bytes taken up by all intermediate products in directory."""
+    exts = set(CONSUMERS) | set(OUTPUTS.values())
+    return sum(
+        file_size(f) for ext in exts for f in products(ext, directory).values()
+    )
+
+
+def releasable(completed, keep=DEFAULT_KEEP, directory="."):
+    """
+    Files that no remaining stage needs: every consumer of the product has
+    completed and, where the consumer writes a per-observation product, that
+    product exists for the same observation.
+    """
+    files = []
+    for ext, consumers in CONSUMERS.items():
+        if ext in keep or not all(stage in completed for stage in consumers):
+            continue
+        outputs = [products(OUTPUTS[s], directory) for s in consumers if s in OUTPUTS]
+        for obs, fname in products(ext, directory).items():
+            if all(obs in out for out in outputs):
+                files.append(fname)
+    return sorted(files)
+
+
+def release(files, dry_run=False):
+    """Delete files, returning the number of bytes freed."""
+    freed = 0
+    for fname in files:
+        freed += file_size(fname)
+        if not dry_run:
+            os.remove(fname)
+    return freed
+
+
+def apply_retention(completed, keep=DEFAULT_KEEP, directory=".", dry_run=False):
+    files = releasable(completed, keep=keep, directory=directory)
+    freed = release(files, dry_run=dry_run)
+    if len(files) > 0:
+        action = "Would release" if dry_run else "Released"
+        print(f"{action} {len(files)} intermediate files ({format_size(freed)}).")
+    return freed
+
+
+def compressible(directory="."):
+    """Uncompressed files of the COMPRESSIBLE products (symlinks excluded)."""
+    files = []
+    for ext in COMPRESSIBLE:
+        for fname in products(ext, directory).values():
+            if os.path.islink(fname):
+                continue
+            with open_archive(fname) as ar:
+                if not ar.compressed:
+                    files.append(fname)
+    return sorted(files)
+
+
+def apply_compression(level, directory=".", dry_run=False):
+    """Compress every compressible file at zlib level, returning the bytes freed."""
+    files = compressible(directory)
+    if len(files) == 0:
+        return 0
+    before = sum(file_size(f) for f in files)
+    if dry_run:
+        print(f"Would compress {len(files)} intermediate files ({format_size(before)}).")
+        return 0
+    # compress.py imports this module
+    from compress import convert_files
+
+    convert_files(files, level=level)
+    return before - sum(file_size(f) for f in files)
+
+
+def expected_output(stage, directory="."):
+    """Bytes the stage is expected to write, from the size of its inputs."""
+    if stage not in FULL_RESOLUTION:
+        return 0
+    ext = [e for e, consumers in CONSUMERS.items() if stage in consumers][0]
+    return sum(
+        file_size(f, follow_links=True) for f in products(ext, directory).values()
+    )
+
+
+def manage_intermediates(
+    next_stage, keep=None, budget=None, directory=".", compress_level=0, dry_run=False
+):
+    """
+    Call before starting next_stage: release intermediates that every completed
+    stage is done with (if keep is given), then check that its expected output
+    fits within the disk budget (if any), compressing the products that are
+    still needed first if compress_level is set. Exits if it does not fit, as
+    nothing else frees space while the pipeline runs.
+    """
+    completed = STAGES[: STAGES.index(next_stage)] if next_stage in STAGES else STAGES
+    if keep is not None:
+        apply_retention(completed, keep=keep, directory=directory, dry_run=dry_run)
+    budget = parse_size(budget)
+    if budget is None or next_stage not in STAGES:
+        return
+    needed = expected_output(next_stage, directory)
+    usage = disk_usage(directory)
+    if usage + needed > budget and compress_level > 0:
+        apply_compression(compress_level, directory=directory, dry_run=dry_run)
+        usage = disk_usage(directory)
+    if usage + needed > budget:
+        print(
+            f"\nDisk budget of {format_size(budget)} reached: intermediates use {format_size(usage)}"
+            + f" and {next_stage} needs about {format_size(needed)} more."
+        )
+        if dry_run:
+            return
+        print(
+            "error: free space (e.g. remove older products, set keep_intermediates or compress_level) or raise disk_budget in config.sh, then run again."
+        )
+        exit(1)
+
+
+def parse_keep(keep_str):
+    # keep_intermediates in config.sh: "all", or a space-separated list of extensions
+    if keep_str is None or keep_str.strip() in ["", "all"]:
+        return None
+    return keep_str.split()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Release intermediate products that no remaining stage needs, and check the disk budget."
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--completed",
+        nargs="+",
+        choices=STAGES,
+        help="Stages that have completed successfully.",
+    )
+    group.add_argument(
+        "--next_stage",
+        choices=STAGES + ["complete"],
+        help="Stage about to start (all earlier stages are taken as complete).",
+    )
+    parser.add_argument(
+        "--keep",
+        nargs="+",
+        default=DEFAULT_KEEP,
+        help=f"Extensions of products to keep ({' '.join(DEFAULT_KEEP)} by default).",
+    )
+    parser.add_argument(
+        "--budget", type=str, default=None, help="Disk budget, e.g. 500G."
+    )
+    parser.add_argument(
+        "--compress_level",
+        type=int,
+        default=0,
+        help="With --budget, compress products still needed at this zlib level (1-9) before giving up; 0 to only delete (0 by default).",
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Only report what would be released.",
+    )
+    args = parser.parse_args()
+
+    if args.completed:
+        apply_retention(args.completed, keep=args.keep, dry_run=args.dry_run)
+    else:
+        manage_intermediates(
+            args.next_stage,
+            keep=args.keep,
+            budget=args.budget,
+            compress_level=args.compress_level,
+            dry_run=args.dry_run,
+        )
+    print(f"Intermediate products use {format_size(disk_usage())}.")
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                         In-process scrunch                          ##
+#########################################################################
+
+Frequency- and time-scrunch PSRFITS archives without launching PSRCHIVE.
+Equivalent to, for every file:
+    nsub=$(vap -nc length $f | awk '{print int($2/max_subint) + 1}')
+    pam --setnchn $nsubbands -e ftp --setnsub $nsub $f
+
+Each archive is read exactly once through a memory map. Channels are weighted,
+dedispersed to their subband's weighted centre frequency with a batched FFT
+phase rotation and summed into subbands and subints with NumPy reductions.
+
+With --min_nchan, every power-of-two subband count from --setnchn down to
+--min_nchan is also written (as e.g. *.ftp.32ch, *.ftp.16ch) from the same read,
+each level formed by pairwise summation of the one above it. The nchan retry
+loop in new_pulsar.py then only has to switch levels instead of re-scrunching.
+
+With --manifest, the number of subbands is looked up per observation in a
+manifest written by find_nchan.py --manifest; --setnchn is used for files
+that are not listed.
+
+With --stage_dir (e.g. $SLURM_TMPDIR), inputs are copied to node-local disk a
+few files ahead of the workers and outputs are written back in batches.
+
+Run from the command line with:
+python scrunch.py --setnchn 64 -e ftp --max_subint 3600.0 -j 4 CHIME*bmwt.clfd
+python scrunch.py --setnchn 64 --min_nchan 8 -e ftp CHIME*bmwt.clfd  # Also 32, 16, 8 subbands
+python scrunch.py --setnchn 64 --manifest nchan_manifest.txt CHIME*bmwt.clfd  # Per-file subbands
+python scrunch.py --setnchn 64 --stage_dir $SLURM_TMPDIR -j 4 CHIME*bmwt.clfd  # Stage through local disk
+"""
+
+import argparse
+import os
+import numpy as np
+from psrfits import open_archive, write_archive
+from staging import run_staged
+
+# Dispersion constant used by PSRCHIVE, in s MHz^2 cm^3 / pc
+DM_CONST = 1.0 / 2.41e-4
+# Number of input subints held in memory at once
+CHUNK_NSUB = 16
+
+
+def dispersion_turns(freqs, ref_freqs, dm, periods):
+    """Dispersion delay of freqs relative to ref_freqs (MHz), in turns of phase."""
+    return DM_CONST * dm * (freqs**-2.0 - ref_freqs**-2.0) / periods
+
+
+def rotate(profiles, turns):
+    """
+    Rotate profiles (..., nbin) earlier in phase by turns (broadcastable to
+    profiles.shape[:-1]) using a Fourier-domain phase gradient.
+    """
+    nbin = profiles.shape[-1]
+    spec = np.fft.rfft(profiles, axis=-1)
+    k = np.arange(spec.shape[-1])
+    spec *= np.exp(2j * np.pi * k * np.asarray(turns)[..., None])
+    return np.fft.irfft(spec, n=nbin, axis=-1)
+
+
+def get_nsub(length, max_subint):
+    # Same rule as the vap | awk one-liner in scrunch.sh
+    return int(length / max_subint) + 1
+
+
+def weighted_freqs(weights, freqs, factor):
+    """Weighted centre frequency of each group of factor adjacent channels."""
+    w = weights.reshape(weights.shape[:-1] + (-1, factor))
+    f = freqs.reshape(w.shape)
+    wsum = w.sum(axis=-1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centre = (w * f).sum(axis=-1) / wsum
+    return np.where(wsum > 0, centre, f.mean(axis=-1)), wsum
+
+
+def combine_channels(cube, weights, freqs, factor, dm, periods, ref_freqs=None):
+    """
+    Weighted sum of groups of factor adjacent channels.
+
+    cube is (nsub, npol, nchan, nbin), weights and freqs are (nsub, nchan) and
+    periods is (nsub,). Each channel is dedispersed to ref_freqs (by default the
+    weighted centre frequency of its group) before summing. Returns the
+    weighted sums (not yet normalised), summed weights and reference frequencies.
+    """
+    nsub, npol, nchan, nbin = cube.shape
+    if nchan % factor != 0:
+        raise ValueError(f"{nchan} channels cannot be scrunched by a factor of {factor}")
+    if ref_freqs is None:
+        ref_freqs, wsum = weighted_freqs(weights, freqs, factor)
+    else:
+        wsum = weights.reshape(nsub, -1, factor).sum(axis=-1)
+    if dm != 0.0:
+        turns = dispersion_turns(
+            freqs, np.repeat(ref_freqs, factor, axis=-1), dm, periods[:, None]
+        )
+        cube = rotate(cube, turns[:, None, :])
+    wd = (cube * weights[:, None, :, None]).reshape(nsub, npol, -1, factor, nbin)
+    return wd.sum(axis=3), wsum, ref_freqs
+
+
+def normalise(sums, wsum):
+    # Turn weighted sums into weighted means, leaving zero-weight profiles at zero
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / wsum[:, None, :, None]
+    means[~np.isfinite(means)] = 0.0
+    return means
+
+
+def subint_columns(ar, groups):
+    """Per-subint SUBINT columns (other than the channel columns) for the scrunched file."""
+    tsubint = ar.tsubint
+    columns = {}
+    for col in ar.subint.columns:
+        if col.name in ["DATA", "DAT_FREQ", "DAT_WTS", "DAT_OFFS", "DAT_SCL"]:
+            continue
+        values = np.asarray(ar.subint.data[col.name])
+        if col.name == "TSUBINT":
+            columns[col.name] = [tsubint[g].sum() for g in groups]
+        elif np.issubdtype(values.dtype, np.number):
+            columns[col.name] = [
+                np.average(values[g], axis=0, weights=tsubint[g]) for g in groups
+            ]
+        else:
+            columns[col.name] = [values[g[0]] for g in groups]
+    return columns
+
+
+def scrunch_archive(ar, nsubbands, nsub):
+    """
+    Scrunch an open Archive to nsubbands subbands and (at most) nsub subints.
+    Returns the (nsub, npol, nsubbands, nbin) cube, weights, frequencies and
+    the per-subint columns for writing (including folding periods).
+    """
+    nsub = max(1, min(nsub, ar.nsub))
+    nsubbands = min(nsubbands, ar.nchan)
+    factor = ar.nchan // nsubbands
+    groups = np.array_split(np.arange(ar.nsub), nsub)
+    dm = 0.0 if ar.dedispersed else ar.dm
+    weights = np.array(ar.weights, dtype=np.float64)
+    freqs = np.array(ar.freqs, dtype=np.float64)
+    periods = ar.periods
+
+    sums = np.zeros((nsub, ar.npol, nsubbands, ar.nbin))
+    out_weights = np.zeros((nsub, nsubbands))
+    out_freqs = np.zeros((nsub, nsubbands))
+    for iout, group in enumerate(groups):
+        # Reference frequencies come from the weights of the whole output subint,
+        # so every input subint is dedispersed to the same frequencies
+        ref, wsum = weighted_freqs(
+            weights[group].sum(axis=0, keepdims=True),
+            freqs[group].mean(axis=0, keepdims=True),
+            factor,
+        )
+        out_weights[iout] = wsum[0]
+        out_freqs[iout] = ref[0]
+        for start in range(group[0], group[-1] + 1, CHUNK_NSUB):
+            stop = min(start + CHUNK_NSUB, group[-1] + 1)
+            wd, _, _ = combine_channels(
+                ar.data[start:stop].astype(np.float64),
+                weights[start:stop],
+                freqs[start:stop],
+                factor,
+                dm,
+                periods[start:stop],
+                ref_freqs=np.repeat(ref, stop - start, axis=0),
+            )
+            sums[iout] += wd.sum(axis=0)
+    # Group weights were accumulated over all subints of each output subint
+    cube = normalise(sums, out_weights)
+    columns = subint_columns(ar, groups)
+    columns.setdefault("PERIOD", [periods[g].mean() for g in groups])
+    return cube, out_weights, out_freqs, columns
+
+
+def scrunch_levels(cube, weights, freqs, dm, periods, min_nchan):
+    """
+    Yield (nchan, cube, weights, freqs) for each power-of-two level below the
+    input resolution, down to min_nchan, by summing adjacent pairs of subbands.
+    """
+    periods = np.asarray(periods, dtype=np.float64)
+    while cube.shape[2] // 2 >= min_nchan and cube.shape[2] % 2 == 0:
+        sums, weights, freqs = combine_channels(cube, weights, freqs, 2, dm, periods)
+        cube = normalise(sums, weights)
+        yield cube.shape[2], cube, weights, freqs
+
+
+def manifest_key(fname):
+    # Observations are identified by file name without directory or last extension,
+    # so the entry for X.bmwt.clfd also applies to X.bmwt.ftp
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+def write_nchan_manifest(nchans, fname="nchan_manifest.txt"):
+    """Write a manifest of observation: nsubbands, from a dict of file: nsubbands."""
+    with open(fname, "w") as f:
+        f.write("# observation nsubbands\n")
+        for obs in sorted(nchans):
+            f.write(f"{manifest_key(obs)} {nchans[obs]}\n")
+    return fname
+
+
+def read_nchan_manifest(fname):
+    nchans = {}
+    with open(fname, "r") as f:
+        for line in f:
+            if line.startswith("#") or len(line.split()) < 2:
+                continue
+            obs, nchan = line.split()[:2]
+            nchans[obs] = int(nchan)
+    return nchans
+
+
+def output_name(fname, extension):
+    # Replace the last extension, as PSRCHIVE's -e option does
+    return f"{os.path.splitext(fname)[0]}.{extension.lstrip('.')}"
+
+
+def level_name(outname, nchan):
+    return f"{outname}.{nchan}ch"
+
+
+def scrunch_file(fname, nsubbands, max_subint=3600.0, extension="ftp", min_nchan=None):
+    """Scrunch fname, returning the names of the files written."""
+    with open_archive(fname) as ar:
+        nsub = get_nsub(ar.length, max_subint)
+        cube, weights, freqs, columns = scrunch_archive(ar, nsubbands, nsub)
+        outname = write_archive(
+            ar, output_name(fname, extension), cube, weights, freqs, columns
+        )
+        written = [outname]
+        if min_nchan:
+            dm = 0.0 if ar.dedispersed else ar.dm
+            for nchan, lcube, lweights, lfreqs in scrunch_levels(
+                cube, weights, freqs, dm, columns["PERIOD"], min_nchan
+            ):
+                written.append(
+                    write_archive(
+                        ar, level_name(outname, nchan), lcube, lweights, lfreqs, columns
+                    )
+                )
+    return written
+
+
+def _scrunch_one(fname, nsubbands, max_subint, extension, min_nchan, manifest):
+    nsubbands = manifest.get(manifest_key(fname), nsubbands)
+    try:
+        return scrunch_file(fname, nsubbands, max_subint, extension, min_nchan), None
+    except Exception as err:
+        return [], f"{type(err).__name__}: {err}"
+
+
+def scrunch_files(
+    files,
+    nsubbands,
+    max_subint=3600.0,
+    extension="ftp",
+    nproc=1,
+    min_nchan=None,
+    manifest=None,
+    stage_dir=None,
+):
+    """
+    Scrunch every file, using a pool of nproc worker processes. manifest is an
+    optional dict of observation: nsubbands overriding nsubbands per file.
+    With a stage_dir, files are scrunched from node-local copies (see staging.py).
+    Returns the list of files that failed.
+    """
+    return run_staged(
+        files,
+        _scrunch_one,
+        args=(nsubbands, max_subint, extension, min_nchan, manifest or {}),
+        stage_dir=stage_dir,
+        nproc=nproc,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Scrunch PSRFITS archives in frequency and time without PSRCHIVE."
+    )
+    parser.add_argument("files", nargs="+", help="Archives to scrunch.")
+    parser.add_argument(
+        "--setnchn",
+        type=int,
+        required=True,
+        help="Frequency scrunch to this many subbands (as in pam --setnchn).",
+    )
+    parser.add_argument(
+        "-e",
+        "--extension",
+        type=str,
+        default="ftp",
+        help="Extension replacing that of the input file ('ftp' by default).",
+    )
+    parser.add_argument(
+        "--max_subint",
+        type=float,
+        default=3600.0,
+        help="Maximum subint duration in seconds (3600.0 by default).",
+    )
+    parser.add_argument(
+        "--min_nchan",
+        type=int,
+        default=None,
+        help="Also write every power-of-two subband count down to this many subbands.",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="Per-observation number of subbands, as written by find_nchan.py --manifest.",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of worker processes (1 by default).",
+    )
+    parser.add_argument(
+        "--stage_dir",
+        type=str,
+        default=None,
+        help="Node-local directory (e.g. $SLURM_TMPDIR) to stage files through; outputs are written back to the current directory.",
+    )
+    args = parser.parse_args()
+
+    failed = scrunch_files(
+        args.files,
+        args.setnchn,
+        max_subint=args.max_subint,
+        extension=args.extension,
+        nproc=args.nproc,
+        min_nchan=args.min_nchan,
+        manifest=read_nchan_manifest(args.manifest) if args.manifest else None,
+        stage_dir=args.stage_dir,
+    )
+    if failed:
+        exit(1)
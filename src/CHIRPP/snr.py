@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+
+"""
+In-process S/N estimates for PSRFITS archives, with a per-file metadata cache.
+
+The cache (file_metadata.json by default) maps each file to its size, mtime,
+fully scrunched S/N, nbin, nchan, nsub and length, so repeated passes over a
+dataset (nchan planning, template selection) only read files that changed.
+"""
+
+import json
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from psrfits import open_archive
+from scrunch import scrunch_archive
+
+METADATA_CACHE = "file_metadata.json"
+# Fraction of the profile used to estimate the off-pulse baseline
+BASELINE_DUTY = 0.15
+
+
+def pscrunch(cube, pol_type="AA+BB"):
+    """Total intensity from a (..., npol, nchan, nbin) cube."""
+    npol = cube.shape[-3]
+    if npol == 1 or pol_type.startswith("IQUV"):
+        return cube[..., 0, :, :]
+    return cube[..., 0, :, :] + cube[..., 1, :, :]
+
+
+def circular_window_sums(profiles, width):
+    # Sum of every run of width adjacent bins, wrapping around in phase
+    nbin = profiles.shape[-1]
+    wrapped = np.concatenate([profiles, profiles[..., : width - 1]], axis=-1)
+    csum = np.cumsum(wrapped, axis=-1)
+    csum = np.concatenate([np.zeros(profiles.shape[:-1] + (1,)), csum], axis=-1)
+    return csum[..., width : width + nbin] - csum[..., :nbin]
+
+
+def baseline_stats(profiles):
+    """
+    Mean and standard deviation of the off-pulse baseline of profiles
+    (..., nbin): the lowest-mean window of BASELINE_DUTY of a turn.
+    """
+    profiles = np.asarray(profiles, dtype=np.float64)
+    nbin = profiles.shape[-1]
+    nbase = max(2, int(BASELINE_DUTY * nbin))
+    base_sums = circular_window_sums(profiles, nbase)
+    start = np.argmin(base_sums, axis=-1)
+    idx = (start[..., None] + np.arange(nbase)) % nbin
+    baseline = np.take_along_axis(profiles, idx, axis=-1)
+    return baseline.mean(axis=-1), baseline.std(axis=-1, ddof=1)
+
+
+def profile_snr(profiles):
+    """
+    S/N of profiles (..., nbin), vectorized over leading axes.
+
+    The baseline is the lowest-mean window of BASELINE_DUTY of a turn; the
+    signal is the best boxcar (widths 1, 2, 4, ... nbin/2) above that baseline.
+    """
+    profiles = np.asarray(profiles, dtype=np.float64)
+    nbin = profiles.shape[-1]
+    mean, sigma = baseline_stats(profiles)
+    sigma = np.where(sigma == 0, np.inf, sigma)
+
+    snr = np.full(profiles.shape[:-1], -np.inf)
+    width = 1
+    while width <= nbin // 2:
+        on = circular_window_sums(profiles, width).max(axis=-1)
+        snr = np.maximum(snr, (on - width * mean) / (sigma * np.sqrt(width)))
+        width *= 2
+    return snr
+
+
+def fscrunched_profile(ar):
+    """Dedispersed, fully frequency-, time- and polarization-scrunched profile."""
+    cube, _, _, _ = scrunch_archive(ar, 1, 1)
+    return pscrunch(cube, ar.subint.header.get("POL_TYPE", "AA+BB"))[0, 0]
+
+
+def file_stats(fname):
+    with open_archive(fname) as ar:
+        return {
+            "snr": float(profile_snr(fscrunched_profile(ar))),
+            "nbin": int(ar.nbin),
+            "nchan": int(ar.nchan),
+            "nsub": int(ar.nsub),
+            "length": ar.length,
+        }
+
+
+def _stats_one(fname):
+    try:
+        return fname, file_stats(fname), None
+    except Exception as err:
+        return fname, None, f"{type(err).__name__}: {err}"
+
+
+def load_cache(cache):
+    if cache and os.path.exists(cache):
+        with open(cache, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_cache(entries, cache):
+    tmp = f"{cache}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entries, f, indent=1)
+    os.replace(tmp, cache)
+
+
+def measure_files(files, nproc=1, cache=METADATA_CACHE):
+    """
+    Return a dict of fname: stats for every readable file, reading only files
+    that are missing from (or have changed since) the metadata cache.
+    """
+    entries = load_cache(cache)
+    results = {}
+    todo = []
+    for fname in files:
+        st = os.stat(fname)
+        key = os.path.abspath(fname)
+        entry = entries.get(key)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            results[fname] = entry
+        else:
+            todo.append(fname)
+
+    if nproc > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            measured = list(pool.map(_stats_one, todo, chunksize=8))
+    else:
+        measured = [_stats_one(fname) for fname in todo]
+
+    for fname, stats, error in measured:
+        if error:
+            print(f"warning: could not measure S/N of {fname}: {error}")
+            continue
+        st = os.stat(fname)
+        stats.update(size=st.st_size, mtime=st.st_mtime)
+        entries[os.path.abspath(fname)] = stats
+        results[fname] = stats
+    if cache and len(measured) > 0:
+        save_cache(entries, cache)
+    return results
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                   Node-local staging of per-file work               ##
+#########################################################################
+
+Per-file stages read from and write to the shared data directory. With a
+stage directory (e.g. $SLURM_TMPDIR on a compute node), a background thread
+copies inputs there a few files ahead of the workers, each file is processed
+locally, and outputs are copied back to the working directory in batches.
+Shared-filesystem traffic becomes sequential bulk copies instead of many
+small reads and writes.
+
+Without a stage directory, files are processed in place.
+
+Run from the command line with:
+python staging.py --stage_dir $SLURM_TMPDIR -o .zap -c "psrsh chime_zap.psh -e ar.zap {}" CHIME*.ar
+python staging.py -o .clfd -c "clfd {}" CHIME*.zap  # stages in $SLURM_TMPDIR if set
+"""
+
+import argparse
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from retention import obs_key
+
+# Number of files staged ahead of the workers
+STAGE_DEPTH = 2
+# Number of outputs copied back together
+WRITEBACK_BATCH = 16
+
+
+def copy_atomic(src, dest):
+    # Copy to a temporary name first so a partial file is never mistaken for output
+    tmp = os.path.join(os.path.dirname(dest) or ".", f".{os.path.basename(dest)}.tmp")
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
+
+
+class Prefetcher:
+    """
+    Copies files into stage_dir from a background thread, staying at most
+    slots files ahead of release(). Iterating yields (fname, local path, error).
+    """
+
+    def __init__(self, files, stage_dir, slots=STAGE_DEPTH):
+        self.files = list(files)
+        self.stage_dir = stage_dir
+        self.slots = threading.Semaphore(slots)
+        self.staged = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        for fname in self.files:
+            self.slots.acquire()
+            local = os.path.join(self.stage_dir, os.path.basename(fname))
+            try:
+                copy_atomic(fname, local)
+                self.staged.put((fname, local, None))
+            except OSError as err:
+                self.slots.release()
+                self.staged.put((fname, None, f"{type(err).__name__}: {err}"))
+        self.staged.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self.staged.get()
+            if item is None:
+                return
+            yield item
+
+    def release(self, local):
+        """Remove a staged input once it has been processed."""
+        if os.path.exists(local):
+            os.remove(local)
+        self.slots.release()
+
+
+class WriteBack:
+    """Copies local outputs to dest from a background thread, batch files at a time."""
+
+    def __init__(self, dest=".", batch=WRITEBACK_BATCH):
+        self.dest = dest
+        self.batch = batch
+        self.pending = queue.Queue()
+        self.errors = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _flush(self, outputs):
+        for local in outputs:
+            try:
+                copy_atomic(local, os.path.join(self.dest, os.path.basename(local)))
+                os.remove(local)
+            except OSError as err:
+                self.errors.append(f"{local}: {type(err).__name__}: {err}")
+
+    def _run(self):
+        outputs = []
+        while True:
+            local = self.pending.get()
+            if local is None:
+                break
+            outputs.append(local)
+            if len(outputs) >= self.batch:
+                self._flush(outputs)
+                outputs = []
+        self._flush(outputs)
+
+    def add(self, outputs):
+        for local in outputs:
+            self.pending.put(local)
+
+    def close(self):
+        """Copy back everything still pending and wait for it to finish."""
+        self.pending.put(None)
+        self.thread.join()
+        for error in self.errors:
+            print(f"error: could not write back {error}", file=sys.stderr)
+        return self.errors
+
+
+def default_stage_dir():
+    return os.environ.get("SLURM_TMPDIR") or None
+
+
+def run_staged(
+    files,
+    worker,
+    args=(),
+    stage_dir=None,
+    dest=".",
+    nproc=1,
+    depth=STAGE_DEPTH,
+    batch=WRITEBACK_BATCH,
+):
+    """
+    Call worker(path, *args) on every file, in a pool of nproc processes.
+    worker returns (list of output files, error message or None); outputs must
+    be written next to path. With a stage_dir, path is a local copy and the
+    outputs are copied back to dest. Returns the list of files that failed.
+    """
+    failed = []
+
+    def report(fname, outputs, error):
+        if error:
+            print(f"error: could not process {fname}: {error}", file=sys.stderr)
+            failed.append(fname)
+        else:
+            print(f"{fname} -> {' '.join(os.path.basename(o) for o in outputs)}")
+
+    if not stage_dir:
+        if nproc > 1:
+            with ProcessPoolExecutor(max_workers=nproc) as pool:
+                futures = [(f, pool.submit(worker, f, *args)) for f in files]
+                for fname, fut in futures:
+                    report(fname, *fut.result())
+        else:
+            for fname in files:
+                report(fname, *worker(fname, *args))
+        return failed
+
+    os.makedirs(stage_dir, exist_ok=True)
+    workdir = tempfile.mkdtemp(prefix="chirpp_stage_", dir=stage_dir)
+    prefetcher = Prefetcher(files, workdir, slots=depth + nproc)
+    writeback = WriteBack(dest, batch=batch)
+    lock = threading.Lock()
+
+    def finish(fname, local, outputs, error):
+        try:
+            with lock:
+                report(fname, outputs, error)
+            if not error:
+                writeback.add(outputs)
+        finally:
+            # Always free the slot, or the prefetcher waits for it forever
+            prefetcher.release(local)
+
+    def done(fname, local, fut):
+        # Exceptions raised in a done callback are only logged, so a worker
+        # that died (e.g. BrokenProcessPool after an OOM kill) is reported here
+        try:
+            outputs, error = fut.result()
+        except Exception as err:
+            outputs, error = [], f"{type(err).__name__}: {err}"
+        finish(fname, local, outputs, error)
+
+    try:
+        if nproc > 1:
+            with ProcessPoolExecutor(max_workers=nproc) as pool:
+                for fname, local, error in prefetcher:
+                    if error:
+                        with lock:
+                            report(fname, [], error)
+                        continue
+                    try:
+                        fut = pool.submit(worker, local, *args)
+                    except BrokenProcessPool as err:
+                        finish(fname, local, [], f"{type(err).__name__}: {err}")
+                        continue
+                    fut.add_done_callback(
+                        lambda fut, fname=fname, local=local: done(fname, local, fut)
+                    )
+        else:
+            for fname, local, error in prefetcher:
+                if error:
+                    report(fname, [], error)
+                    continue
+                finish(fname, local, *worker(local, *args))
+    finally:
+        written = writeback.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return failed + written
+
+
+def local_outputs(path, extensions):
+    """Files next to path from the same observation that end in one of extensions."""
+    directory = os.path.dirname(path) or "."
+    return sorted(
+        os.path.join(directory, f)
+        for f in os.listdir(directory)
+        if obs_key(f) == obs_key(path)
+        and f != os.path.basename(path)
+        and any(f.endswith(ext) for ext in extensions)
+    )
+
+
+def run_command(path, command, extensions):
+    """Run a shell command with {} replaced by path, returning its outputs."""
+    result = subprocess.run(command.replace("{}", shlex.quote(path)), shell=True)
+    if result.returncode != 0:
+        return [], f"command exited with status {result.returncode}"
+    return local_outputs(path, extensions), None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run a command on each file, staging inputs and outputs through a node-local directory."
+    )
+    parser.add_argument("files", nargs="+", help="Input files.")
+    parser.add_argument(
+        "-c",
+        "--command",
+        type=str,
+        required=True,
+        help="Shell command to run on each file, with {} standing for the file.",
+    )
+    parser.add_argument(
+        "-o",
+        "--outputs",
+        nargs="+",
+        required=True,
+        help="Extensions of the output files to write back, e.g. .zap.",
+    )
+    parser.add_argument(
+        "--stage_dir",
+        type=str,
+        default=default_stage_dir(),
+        help="Node-local directory to stage files through ($SLURM_TMPDIR by default; in place if unset).",
+    )
+    parser.add_argument(
+        "--dest",
+        type=str,
+        default=".",
+        help="Directory to write outputs back to (the current directory by default).",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=STAGE_DEPTH,
+        help=f"Number of files to stage ahead ({STAGE_DEPTH} by default).",
+    )
+    parser.add_argument(
+        "--batch",
+        type=int,
+        default=WRITEBACK_BATCH,
+        help=f"Number of outputs to write back together ({WRITEBACK_BATCH} by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of files to process at once (1 by default).",
+    )
+    args = parser.parse_args()
+
+    failed = run_staged(
+        args.files,
+        run_command,
+        args=(args.command, args.outputs),
+        stage_dir=args.stage_dir,
+        dest=args.dest,
+        nproc=args.nproc,
+        depth=args.depth,
+        batch=args.batch,
+    )
+    if failed:
+        exit(1)
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                   In-process template construction                  ##
+#########################################################################
+
+Equivalent to "autotoa -g0.1 -i3 -S added.trimmed -M template_50.txt" followed
+by "pam -r0.5 -m added.trimmed": iteratively align and add the listed profiles.
+
+Each file is reduced to its fully scrunched, total-intensity profile as it is
+read, so only a (K, nbin) array of profiles is held in memory. Starting from a
+Gaussian, every iteration measures all K phase shifts against the current
+template at once (FFT cross-correlation, refined in the Fourier domain),
+rotates the profiles with a Fourier phase gradient and forms the S/N-weighted
+sum, until the shifts stop changing. Profiles with more bins than --nbin are
+downsampled. The result is centred at phase 0.5 and written as PSRFITS.
+
+With --state, the running aligned sum, its total weight and the files in it
+are also saved. --update then folds new profiles into that state, aligning
+only them against the current template, so the template improves as data
+arrive at a cost proportional to the new data. The template is only written
+out again (to be re-smoothed) once its S/N has grown by --resmooth_gain since
+it was last smoothed.
+
+Run from the command line with:
+python template.py -g 0.1 -i 10 -S added.trimmed -M template_50.txt --nbin 1024 -j 8
+python template.py -M template_50.txt --nbin 1024 --state template_state.npz  # Keep the running sum
+python template.py --update --state template_state.npz -M new_files.txt --min_snr 20
+"""
+
+import argparse
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from psrfits import open_archive, write_archive
+from scrunch import rotate, scrunch_archive
+from snr import baseline_stats, fscrunched_profile, profile_snr
+
+# Newton steps refining each cross-correlation peak
+NEWTON_STEPS = 3
+# Relative growth of the template S/N after which it is re-smoothed
+RESMOOTH_GAIN = 0.1
+
+
+def resample(profiles, nbin):
+    """Downsample profiles (..., nbin_in) to nbin, averaging bins when possible."""
+    nbin_in = profiles.shape[-1]
+    if nbin_in == nbin:
+        return profiles
+    if nbin_in % nbin == 0:
+        return profiles.reshape(profiles.shape[:-1] + (nbin, -1)).mean(axis=-1)
+    # Otherwise keep the harmonics that nbin bins can represent
+    spec = np.fft.rfft(profiles, axis=-1)[..., : nbin // 2 + 1]
+    return np.fft.irfft(spec, n=nbin, axis=-1) * nbin / nbin_in
+
+
+def gaussian(nbin, width, centre=0.5):
+    """Gaussian profile of FWHM width (turns) centred at centre."""
+    phase = (np.arange(nbin) + 0.5) / nbin - centre
+    phase -= np.round(phase)
+    sigma = width / np.sqrt(8.0 * np.log(2.0))
+    return np.exp(-0.5 * (phase / sigma) ** 2)
+
+
+def fit_shifts(profiles, template):
+    """
+    Phase shifts (turns) of profiles (K, nbin) relative to template (nbin):
+    rotate(profiles, shifts) aligns them with the template. The peak of the
+    FFT cross-correlation is refined by Newton steps on the Fourier-domain
+    cross-correlation, so shifts are not limited to whole bins.
+    """
+    nbin = profiles.shape[-1]
+    cross = np.fft.rfft(profiles, axis=-1) * np.conj(np.fft.rfft(template))[None, :]
+    cross[:, 0] = 0.0
+    return cross_spectrum_shifts(cross, nbin)
+
+
+def cross_spectrum_shifts(cross, nbin):
+    """
+    Shifts (turns) maximising Re(sum_k cross_k exp(2 pi i k shift)) for cross
+    spectra (K, nharm) of nbin-bin profiles: the integer lag of the largest
+    cross-correlation, refined by NEWTON_STEPS Newton steps.
+    """
+    lag = np.argmax(np.fft.irfft(cross, n=nbin, axis=-1), axis=-1)
+    shifts = lag / nbin
+    k = 2.0 * np.pi * np.arange(cross.shape[-1])
+    for _ in range(NEWTON_STEPS):
+        terms = cross * np.exp(1j * k[None, :] * shifts[:, None])
+        d1 = -np.sum((k * terms).imag, axis=-1)
+        d2 = -np.sum((k**2 * terms).real, axis=-1)
+        step = np.where(d2 < 0, -d1 / np.where(d2 == 0, 1.0, d2), 0.0)
+        shifts = shifts + np.clip(step, -0.5 / nbin, 0.5 / nbin)
+    return (shifts + 0.5) % 1.0 - 0.5
+
+
+def normalise(profiles):
+    """Subtract the baseline and scale to unit off-pulse noise."""
+    mean, sigma = baseline_stats(profiles)
+    sigma = np.where(sigma > 0, sigma, np.inf)
+    return (profiles - mean[..., None]) / sigma[..., None]
+
+
+def peak_offset(template, centre=0.5):
+    """Turns by which to rotate template so its peak lies at phase centre."""
+    nbin = len(template)
+    peak = np.argmax(template)
+    # Parabolic refinement of the peak position
+    y0, y1, y2 = template[peak - 1], template[peak], template[(peak + 1) % nbin]
+    denom = y0 - 2 * y1 + y2
+    offset = 0.5 * (y0 - y2) / denom if denom != 0 else 0.0
+    return (peak + offset + 0.5) / nbin - centre
+
+
+def centre_peak(template, centre=0.5):
+    """Rotate template so its peak lies at phase centre (as pam -r does)."""
+    return rotate(template, peak_offset(template, centre))
+
+
+def build_template(profiles, width=0.1, max_iter=10, tol=1e-4, initial=None):
+    """
+    Align and add profiles (K, nbin). Returns (template, shifts, weights,
+    number of iterations). Weights are each profile's S/N, which makes the
+    sum of noise-normalised profiles the optimally weighted one.
+    """
+    profiles = normalise(profiles)
+    weights = np.clip(profile_snr(profiles), 0.0, None)
+    if weights.sum() == 0:
+        weights = np.ones(len(profiles))
+    template = gaussian(profiles.shape[-1], width) if initial is None else initial
+    shifts = np.zeros(len(profiles))
+    for niter in range(1, max_iter + 1):
+        new_shifts = fit_shifts(profiles, template)
+        aligned = rotate(profiles, new_shifts)
+        template = np.tensordot(weights, aligned, axes=1) / weights.sum()
+        change = np.abs((new_shifts - shifts + 0.5) % 1.0 - 0.5).max()
+        shifts = new_shifts
+        if niter > 1 and change < tol:
+            break
+    return template, shifts, weights, niter
+
+
+def save_state(fname, total, weight, snr2, files, snr2_smoothed=None):
+    """
+    Save the running template: the aligned, S/N-weighted sum of profiles
+    (total), the sum of the weights and of their squares (snr2, the squared
+    S/N of the template), the files included and snr2 when last smoothed.
+    """
+    tmp = f"{fname}.tmp.npz"
+    np.savez(
+        tmp,
+        total=total,
+        weight=weight,
+        snr2=snr2,
+        snr2_smoothed=snr2 if snr2_smoothed is None else snr2_smoothed,
+        files=np.array([os.path.basename(f) for f in files]),
+    )
+    os.replace(tmp, fname)
+
+
+def load_state(fname):
+    with np.load(fname) as state:
+        state = {key: state[key] for key in state.files}
+    state["files"] = list(state["files"])
+    return state
+
+
+def update_template(state, profiles, names, min_snr=0.0):
+    """
+    Fold new profiles (K, nbin) into a template state, aligning them against
+    the current template. Profiles of files already in the state, or with S/N
+    below min_snr, are skipped. Returns the names of the profiles added.
+    """
+    included = set(state["files"])
+    profiles = normalise(profiles)
+    weights = profile_snr(profiles)
+    keep = np.array(
+        [
+            os.path.basename(name) not in included and snr >= max(min_snr, 0.0)
+            for name, snr in zip(names, weights)
+        ],
+        dtype=bool,
+    )
+    if not keep.any():
+        return []
+    profiles, weights = profiles[keep], weights[keep]
+    shifts = fit_shifts(profiles, state["total"] / state["weight"])
+    state["total"] = state["total"] + np.tensordot(
+        weights, rotate(profiles, shifts), axes=1
+    )
+    state["weight"] = state["weight"] + weights.sum()
+    state["snr2"] = state["snr2"] + np.sum(weights**2)
+    added = [name for name, k in zip(names, keep) if k]
+    state["files"] = state["files"] + [os.path.basename(f) for f in added]
+    return added
+
+
+def smoothing_due(state, gain=RESMOOTH_GAIN):
+    """True once the template S/N has grown by gain since it was last smoothed."""
+    return np.sqrt(state["snr2"] / state["snr2_smoothed"]) - 1.0 >= gain
+
+
+def _load_one(job):
+    fname, nbin = job
+    try:
+        with open_archive(fname) as ar:
+            if ar.nbin < nbin:
+                return fname, None, f"has {ar.nbin} bins, fewer than {nbin}"
+            return fname, resample(fscrunched_profile(ar), nbin), None
+    except Exception as err:
+        return fname, None, f"{type(err).__name__}: {err}"
+
+
+def load_profiles(files, nbin, nproc=1):
+    """Fully scrunched profiles of files, as a (K, nbin) array, and their names."""
+    jobs = [(fname, nbin) for fname in files]
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            results = list(pool.map(_load_one, jobs))
+    else:
+        results = [_load_one(job) for job in jobs]
+    names, profiles = [], []
+    for fname, profile, error in results:
+        if error:
+            print(f"warning: skipping {fname}: {error}")
+            continue
+        names.append(fname)
+        profiles.append(profile)
+    return names, np.array(profiles).reshape(len(profiles), nbin)
+
+
+def write_template(template, reference, fname):
+    """Write a single-profile PSRFITS template, taking headers from reference."""
+    with open_archive(reference) as ar:
+        _, _, freqs, columns = scrunch_archive(ar, 1, 1)
+        cube = np.asarray(template, dtype=np.float64).reshape(1, 1, 1, -1)
+        write_archive(ar, fname, cube, np.ones((1, 1)), freqs, columns)
+    return fname
+
+
+def read_metafile(metafile):
+    with open(metafile, "r") as f:
+        return [line.split()[0] for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a template by iteratively aligning and adding profiles."
+    )
+    parser.add_argument(
+        "-M", "--metafile", type=str, required=True, help="File listing the archives."
+    )
+    parser.add_argument(
+        "-S",
+        "--output",
+        type=str,
+        default="added.trimmed",
+        help="Output template ('added.trimmed' by default).",
+    )
+    parser.add_argument(
+        "-g",
+        "--width",
+        type=float,
+        default=0.1,
+        help="FWHM (turns) of the initial Gaussian template (0.1 by default).",
+    )
+    parser.add_argument(
+        "-i",
+        "--max_iter",
+        type=int,
+        default=10,
+        help="Maximum number of align-and-add iterations (10 by default).",
+    )
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-4,
+        help="Stop once no profile's shift changes by more than this many turns (1e-4 by default).",
+    )
+    parser.add_argument(
+        "--nbin",
+        type=int,
+        default=None,
+        help="Number of bins of the template (that of the first file by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes used to read the files (1 by default).",
+    )
+    parser.add_argument(
+        "--state",
+        type=str,
+        default=None,
+        help="File (.npz) in which to keep the running aligned sum for later --update runs.",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Fold the listed files into the template saved in --state instead of building from scratch.",
+    )
+    parser.add_argument(
+        "--min_snr",
+        type=float,
+        default=0.0,
+        help="With --update, only add profiles with at least this S/N (0 by default).",
+    )
+    parser.add_argument(
+        "--resmooth_gain",
+        type=float,
+        default=RESMOOTH_GAIN,
+        help=f"With --update, only write the template once its S/N has grown by this fraction since last smoothed ({RESMOOTH_GAIN} by default).",
+    )
+    args = parser.parse_args()
+
+    if args.update and not args.state:
+        print("error: --update needs the --state file of a previous build!")
+        exit(1)
+
+    files = read_metafile(args.metafile)
+    if len(files) == 0:
+        print(f"error: no files listed in {args.metafile}!")
+        exit(1)
+    if args.update:
+        state = load_state(args.state)
+        nbin = len(state["total"])
+    else:
+        nbin = args.nbin
+    if nbin is None:
+        with open_archive(files[0]) as ar:
+            nbin = ar.nbin
+    names, profiles = load_profiles(files, nbin, nproc=args.nproc)
+    if len(names) == 0:
+        print("error: none of the listed files could be used!")
+        exit(1)
+
+    if args.update:
+        added = update_template(state, profiles, names, min_snr=args.min_snr)
+        print(f"Added {len(added)} of {len(names)} profiles to the template.")
+        if len(added) > 0 and smoothing_due(state, args.resmooth_gain):
+            write_template(state["total"] / state["weight"], added[-1], args.output)
+            state["snr2_smoothed"] = state["snr2"]
+            print(f"Template S/N grew enough to re-smooth; written to {args.output}.")
+        save_state(args.state, **state)
+        exit(0)
+
+    template, shifts, weights, niter = build_template(
+        profiles, width=args.width, max_iter=args.max_iter, tol=args.tol
+    )
+    offset = peak_offset(template)
+    template = rotate(template, offset)
+    write_template(template, names[int(np.argmax(weights))], args.output)
+    print(
+        f"Added {len(names)} profiles in {niter} iterations; template written to {args.output}."
+    )
+    if args.state:
+        save_state(
+            args.state, template * weights.sum(), weights.sum(), np.sum(weights**2), names
+        )
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                      Template file selection                        ##
+#########################################################################
+
+Rank files by their fully scrunched S/N and keep the highest-S/N files with
+the template's nbin, as template_creation.sh does with psrstat. Writes:
+    template_allFiles.txt - "file snr nbin" for every matching file, by S/N
+    template_50.txt       - the top files, one per line
+
+S/N values come from the metadata cache (see snr.py), so only new or changed
+files are read, in parallel with -j.
+
+Run from the command line with:
+python template_select.py -d /path/to/data -e .ftp --nbin 1024 -n 50 -j 8
+"""
+
+import argparse
+import os
+from glob import glob
+from snr import METADATA_CACHE, measure_files
+
+
+def select_templates(stats, nbin, ntop=50):
+    """
+    From a dict of fname: stats, return (all files with this nbin sorted by
+    decreasing S/N, the ntop highest-S/N of them), as lists of (fname, snr).
+    """
+    matching = [
+        (fname, x["snr"]) for fname, x in stats.items() if int(x["nbin"]) == int(nbin)
+    ]
+    ranked = sorted(matching, key=lambda x: x[1], reverse=True)
+    return ranked, ranked[:ntop]
+
+
+def write_selection(
+    ranked, top, nbin, allfiles="template_allFiles.txt", topfile="template_50.txt"
+):
+    with open(allfiles, "w") as f:
+        for fname, snr in ranked:
+            f.write(f"{fname} {snr:.0f} {nbin}\n")
+    with open(topfile, "w") as f:
+        for fname, _ in top:
+            f.write(f"{fname}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Select the highest-S/N files with the template nbin for template creation."
+    )
+    parser.add_argument(
+        "-d",
+        "--data_directory",
+        type=str,
+        default=".",
+        help="Directory of the files to rank (the current directory by default).",
+    )
+    parser.add_argument(
+        "-e",
+        "--extension",
+        type=str,
+        default=".ftp",
+        help="Extension of the files to rank ('.ftp' by default).",
+    )
+    parser.add_argument(
+        "--nbin", type=int, required=True, help="Only select files with this nbin."
+    )
+    parser.add_argument(
+        "-n",
+        "--ntop",
+        type=int,
+        default=50,
+        help="Number of files to select (50 by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes used to measure S/N (1 by default).",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=METADATA_CACHE,
+        help=f"Metadata cache of per-file S/N ('{METADATA_CACHE}' by default).",
+    )
+    args = parser.parse_args()
+
+    files = sorted(glob(os.path.join(args.data_directory, f"*{args.extension}")))
+    stats = measure_files(files, nproc=args.nproc, cache=args.cache)
+    ranked, top = select_templates(stats, args.nbin, ntop=args.ntop)
+    if len(ranked) == 0:
+        print(f"No files found with nbin={args.nbin}. Investigate files. Exiting...")
+        exit(1)
+    write_selection(ranked, top, args.nbin)
+    if len(top) < args.ntop:
+        print(
+            f"Not enough top {args.ntop} files found with nbin={args.nbin}. Investigate template_allFiles.txt. Continuing with current list..."
+        )
+    print(f"Selected {len(top)} of {len(ranked)} files with nbin={args.nbin}.")
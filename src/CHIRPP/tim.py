@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                  Streaming tempo2 .tim reader/writer                ##
+#########################################################################
+
+Parse tempo2 .tim files into arrays a chunk of lines at a time, and write
+them back with streamed line generation, so multi-million-TOA files are
+handled in bounded memory.
+
+A TOA line is "name freq MJD error site" followed by any number of
+"-flag value" pairs. Lines starting with "#", "C " (but not "CHIME...") or a
+tempo2 command such as FORMAT or MODE are not TOAs. Within a chunk, lines are
+grouped by their flag layout, and each group is converted with whole-column
+NumPy operations instead of one float() per field.
+
+Each chunk is a TimChunk with the fixed columns as arrays (MJD as integer day
+and fraction, to keep sub-ns precision) and a dict of flag name: array of
+string values ("" where a line does not have the flag).
+
+Run from the command line with:
+python tim.py --benchmark J0000+0000.tim  # Compare with the per-line code paths
+python tim.py --synthetic 2000000 big.tim --benchmark big.tim
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+from itertools import islice
+import numpy as np
+
+# Lines parsed at once
+CHUNK_LINES = 100000
+# First tokens of tempo2 command lines
+TIM_COMMANDS = {
+    "FORMAT",
+    "MODE",
+    "INCLUDE",
+    "TIME",
+    "JUMP",
+    "EFAC",
+    "EQUAD",
+    "SKIP",
+    "NOSKIP",
+    "END",
+    "PHASE",
+    "TRACK",
+}
+
+
+def is_toa_line(line):
+    # Only the first fields are needed to tell, so don't split the flags
+    return is_toa_fields(line.split(None, 5))
+
+
+def is_toa_fields(fields):
+    if len(fields) < 5 or fields[0] in TIM_COMMANDS or fields[0].startswith("#"):
+        return False
+    # tempo2 treats lines starting with "C" as comments, but ours start with CHIME
+    return not fields[0].startswith("C") or fields[0].startswith("CHIME")
+
+
+def chime_prefix(line):
+    # Lowercase "chime" so tempo2 doesn't take lines starting with "C" for comments
+    return f"chime{line[5:]}" if line.startswith("CHIME") else line
+
+
+def toa_sort_key(line):
+    # MJD first (compared as integer day and zero-padded fraction to keep every
+    # digit), then frequency and the line itself so that ties are deterministic
+    fields = line.split()
+    day, _, frac = fields[2].partition(".")
+    return int(day), frac.ljust(20, "0"), float(fields[1]), line
+
+
+def format_mjd(imjd, frac):
+    # Two-part MJD to a string, carrying into the day if the fraction rounds up
+    digits = f"{frac:.15f}"
+    if digits.startswith("1"):
+        return f"{imjd + 1}{digits[1:]}"
+    return f"{imjd}{digits[1:]}"
+
+
+class TimChunk:
+    """Columns of a block of TOAs; flags maps "-flag" to an array of values."""
+
+    def __init__(self, name, freq, mjd_int, mjd_frac, err, site, flags=None):
+        self.name = np.asarray(name, dtype=str)
+        self.freq = np.asarray(freq, dtype=np.float64)
+        self.mjd_int = np.asarray(mjd_int, dtype=np.int64)
+        self.mjd_frac = np.asarray(mjd_frac, dtype=np.float64)
+        self.err = np.asarray(err, dtype=np.float64)
+        self.site = np.asarray(site, dtype=str)
+        self.flags = flags or {}
+
+    def __len__(self):
+        return len(self.freq)
+
+    def flag(self, name, dtype=float, missing=np.nan):
+        """Values of a flag as dtype, with missing where a TOA does not have it."""
+        values = self.flags.get(name)
+        if values is None:
+            return np.full(len(self), missing, dtype=dtype)
+        present = values != ""
+        out = np.full(len(self), missing, dtype=dtype)
+        out[present] = values[present].astype(dtype)
+        return out
+
+    @classmethod
+    def concatenate(cls, chunks):
+        chunks = list(chunks)
+        names = []
+        for chunk in chunks:
+            names += [x for x in chunk.flags if x not in names]
+        flags = {
+            x: np.concatenate(
+                [c.flags.get(x, np.full(len(c), "", dtype="U1")) for c in chunks]
+            )
+            for x in names
+        }
+        columns = [
+            np.concatenate([getattr(c, attr) for c in chunks])
+            for attr in ["name", "freq", "mjd_int", "mjd_frac", "err", "site"]
+        ]
+        return cls(*columns, flags=flags)
+
+
+def parse_lines(lines):
+    """TimChunk of the TOA lines among lines."""
+    rows = [fields for fields in map(str.split, lines) if is_toa_fields(fields)]
+    n = len(rows)
+    day, frac = zip(*(r[2].partition(".")[::2] for r in rows)) if n else ((), ())
+    flags = {}
+    # Lines with the same flags in the same order share column positions
+    layouts = {}
+    for i, fields in enumerate(rows):
+        layouts.setdefault(tuple(fields[5::2]), []).append(i)
+    for layout, idx in layouts.items():
+        group = rows if len(layouts) == 1 else [rows[i] for i in idx]
+        for j, flag in enumerate(layout):
+            k = 6 + 2 * j
+            if not flag.startswith("-") or k >= len(group[0]):
+                continue
+            if flag not in flags:
+                flags[flag] = np.full(n, "", dtype=object)
+            flags[flag][idx] = [fields[k] for fields in group]
+    return TimChunk(
+        [r[0] for r in rows],
+        np.array([r[1] for r in rows], dtype=np.float64),
+        np.array(day, dtype=np.int64),
+        np.array([f"0.{x}" for x in frac], dtype=np.float64),
+        np.array([r[3] for r in rows], dtype=np.float64),
+        [r[4] for r in rows],
+        flags={x: v.astype(str) for x, v in flags.items()},
+    )
+
+
+def iter_blocks(fname, chunk_lines=CHUNK_LINES):
+    """Lists of (at most chunk_lines) lines of a file, with their newlines."""
+    with open(fname, "r") as f:
+        while True:
+            block = list(islice(f, chunk_lines))
+            if not block:
+                return
+            yield block
+
+
+def iter_tim(fname, chunk_lines=CHUNK_LINES):
+    """Yield a TimChunk for every chunk_lines lines of a .tim file."""
+    for block in iter_blocks(fname, chunk_lines):
+        yield parse_lines(block)
+
+
+def read_tim(fname, chunk_lines=CHUNK_LINES):
+    """The whole .tim as one TimChunk."""
+    return TimChunk.concatenate(iter_tim(fname, chunk_lines))
+
+
+def read_flag(fname, flag, dtype=float, missing=np.nan, chunk_lines=CHUNK_LINES):
+    """
+    One flag's values for every TOA of a .tim, only ever holding one chunk of
+    lines. Only the flag is parsed, not the other columns.
+    """
+    values = [np.zeros(0, dtype=dtype)]
+    for block in iter_blocks(fname, chunk_lines):
+        strings = []
+        for line in block:
+            if is_toa_line(line):
+                _, found, rest = line.partition(f" {flag} ")
+                value = rest.split(None, 1)[:1] if found else []
+                strings.append(value[0] if value else None)
+        values.append(_flag_values(strings, dtype, missing))
+    return np.concatenate(values)
+
+
+def _flag_values(strings, dtype, missing):
+    out = np.full(len(strings), missing, dtype=dtype)
+    present = [i for i, x in enumerate(strings) if x is not None]
+    out[present] = np.array([strings[i] for i in present]).astype(dtype)
+    return out
+
+
+def format_lines(chunk, rename=True):
+    """tempo2 lines (without newlines) of a TimChunk."""
+    names = chunk.name.tolist()
+    if rename:
+        names = [chime_prefix(x) for x in names]
+    columns = [
+        names,
+        [f"{x:.6f}" for x in chunk.freq.tolist()],
+        [
+            format_mjd(day, frac)
+            for day, frac in zip(chunk.mjd_int.tolist(), chunk.mjd_frac.tolist())
+        ],
+        [f"{x:.3f}" for x in chunk.err.tolist()],
+        chunk.site.tolist(),
+    ]
+    for flag, values in chunk.flags.items():
+        columns.append([f" {flag} {x}" if x else "" for x in values.tolist()])
+    return [
+        f"{name} {freq} {mjd} {err} {site}{''.join(flags)}"
+        for name, freq, mjd, err, site, *flags in zip(*columns)
+    ]
+
+
+def write_tim(chunks, out, rename=True, header=True):
+    """Write TimChunks to the stream out, one chunk's lines at a time. Returns the number of TOAs."""
+    if header:
+        out.write("FORMAT 1\n")
+    ntoa = 0
+    for chunk in chunks:
+        lines = format_lines(chunk, rename=rename)
+        if lines:
+            out.write("\n".join(lines) + "\n")
+        ntoa += len(lines)
+    return ntoa
+
+
+def copy_toas(src, out, rename=True):
+    """Stream the TOA lines of src to out (renaming CHIME TOAs). Returns the number of TOAs."""
+    ntoa = 0
+    for block in iter_blocks(src):
+        lines = [line for line in block if is_toa_line(line)]
+        if rename:
+            lines = [chime_prefix(line) for line in lines]
+        # Only the file's last line can lack its newline
+        if lines and not lines[-1].endswith("\n"):
+            lines[-1] += "\n"
+        out.write("".join(lines))
+        ntoa += len(lines)
+    return ntoa
+
+
+def rename_toas(fname):
+    """
+    Rename CHIME TOAs to chime in place, streaming through a temporary file.
+    Other lines are kept as they are.
+    """
+    tmp = f"{fname}.tmp"
+    with open(tmp, "w") as out:
+        for block in iter_blocks(fname):
+            out.write("".join(chime_prefix(line) for line in block))
+    os.replace(tmp, fname)
+
+
+def _legacy_snrs(timfile):
+    # get_snr_pct()'s per-line parse before this module
+    tim = open(timfile, "r")
+    tfr = tim.read()
+    tim.close()
+    snrs = np.array(
+        [
+            float(line.split("-snr")[1].split()[0])
+            for line in tfr.split("\n")
+            if "-snr" in line and (not line.startswith("C") or line.startswith("CHIME"))
+        ]
+    )
+    return np.array([x for x in snrs if not np.isnan(x)])
+
+
+def _legacy_rename(timfile, outfile):
+    # make_tim()'s rewrite before this module
+    tim = open(timfile, "r")
+    tfr = tim.read()
+    tim.close()
+    newlines = [
+        f"chime{x.lstrip('CHIME')}\n" if x.startswith("CHIME") else f"{x}\n"
+        for x in tfr.split("\n")
+    ]
+    with open(outfile, "w") as f:
+        for newline in newlines:
+            f.write(newline)
+
+
+def _measure(label, func, *args):
+    # Timed on its own, then run again under tracemalloc for the peak memory
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"    {label:45s} {elapsed:8.2f} s {peak / 2**20:9.1f} MiB peak")
+    return result
+
+
+def benchmark(timfile):
+    """Time the per-line code paths against this module's on timfile."""
+    tmp = f"{timfile}.bench"
+    size = os.path.getsize(timfile) / 2**20
+    print(f"{timfile}: {size:.1f} MiB")
+    print("S/N of every TOA (get_snr_pct):")
+    old = _measure("per-line split (old)", _legacy_snrs, timfile)
+    new = _measure("read_flag", read_flag, timfile, "-snr")
+    new = new[~np.isnan(new)]
+    print(f"    same values: {len(old) == len(new) and np.allclose(old, new)}")
+    print("Rename CHIME TOAs (make_tim, new_data):")
+    _measure("read, split and rewrite (old)", _legacy_rename, timfile, tmp)
+    with open(tmp, "w") as out:
+        _measure("copy_toas", copy_toas, timfile, out)
+    print("Parse every column and write back:")
+    chunks = _measure("read_tim", read_tim, timfile)
+    with open(tmp, "w") as out:
+        _measure("write_tim", write_tim, [chunks], out)
+
+    def roundtrip():
+        with open(tmp, "w") as out:
+            return write_tim(iter_tim(timfile), out)
+
+    _measure("iter_tim -> write_tim (streamed)", roundtrip)
+    os.remove(tmp)
+
+
+def write_synthetic(fname, ntoa, seed=0):
+    """A .tim of ntoa random CHIME-like TOAs, for benchmarks."""
+    rng = np.random.default_rng(seed)
+    per_file = 64
+    with open(fname, "w") as out:
+        out.write("FORMAT 1\n")
+        for start in range(0, ntoa, CHUNK_LINES):
+            n = min(CHUNK_LINES, ntoa - start)
+            i = np.arange(start, start + n)
+            chunk = TimChunk(
+                np.char.add("CHIME_", np.char.mod("%08d.ftp", i // per_file)),
+                400.0 + 400.0 * ((i % per_file) + 0.5) / per_file,
+                58000 + i // per_file,
+                rng.random(n),
+                rng.gamma(2.0, 2.0, n),
+                np.full(n, "CH"),
+                flags={
+                    "-chan": np.char.mod("%d", i % per_file),
+                    "-subint": np.full(n, "0"),
+                    "-snr": np.char.mod("%.3f", rng.gamma(3.0, 5.0, n)),
+                    "-wt": np.full(n, "1"),
+                    "-f": np.full(n, "CHIME"),
+                    "-be": np.full(n, "CHIME"),
+                    "-fe": np.full(n, "Rcvr_CHIME"),
+                },
+            )
+            write_tim([chunk], out, rename=False, header=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Streaming .tim parsing and writing: benchmark against the per-line code paths."
+    )
+    parser.add_argument(
+        "--synthetic",
+        nargs=2,
+        metavar=("NTOA", "TIM"),
+        default=None,
+        help="First write a synthetic .tim of NTOA TOAs to TIM.",
+    )
+    parser.add_argument(
+        "--benchmark", type=str, default=None, help=".tim file to benchmark on."
+    )
+    args = parser.parse_args()
+
+    if args.synthetic:
+        write_synthetic(args.synthetic[1], int(args.synthetic[0]))
+        print(f"Wrote {args.synthetic[0]} TOAs to {args.synthetic[1]}.")
+    if args.benchmark:
+        benchmark(args.benchmark)
@@ -5,35 +5,95 @@ import pint_pal.dmx_utils as du
 import pint_pal.lite_utils as lu
 # import pint_pal.noise_utils as nu
 import pint_pal.plot_utils as pu
+import pint_pal.timingconfiguration
 from pint_pal.timingconfiguration import TimingConfiguration
 from pint.fitter import ConvergenceFailure
 # import pint.fitter
 # from pint.utils import dmxparse
 from astropy.visualization import quantity_support
+from datetime import date
+from pint_cache import cached_toas, file_sha1
+import incremental_fit as inc
 
 quantity_support()
 
 
-def update_timing(config, par_directory=None, tim_directory=None, plots=False):
+def update_timing(
+    config,
+    par_directory=None,
+    tim_directory=None,
+    plots=False,
+    pint_cache=None,
+    incremental=False,
+    quick=False,
+    fit_state=None,
+):
     tc = TimingConfiguration(
         config, par_directory=par_directory, tim_directory=tim_directory
     )
-    mo, to = tc.get_model_and_toas(excised=False, usepickle=False)
-    to.compute_pulse_numbers(mo)
-    # Ensure DMX windows are calculated properly, set non-binary epochs to the center of the data span
-    to = du.setup_dmx(
-        mo, to, frequency_ratio=tc.get_fratio(), max_delta_t=tc.get_sw_delay()
-    )
-    lu.center_epochs(mo, to)
+    # Prepared TOAs are reused from pint_cache if given (see pint_cache.py)
+    with cached_toas(pint_cache, modules=[pint_pal.timingconfiguration]):
+        mo, to = tc.get_model_and_toas(excised=False, usepickle=False)
+    # With incremental, start from the last fit (see incremental_fit.py)
+    fit_state = fit_state or inc.state_path(tc)
+    state = inc.load_fit_state(fit_state) if incremental else None
+    if incremental and state is None:
+        print(f"No fit state in {fit_state}: fitting all TOAs.")
+    elif state is not None and not inc.state_matches(state, tc.get_model_path()):
+        print(f"{tc.get_model_path()} is not the last fit's: fitting all TOAs.")
+        state = None
+    if state is None:
+        to.compute_pulse_numbers(mo)
+        # Ensure DMX windows are calculated properly, set non-binary epochs to the center of the data span
+        to = du.setup_dmx(
+            mo, to, frequency_ratio=tc.get_fratio(), max_delta_t=tc.get_sw_delay()
+        )
+        lu.center_epochs(mo, to)
+    else:
+        # Warm start: the last fit's model, epochs and DMX windows
+        mo = inc.warm_model(state)
+        to.compute_pulse_numbers(mo)
+        to, nwindows = inc.add_new_dmx(
+            mo,
+            to,
+            inc.new_toas(to, state),
+            frequency_ratio=tc.get_fratio(),
+            max_delta_t=tc.get_sw_delay(),
+        )
+        new = inc.new_toas(to, state)
+        print(f"{new.sum()} new TOAs of {len(to)}; {nwindows} DMX windows added.")
     fo = tc.construct_fitter(to, mo)
     fo.model.free_params = tc.get_free_params(fo)
     # lu.check_fit(fo, skip_check=tc.skip_check)
-    try:
-        fo.fit_toas(maxiter=tc.get_niter())
+    converged = True
+    if state is not None and quick:
+        if new.any():
+            params, cov = inc.sequential_update(
+                fo.model, to, new, state["params"].tolist(), state["cov"]
+            )
+        else:
+            params, cov = state["params"].tolist(), state["cov"]
+        fo.update_resids()
         fo.model.CHI2.value = fo.resids.chi2
-    except ConvergenceFailure:
-        print("Fitter failed to converge.")
-    lu.write_par(fo, toatype=tc.get_toa_type(), addext="_prenoise", include_date=True)
+    else:
+        try:
+            fo.fit_toas(maxiter=tc.get_niter())
+            fo.model.CHI2.value = fo.resids.chi2
+            params, cov = inc.fit_covariance(fo)
+        except ConvergenceFailure:
+            print("Fitter failed to converge.")
+            converged = False
+    addext = "_quicklook" if state is not None and quick else "_prenoise"
+    # write_par's default name, which the fit state refers to
+    parfile = f"{fo.model.PSR.value}_PINT_{date.today().strftime('%Y%m%d')}"
+    parfile += f"{addext}.{tc.get_toa_type().lower()}.par"
+    lu.write_par(fo, outfile=parfile)
+    if incremental and converged:
+        # Valid for the configured .par and the one written, either of which
+        # the next run may start from
+        par_sha = [file_sha1(tc.get_model_path()), file_sha1(parfile)]
+        inc.save_fit_state(fit_state, fo.model, to, params, cov, par_sha)
+        print(f"Fit state saved to {fit_state}.")
     if plots:
         pu.plot_residuals(fo, to, tc.get_toa_type(), title="Post-Fit Residuals")
         pu.plot_dmx(fo, to, tc.get_toa_type(), title="Post-Fit DMX")
@@ -63,6 +123,26 @@ if __name__ == "__main__":
         help="Generate residual & DMX plots after fitting.",
         action="store_true",
     )
+    parser.add_argument(
+        "--pint_cache",
+        help="Directory in which to cache the prepared TOAs, so that only new TOAs are prepared in later runs. If not provided, TOAs are not cached.",
+        default=None,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Start from the last fit's solution, keeping its epochs and DMX windows and only adding windows for new TOAs (see incremental_fit.py). All TOAs are fit if there is no saved fit or the .par has changed.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--quick",
+        help="With --incremental, update the last fit with the new TOAs by one linear (Kalman) step instead of running the fitter, and write a _quicklook .par.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--fit_state",
+        help="File of the last fit's solution for --incremental. If not provided, uses <source>.nb_fit.npz.",
+        default=None,
+    )
     args = parser.parse_args()
 
     update_timing(
@@ -70,4 +150,8 @@ if __name__ == "__main__":
         par_directory=args.par_directory,
         tim_directory=args.tim_directory,
         plots=args.plots,
+        pint_cache=args.pint_cache,
+        incremental=args.incremental,
+        quick=args.quick,
+        fit_state=args.fit_state,
     )
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                   Content-keyed TOA cache                           ##
+#########################################################################
+
+Generate a .tim like tim_run.sh does, but only compute the TOAs that are not
+already cached. Each file's TOAs are stored in toa_cache/ under a key made of
+the file's content hash, the template's content hash, the file's number of
+subbands and subints, the TOA engine and its options. Re-running after new
+data arrive, or after any change that leaves those alone, only times the new
+or changed files. The flags from tim_flags (-X) are not part of the key: they
+are appended as the .tim is assembled.
+
+Every cache entry is sorted by MJD, and the .tim is assembled by a k-way merge
+of the entries in MJD order, which only holds the entries that overlap in
+time open at once. With --append, the TOAs of an existing .tim are merged in
+too, and files that already have TOAs there are not added again. TOAs are
+renamed from CHIME... to chime... in the same pass.
+
+Content hashes are remembered per file (by size and mtime) in
+toa_cache/hashes.json, so unchanged files are not read again.
+
+Run from the command line with:
+python toa_cache.py --engine native -j 8 -e .ftp -X "-f CHIME -be CHIME -fe Rcvr_CHIME" -s template.sm > toas.tim
+python toa_cache.py --engine pat -j 8 -s template.sm --append old.tim > all.tim  # Only times files not in old.tim
+"""
+
+import argparse
+import hashlib
+import heapq
+import json
+import os
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from itertools import count
+from pat_shards import (
+    balance_shards,
+    chime_prefix,
+    is_toa_line,
+    run_shard,
+    toa_sort_key,
+)
+from psrfits import open_archive
+from toas import PAT_OPTIONS, SITE, iter_file_toas
+
+CACHE_DIR = "toa_cache"
+HASH_INDEX = "hashes.json"
+# Bump to invalidate every entry, e.g. when the native fit changes
+CACHE_VERSION = 2
+ENGINES = ["native", "pat", "pat_sharded"]
+
+
+def content_hash(fname, blocksize=1 << 20):
+    sha = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_index(cache_dir):
+    index = os.path.join(cache_dir, HASH_INDEX)
+    if os.path.exists(index):
+        with open(index, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def save_index(entries, cache_dir):
+    index = os.path.join(cache_dir, HASH_INDEX)
+    tmp = f"{index}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(entries, f, indent=1)
+    os.replace(tmp, index)
+
+
+def file_hashes(files, cache_dir=CACHE_DIR):
+    """
+    Dict of fname: {"sha1", "nchan", "nsub"}, only hashing (and opening) files
+    that are new or have changed since the last call.
+    """
+    entries = load_index(cache_dir)
+    results = {}
+    changed = False
+    for fname in files:
+        st = os.stat(fname)
+        key = os.path.abspath(fname)
+        entry = entries.get(key)
+        if not (
+            entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime
+        ):
+            with open_archive(fname) as ar:
+                nchan, nsub = int(ar.nchan), int(ar.nsub)
+            entry = {
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "sha1": content_hash(fname),
+                "nchan": nchan,
+                "nsub": nsub,
+            }
+            entries[key] = entry
+            changed = True
+        results[fname] = entry
+    if changed:
+        save_index(entries, cache_dir)
+    return results
+
+
+def engine_options(engine, site=SITE):
+    # pat and its sharded runs give the same TOAs, so they share entries
+    if engine == "native":
+        return f"toas.py site={site}"
+    return f"pat {PAT_OPTIONS}"
+
+
+def entry_key(fname, entry, template_sha, engine, site=SITE):
+    text = " ".join(
+        str(x)
+        for x in [
+            CACHE_VERSION,
+            fname,
+            entry["sha1"],
+            template_sha,
+            entry["nchan"],
+            entry["nsub"],
+            engine_options(engine, site),
+        ]
+    )
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def entry_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, key[:2], f"{key}.tim")
+
+
+def write_entry(path, lines):
+    # Entries are sorted by MJD so they can be merged without re-sorting
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write("".join(f"{line}\n" for line in sorted(lines, key=toa_sort_key)))
+    os.replace(tmp, path)
+
+
+def compute_toas(files, template, engine="native", nproc=1, site=SITE):
+    """Yield (fname, TOA lines without extra flags, error) for every file."""
+    if len(files) == 0:
+        return
+    if engine == "native":
+        yield from iter_file_toas(files, template, nproc=nproc, site=site)
+        return
+    # pat writes the TOAs of a whole shard; split them up by file name
+    shards = balance_shards(files, nproc)
+    with tempfile.TemporaryDirectory(dir=".") as shard_dir, ThreadPoolExecutor(
+        max_workers=max(1, nproc)
+    ) as pool:
+        jobs = [(i, shard, template, "", shard_dir) for i, shard in enumerate(shards)]
+        for shard, (timfile, _, error) in zip(shards, pool.map(run_shard, jobs)):
+            if error:
+                for fname in shard:
+                    yield fname, [], error
+                continue
+            by_file = {fname: [] for fname in shard}
+            with open(timfile, "r") as f:
+                for line in f:
+                    line = line.rstrip("\n")
+                    by_file.setdefault(line.split()[0], []).append(line)
+            for fname in shard:
+                yield fname, by_file[fname], None
+
+
+def first_key(path):
+    # Sort key of the earliest TOA of an entry (or None if it has none)
+    with open(path, "r") as f:
+        line = f.readline().rstrip("\n")
+    return toa_sort_key(line) if line else None
+
+
+def _entry_lines(path, extra):
+    with open(path, "r") as f:
+        for line in f:
+            yield f"{line.rstrip()}{extra}"
+
+
+def merge_sorted(sources):
+    """
+    k-way merge of sorted line streams by MJD. sources are (first key, opener)
+    pairs, where opener() returns the stream; streams are only opened once the
+    merge reaches their first TOA, so few are open at once.
+    """
+    pending = sorted(
+        ((key, i, opener) for i, (key, opener) in enumerate(sources) if key),
+        key=lambda x: x[:2],
+        reverse=True,
+    )
+    heap = []
+    tiebreak = count()
+
+    def push(heap, line, stream):
+        heapq.heappush(heap, (toa_sort_key(line), next(tiebreak), line, stream))
+
+    while heap or pending:
+        while pending and (not heap or pending[-1][0] <= heap[0][0]):
+            _, _, opener = pending.pop()
+            stream = iter(opener())
+            line = next(stream, None)
+            if line is not None:
+                push(heap, line, stream)
+        if not heap:
+            break
+        _, _, line, stream = heapq.heappop(heap)
+        yield line
+        line = next(stream, None)
+        if line is not None:
+            push(heap, line, stream)
+
+
+def read_tim(fname):
+    """TOA lines of a .tim file, sorted by MJD."""
+    with open(fname, "r") as f:
+        return sorted(
+            (line.rstrip("\n") for line in f if is_toa_line(line)), key=toa_sort_key
+        )
+
+
+def write_merged(sources, out):
+    out.write("FORMAT 1\n")
+    ntoa = 0
+    for line in merge_sorted(sources):
+        out.write(f"{chime_prefix(line)}\n")
+        ntoa += 1
+    return ntoa
+
+
+def merge_tim_files(timfiles, out):
+    """
+    Merge .tim files into out in MJD order. A file's TOAs are only taken from
+    the first .tim that has any for it. Returns the number of TOAs.
+    """
+    sources = []
+    present = set()
+    for timfile in timfiles:
+        lines = read_tim(timfile)
+        names = {chime_prefix(line.split()[0]) for line in lines}
+        lines = [
+            line for line in lines if chime_prefix(line.split()[0]) not in present
+        ]
+        present |= names
+        if lines:
+            sources.append((toa_sort_key(lines[0]), lambda lines=lines: lines))
+    return write_merged(sources, out)
+
+
+def cached_tim(
+    files,
+    template,
+    engine="native",
+    nproc=1,
+    site=SITE,
+    extra_flags="",
+    cache_dir=CACHE_DIR,
+    append=None,
+    out=sys.stdout,
+):
+    """
+    Write the .tim of files (merged with the .tim append, if given) to out,
+    computing only TOAs that are not cached. Returns a dict of counts and the
+    list of (fname, error) for files that failed.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    sources = []
+    present = set()
+    if append:
+        existing = read_tim(append)
+        present = {chime_prefix(line.split()[0]) for line in existing}
+        if existing:
+            sources.append((toa_sort_key(existing[0]), lambda: existing))
+    duplicates = [f for f in files if chime_prefix(f) in present]
+    files = [f for f in files if chime_prefix(f) not in present]
+
+    template_sha = content_hash(template)
+    hashes = file_hashes(files, cache_dir)
+    paths = {
+        fname: entry_path(
+            entry_key(fname, hashes[fname], template_sha, engine, site), cache_dir
+        )
+        for fname in files
+    }
+    missing = [fname for fname in files if not os.path.exists(paths[fname])]
+    failed = []
+    for fname, lines, error in compute_toas(missing, template, engine, nproc, site):
+        if error:
+            failed.append((fname, error))
+            continue
+        write_entry(paths[fname], lines)
+
+    extra = f" {extra_flags.strip()}" if extra_flags.strip() else ""
+    for fname in files:
+        if os.path.exists(paths[fname]):
+            path = paths[fname]
+            sources.append((first_key(path), lambda p=path: _entry_lines(p, extra)))
+    counts = {
+        "toas": write_merged(sources, out),
+        "cached": len(files) - len(missing),
+        "computed": len(missing) - len(failed),
+        "duplicates": len(duplicates),
+    }
+    return counts, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate a .tim, only timing files whose TOAs are not already cached."
+    )
+    parser.add_argument(
+        "-d",
+        "--data_directory",
+        type=str,
+        default=".",
+        help="Directory of the files (the current directory by default).",
+    )
+    parser.add_argument(
+        "-e",
+        "--extension",
+        type=str,
+        default=".ftp",
+        help="Extension of the files to time ('.ftp' by default).",
+    )
+    parser.add_argument(
+        "-s", "--template", type=str, required=True, help="Standard template profile."
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="pat",
+        help="TOA engine for files that are not cached ('pat' by default).",
+    )
+    parser.add_argument(
+        "-X",
+        "--extra_flags",
+        type=str,
+        default="",
+        help="Flags appended to every new TOA line, as with pat -X.",
+    )
+    parser.add_argument(
+        "--site",
+        type=str,
+        default=SITE,
+        help=f"Observatory code of native TOAs ('{SITE}' by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes timing files (1 by default).",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=CACHE_DIR,
+        help=f"Directory of the cache ('{CACHE_DIR}' by default).",
+    )
+    parser.add_argument(
+        "--append",
+        type=str,
+        default=None,
+        help="Existing .tim to merge the TOAs into; files that already have TOAs there are skipped.",
+    )
+    args = parser.parse_args()
+
+    # normpath drops a leading "./", so TOAs are named like pat's would be
+    files = sorted(
+        glob(os.path.normpath(os.path.join(args.data_directory, f"*{args.extension}")))
+    )
+    if len(files) == 0 and not args.append:
+        print(
+            f"error: no *{args.extension} files in {args.data_directory}!",
+            file=sys.stderr,
+        )
+        exit(1)
+    counts, failed = cached_tim(
+        files,
+        args.template,
+        engine=args.engine,
+        nproc=args.nproc,
+        site=args.site,
+        extra_flags=args.extra_flags,
+        cache_dir=args.cache_dir,
+        append=args.append,
+    )
+    for fname, error in failed:
+        print(f"warning: no TOAs from {fname}: {error}", file=sys.stderr)
+    summary = f"{counts['toas']} TOAs: {counts['cached']} files from the cache, {counts['computed']} timed, "
+    if args.append:
+        summary += f"{counts['duplicates']} already in {args.append}, "
+    print(f"{summary}{len(failed)} failed.", file=sys.stderr)
+    if failed and len(failed) == len(files):
+        exit(1)
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                     Columnar TOA store                              ##
+#########################################################################
+
+TOAs as a NumPy structured array, one row per TOA, saved as <store>.npy (which
+can be memory-mapped) next to <store>.strings.npy. Columns:
+    file, site, flags   indices into the strings table
+    freq                MHz
+    mjd_int, mjd_frac   MJD as integer day and fraction, to keep sub-ns precision
+    err                 us
+    snr, wt             from -snr and -wt (NaN if missing)
+    subint, chan        from -subint and -chan (-1 if missing)
+Any other flags are kept, as one string per distinct set, in "flags".
+
+Rows are kept sorted by MJD, so MJD ranges are selected by binary search;
+frequency and S/N cuts are vectorized masks. Stores are built from, and
+exported to, tempo2 .tim files.
+
+Run from the command line with:
+python toa_store.py build J0000+0000.tim -o J0000+0000.npy
+python toa_store.py export J0000+0000.npy --min_snr 8 --mjd 59000 59500 > cut.tim
+python toa_store.py merge old.npy new.npy -o all.npy  # Skips files already in old.npy
+python toa_store.py stats J0000+0000.npy
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from tim import TimChunk, chime_prefix, format_lines, iter_tim
+
+TOA_DTYPE = np.dtype(
+    [
+        ("file", np.int32),
+        ("freq", np.float64),
+        ("mjd_int", np.int64),
+        ("mjd_frac", np.float64),
+        ("err", np.float64),
+        ("site", np.int32),
+        ("snr", np.float64),
+        ("wt", np.float64),
+        ("subint", np.int32),
+        ("chan", np.int32),
+        ("flags", np.int32),
+    ]
+)
+# Flags stored in their own columns
+COLUMN_FLAGS = {"-snr": "snr", "-wt": "wt", "-subint": "subint", "-chan": "chan"}
+# Lines parsed or written at once
+CHUNK_LINES = 100000
+
+
+def strings_name(path):
+    return f"{os.path.splitext(path)[0]}.strings.npy"
+
+
+def mjd_sort_order(toas):
+    return np.lexsort((toas["freq"], toas["mjd_frac"], toas["mjd_int"]))
+
+
+class TOAStore:
+    """
+    A table of TOAs: toas is a structured array of TOA_DTYPE sorted by MJD,
+    strings the table that its file, site and flags columns index.
+    """
+
+    def __init__(self, toas, strings):
+        self.toas = toas
+        self.strings = np.asarray(strings)
+
+    def __len__(self):
+        return len(self.toas)
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Build a store from TimChunks (see tim.py)."""
+        lookup = {}
+        tables = []
+        for chunk in chunks:
+            toas = np.zeros(len(chunk), dtype=TOA_DTYPE)
+            toas["file"] = [lookup.setdefault(x, len(lookup)) for x in chunk.name]
+            toas["site"] = [lookup.setdefault(x, len(lookup)) for x in chunk.site]
+            for column in ["freq", "mjd_int", "mjd_frac", "err"]:
+                toas[column] = getattr(chunk, column)
+            for flag, column in COLUMN_FLAGS.items():
+                if column in ["snr", "wt"]:
+                    toas[column] = chunk.flag(flag)
+                else:
+                    toas[column] = chunk.flag(flag, dtype=np.int32, missing=-1)
+            extra = [
+                [f"{flag} {x}" if x else "" for x in values.tolist()]
+                for flag, values in chunk.flags.items()
+                if flag not in COLUMN_FLAGS
+            ]
+            rows = zip(*extra) if extra else [()] * len(chunk)
+            toas["flags"] = [
+                lookup.setdefault(" ".join(x for x in row if x), len(lookup))
+                for row in rows
+            ]
+            tables.append(toas)
+        toas = np.concatenate([np.zeros(0, dtype=TOA_DTYPE)] + tables)
+        strings = np.array(list(lookup), dtype=str)
+        return cls(toas[mjd_sort_order(toas)], strings)
+
+    @classmethod
+    def from_tim(cls, fname):
+        return cls.from_chunks(iter_tim(fname, CHUNK_LINES))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a store saved with save(); the TOA table is memory-mapped by default."""
+        toas = np.load(path, mmap_mode="r" if mmap else None)
+        return cls(toas, np.load(strings_name(path)))
+
+    def save(self, path):
+        np.save(path, np.asarray(self.toas))
+        np.save(strings_name(path), self.strings)
+        return path
+
+    @property
+    def mjd(self):
+        """MJDs as float64 (about 1 us precision); use mjd_int and mjd_frac for more."""
+        return self.toas["mjd_int"] + self.toas["mjd_frac"]
+
+    @property
+    def files(self):
+        return self.strings[self.toas["file"]]
+
+    def subset(self, index):
+        return TOAStore(self.toas[index], self.strings)
+
+    def mjd_slice(self, start=None, stop=None):
+        """Rows with start <= MJD < stop, by binary search on the sorted MJDs."""
+        mjd = self.mjd
+        lo = 0 if start is None else np.searchsorted(mjd, start, side="left")
+        hi = len(mjd) if stop is None else np.searchsorted(mjd, stop, side="left")
+        return slice(lo, hi)
+
+    def select(self, mjd=None, freq=None, min_snr=None):
+        """
+        TOAs with MJD in [mjd[0], mjd[1]), frequency in [freq[0], freq[1]) and
+        S/N >= min_snr (any of them None for no cut).
+        """
+        rows = self.subset(self.mjd_slice(*mjd) if mjd else slice(None))
+        mask = np.ones(len(rows), dtype=bool)
+        if freq:
+            mask &= (rows.toas["freq"] >= freq[0]) & (rows.toas["freq"] < freq[1])
+        if min_snr is not None:
+            mask &= rows.toas["snr"] >= min_snr
+        return rows.subset(mask)
+
+    def merge(self, other):
+        """
+        This store plus the TOAs of other from files that have none here, still
+        sorted by MJD. File names are compared as written to a .tim.
+        """
+        present = {chime_prefix(str(x)) for x in np.unique(self.files)}
+        new = ~np.isin(
+            np.array([chime_prefix(str(x)) for x in other.strings]), list(present)
+        )[other.toas["file"]]
+        # Re-index other's strings into a combined table
+        strings = list(self.strings)
+        lookup = {s: i for i, s in enumerate(strings)}
+        remap = np.array(
+            [lookup.setdefault(s, len(lookup)) for s in other.strings], dtype=np.int32
+        )
+        strings = list(lookup)
+        added = np.array(other.toas[new])
+        for column in ["file", "site", "flags"]:
+            added[column] = remap[added[column]]
+        toas = np.concatenate([np.asarray(self.toas), added])
+        return TOAStore(toas[mjd_sort_order(toas)], np.array(strings, dtype=str))
+
+    def iter_lines(self, chunk=CHUNK_LINES):
+        """tempo2 .tim lines, with CHIME TOAs renamed to chime."""
+        for start in range(0, len(self.toas), chunk):
+            rows = self.toas[start : start + chunk]
+            flags = {}
+            # In the order pat writes them
+            for flag in ["-chan", "-subint", "-snr", "-wt"]:
+                values = rows[COLUMN_FLAGS[flag]]
+                if flag in ["-snr", "-wt"]:
+                    present = np.isfinite(values)
+                    text = [f"{x:g}" for x in values.tolist()]
+                else:
+                    present = values >= 0
+                    text = [str(x) for x in values.tolist()]
+                flags[flag] = np.where(present, text, "")
+            lines = format_lines(
+                TimChunk(
+                    self.strings[rows["file"]],
+                    rows["freq"],
+                    rows["mjd_int"],
+                    rows["mjd_frac"],
+                    rows["err"],
+                    self.strings[rows["site"]],
+                    flags=flags,
+                )
+            )
+            for line, extra in zip(lines, self.strings[rows["flags"]].tolist()):
+                yield f"{line} {extra}" if extra else line
+
+    def to_tim(self, out=sys.stdout):
+        out.write("FORMAT 1\n")
+        for line in self.iter_lines():
+            out.write(f"{line}\n")
+        return len(self)
+
+
+def load_store(fname):
+    """A TOAStore from a saved .npy store or from a .tim file."""
+    if fname.endswith(".npy"):
+        return TOAStore.load(fname)
+    return TOAStore.from_tim(fname)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build, query, merge and export columnar TOA stores."
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Build a store from a .tim file.")
+    build.add_argument("tim", help=".tim file.")
+    build.add_argument("-o", "--output", required=True, help="Store to write (.npy).")
+    export = sub.add_parser(
+        "export", help="Write (a selection of) a store as a .tim to stdout."
+    )
+    stats = sub.add_parser(
+        "stats", help="Print the number of TOAs and S/N percentiles."
+    )
+    for p in [export, stats]:
+        p.add_argument("store", help="Store (.npy) or .tim file.")
+        p.add_argument(
+            "--mjd",
+            nargs=2,
+            type=float,
+            default=None,
+            help="Only TOAs in this MJD range.",
+        )
+        p.add_argument(
+            "--freq",
+            nargs=2,
+            type=float,
+            default=None,
+            help="Only TOAs in this frequency range (MHz).",
+        )
+        p.add_argument(
+            "--min_snr",
+            type=float,
+            default=None,
+            help="Only TOAs with at least this S/N.",
+        )
+    merge = sub.add_parser(
+        "merge", help="Add TOAs of files that are not yet in the first store."
+    )
+    merge.add_argument("stores", nargs="+", help="Stores (.npy) or .tim files.")
+    merge.add_argument("-o", "--output", required=True, help="Store to write (.npy).")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        store = TOAStore.from_tim(args.tim)
+        store.save(args.output)
+        print(f"{len(store)} TOAs written to {args.output}.")
+    elif args.command == "merge":
+        store = load_store(args.stores[0])
+        for fname in args.stores[1:]:
+            store = store.merge(load_store(fname))
+        store.save(args.output)
+        print(f"{len(store)} TOAs written to {args.output}.")
+    else:
+        store = load_store(args.store).select(
+            mjd=args.mjd, freq=args.freq, min_snr=args.min_snr
+        )
+        if args.command == "export":
+            store.to_tim()
+        else:
+            snrs = store.toas["snr"][np.isfinite(store.toas["snr"])]
+            print(f"{len(store)} TOAs from {len(np.unique(store.toas['file']))} files.")
+            if len(snrs) > 0:
+                pct = np.percentile(snrs, [5, 25, 50, 75, 95])
+                print(
+                    "S/N percentiles (5, 25, 50, 75, 95): "
+                    + ", ".join(f"{x:.2f}" for x in pct)
+                )
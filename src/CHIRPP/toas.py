@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                  In-process Fourier-domain TOAs                     ##
+#########################################################################
+
+Equivalent to
+    pat -A FDM -e mcmc=0 -C chan -C subint -C snr -C wt -f tempo2 -X "$tim_flags" -s $template *.ftp
+writing one tempo2-format TOA per subint and subband to stdout.
+
+Every (subint, subband) profile of a file is fitted at once: the profiles'
+spectra are multiplied by the conjugate template spectrum, the phase shift
+maximising the cross-correlation is found from its FFT peak and refined by
+Newton steps (the same fit as template.py), and the amplitude, S/N and phase
+uncertainty follow analytically from the Fourier-domain chi^2, as in pat's FDM
+with mcmc=0. The template spectrum is computed once and handed to every worker
+of the process pool; files are read through a memory map.
+
+As in PSRCHIVE, the TOA is the shift added to the time of phase zero of the
+folding predictor (T2PREDICT or POLYCO table) nearest the subint mid-time, not
+to the mid-time itself; files without a predictor give no TOAs.
+
+With --check_pat, pat is also run on the same files and the two sets of TOAs
+are compared (pat stays the reference implementation). This comparison has not
+yet been made on CHIME data, so new_pulsar.py does not offer this engine,
+nor xspec.py or wideband.py, which share its epochs and fit.
+
+Run from the command line with:
+python toas.py -j 8 -X "-f CHIME -be CHIME -fe Rcvr_CHIME" -s template.sm *.ftp > toas.tim
+python toas.py -s template.sm --check_pat CHIME*.ftp > /dev/null  # Compare with pat
+"""
+
+import argparse
+import subprocess
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from psrfits import open_archive, zero_phase_epochs
+from scrunch import dispersion_turns
+from snr import baseline_stats, fscrunched_profile, pscrunch
+from template import cross_spectrum_shifts
+from tim import format_mjd
+
+# Site code written to the .tim file (our par files use tempo's code for CHIME)
+SITE = "CH"
+# pat options reproduced by this module, used by --check_pat
+PAT_OPTIONS = "-A FDM -e mcmc=0 -C chan -C subint -C snr -C wt -f tempo2"
+# Template spectrum shared by the workers of the pool
+_template_spectrum = None
+
+
+def template_spectrum(fname):
+    """Spectrum of the fully scrunched total-intensity profile of a template archive."""
+    with open_archive(fname) as ar:
+        return np.fft.rfft(fscrunched_profile(ar))
+
+
+def fit_harmonics(tspec, nbin):
+    """
+    The template harmonics used to fit nbin-bin profiles: those that both the
+    profiles and the template have, with the DC term zeroed and without the
+    Nyquist harmonic.
+    """
+    nharm = min(len(tspec), nbin // 2 + 1) - 1
+    tspec = np.array(tspec[:nharm])
+    tspec[0] = 0.0
+    return tspec
+
+
+def fdm_fit(profiles, tspec):
+    """
+    Fourier-domain fit of profiles (K, nbin) to a template with spectrum tspec.
+    Returns the shifts (turns; a positive shift means the pulse arrives late),
+    their uncertainties (turns) and the matched-filter S/N of each profile.
+    """
+    profiles = np.asarray(profiles, dtype=np.float64)
+    nbin = profiles.shape[-1]
+    tspec = fit_harmonics(tspec, nbin)
+    spec = np.fft.rfft(profiles, axis=-1)[:, : len(tspec)]
+    # Noise of each real or imaginary Fourier component, from the baseline rms
+    noise = baseline_stats(profiles)[1] * np.sqrt(nbin / 2.0)
+    return fdm_fit_cross(spec * np.conj(tspec)[None, :], tspec, noise, nbin)
+
+
+def fdm_fit_cross(cross, tspec, noise, nbin):
+    """
+    fdm_fit() from the cross-spectra (K, nharm) of the profiles with the
+    template harmonics tspec (see fit_harmonics()), given the noise of each
+    real or imaginary Fourier component of the profiles.
+    """
+    shifts = cross_spectrum_shifts(cross, nbin)
+    k = 2.0 * np.pi * np.arange(len(tspec))
+    corr = np.sum((cross * np.exp(1j * k[None, :] * shifts[:, None])).real, axis=-1)
+    power = np.sum(np.abs(tspec) ** 2)
+    noise = np.where(noise > 0, noise, np.inf)
+    snr = corr / (noise * np.sqrt(power))
+    # Inverse Fisher information for the shift, amplitude = corr / power
+    with np.errstate(divide="ignore"):
+        errors = (
+            noise * power / (np.abs(corr) * np.sqrt(np.sum(k**2 * np.abs(tspec) ** 2)))
+        )
+    return shifts, errors, snr
+
+
+def file_toas(fname, tspec, site=SITE, extra_flags=""):
+    """tempo2 .tim lines for every subint and subband of fname with non-zero weight."""
+    with open_archive(fname) as ar:
+        cube = pscrunch(
+            np.asarray(ar.data, dtype=np.float64),
+            ar.subint.header.get("POL_TYPE", "AA+BB"),
+        )
+        weights = np.array(ar.weights, dtype=np.float64)
+        freqs = np.array(ar.freqs, dtype=np.float64)
+        periods = ar.periods
+        # Phase zero of the profiles, which the shifts are measured from
+        imjd, frac = zero_phase_epochs(ar)
+        dedispersed = ar.dedispersed
+        dm = ar.dm
+        obsfreq = float(ar.primary.get("OBSFREQ", 0.0))
+
+    # Zapped (and empty) profiles give no TOA
+    isub, ichan = np.nonzero((weights > 0) & (np.ptp(cube, axis=-1) > 0))
+    if len(isub) == 0:
+        return []
+    shifts, errors, snr = fdm_fit(cube[isub, ichan], tspec)
+    if dedispersed:
+        # Profiles were aligned at the centre frequency; put the TOAs back at their own
+        shifts = shifts + dispersion_turns(
+            freqs[isub, ichan], obsfreq, dm, periods[isub]
+        )
+
+    days = frac[isub] + shifts * periods[isub] / 86400.0
+    carry = np.floor(days)
+    toa_imjd = imjd[isub] + carry.astype(np.int64)
+    toa_frac = days - carry
+    errors_us = errors * periods[isub] * 1e6
+    extra = f" {extra_flags.strip()}" if extra_flags.strip() else ""
+    return [
+        f"{fname} {freqs[s, c]:.6f} {format_mjd(toa_imjd[i], toa_frac[i])} "
+        f"{errors_us[i]:.3f} {site} -chan {c} -subint {s} -snr {snr[i]:.3f} "
+        f"-wt {weights[s, c]:g}{extra}"
+        for i, (s, c) in enumerate(zip(isub, ichan))
+        if np.isfinite(errors_us[i])
+    ]
+
+
+def _init_worker(tspec):
+    global _template_spectrum
+    _template_spectrum = tspec
+
+
+def _toas_one(job):
+    fname, site, extra_flags = job
+    try:
+        return fname, file_toas(fname, _template_spectrum, site, extra_flags), None
+    except Exception as err:
+        return fname, [], f"{type(err).__name__}: {err}"
+
+
+def iter_file_toas(files, template, nproc=1, site=SITE, extra_flags=""):
+    """
+    Yield (fname, .tim lines, error) for every file, in the order of files,
+    fitting files on nproc processes that share the template spectrum.
+    """
+    tspec = template_spectrum(template)
+    jobs = [(fname, site, extra_flags) for fname in files]
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=nproc, initializer=_init_worker, initargs=(tspec,)
+        ) as pool:
+            yield from pool.map(_toas_one, jobs, chunksize=4)
+    else:
+        _init_worker(tspec)
+        yield from map(_toas_one, jobs)
+
+
+def generate_toas(
+    files, template, nproc=1, site=SITE, extra_flags="", out=sys.stdout
+):
+    """
+    Write a tempo2 .tim of every file's TOAs to out, in the order of files.
+    Returns (number of TOAs, list of (fname, error) for files that failed).
+    """
+    out.write("FORMAT 1\n")
+    ntoa, failed = 0, []
+    for fname, lines, error in iter_file_toas(
+        files, template, nproc=nproc, site=site, extra_flags=extra_flags
+    ):
+        if error:
+            failed.append((fname, error))
+            continue
+        for line in lines:
+            out.write(f"{line}\n")
+        ntoa += len(lines)
+    return ntoa, failed
+
+
+def read_toa_lines(lines):
+    """
+    Dict of (file name, subint, chan): (MJD day, MJD fraction, error, S/N) from
+    tempo2 .tim lines carrying -subint, -chan and -snr flags.
+    """
+    toas = {}
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 5 or fields[0] in ["FORMAT", "MODE", "C"]:
+            continue
+        flags = dict(zip(fields[5::2], fields[6::2]))
+        day, _, frac = fields[2].partition(".")
+        key = (fields[0], int(flags.get("-subint", 0)), int(flags.get("-chan", 0)))
+        toas[key] = (
+            int(day),
+            float(f"0.{frac}"),
+            float(fields[3]),
+            float(flags.get("-snr", "nan")),
+        )
+    return toas
+
+
+def compare_with_pat(files, template, native_lines):
+    """Run pat on files and print how its TOAs differ from native_lines."""
+    result = subprocess.run(
+        ["pat", *PAT_OPTIONS.split(), "-s", template, *files],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(f"error: pat failed: {result.stderr.strip()}", file=sys.stderr)
+        return
+    pat = read_toa_lines(result.stdout.splitlines())
+    native = read_toa_lines(native_lines)
+    common = sorted(set(pat) & set(native))
+    print(
+        f"Cross-check with pat: {len(common)} TOAs in common, {len(pat) - len(common)} only from pat, {len(native) - len(common)} only native.",
+        file=sys.stderr,
+    )
+    if len(common) == 0:
+        return
+    p = np.array([pat[key] for key in common])
+    n = np.array([native[key] for key in common])
+    dt = ((n[:, 0] - p[:, 0]) + (n[:, 1] - p[:, 1])) * 86400e6
+    for label, values in [
+        ("TOA difference (us)", np.abs(dt)),
+        ("TOA difference / pat error", np.abs(dt) / p[:, 2]),
+        ("Error ratio (native / pat)", n[:, 2] / p[:, 2]),
+        ("S/N ratio (native / pat)", n[:, 3] / p[:, 3]),
+    ]:
+        print(
+            f"    {label}: median {np.nanmedian(values):.4g}, max {np.nanmax(values):.4g}",
+            file=sys.stderr,
+        )
+
+
+class _Tee:
+    # Write to a stream while keeping the lines, for --check_pat
+    def __init__(self, out):
+        self.out = out
+        self.lines = []
+
+    def write(self, text):
+        self.out.write(text)
+        self.lines.extend(text.splitlines())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate tempo2 TOAs for every subint and subband of the files with a Fourier-domain fit."
+    )
+    parser.add_argument("files", nargs="+", help="Scrunched archives (e.g. *.ftp).")
+    parser.add_argument(
+        "-s", "--template", type=str, required=True, help="Standard template profile."
+    )
+    parser.add_argument(
+        "-X",
+        "--extra_flags",
+        type=str,
+        default="",
+        help="Flags appended to every TOA line, as with pat -X.",
+    )
+    parser.add_argument(
+        "--site",
+        type=str,
+        default=SITE,
+        help=f"Observatory code of the TOAs ('{SITE}' by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of worker processes (1 by default).",
+    )
+    parser.add_argument(
+        "--check_pat",
+        action="store_true",
+        help="Also run pat on the files and report the differences (to stderr).",
+    )
+    args = parser.parse_args()
+
+    out = _Tee(sys.stdout) if args.check_pat else sys.stdout
+    ntoa, failed = generate_toas(
+        args.files,
+        args.template,
+        nproc=args.nproc,
+        site=args.site,
+        extra_flags=args.extra_flags,
+        out=out,
+    )
+    for fname, error in failed:
+        print(f"warning: no TOAs from {fname}: {error}", file=sys.stderr)
+    print(f"{ntoa} TOAs from {len(args.files) - len(failed)} files.", file=sys.stderr)
+    if args.check_pat:
+        compare_with_pat(args.files, args.template, out.lines)
+    if len(failed) == len(args.files):
+        exit(1)
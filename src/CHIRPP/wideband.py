@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##                 Wideband TOAs: joint phase and DM fit               ##
+#########################################################################
+
+One TOA and one DM per subint, instead of one TOA per subband.
+
+The template is a portrait: a profile per frequency channel, built from the
+data themselves. Every file's profiles are dedispersed to the centre
+frequency and summed over subints, the sum is aligned with the standard
+template and the files are added, weighted by S/N, channel by channel. Only
+the harmonics where the standard template has power are kept, which removes
+most of the noise. The portrait is saved (--portrait) and reused as long as
+the files have the same number of channels and bins.
+
+Each subint is then fitted in the Fourier domain for a phase and a DM offset
+at once, with an amplitude per channel marginalised analytically (as in
+PulsePortraiture): Newton steps on the channel-summed cross-correlation,
+vectorized over subints. The TOA is given at the frequency where its error is
+uncorrelated with the DM, and the DM and its error are written as -pp_dm and
+-pp_dme, as tempo2 and PINT expect of wideband TOAs. As for toas.py, the phase
+is added to each subint's time of predictor phase zero (so files without a
+T2PREDICT or POLYCO table give no TOAs). Like toas.py, this engine is not
+offered by new_pulsar.py until toas.py --check_pat agrees with pat on CHIME data.
+
+Run from the command line with:
+python wideband.py --portrait J0000+0000.portrait.npz -j 8 -X "-f CHIME -be CHIME -fe Rcvr_CHIME" -s template.sm *.ftp > toas.tim
+python wideband.py --portrait J0000+0000.portrait.npz --rebuild -M template_50.txt -s template.sm *.ftp > toas.tim
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scrunch import DM_CONST, dispersion_turns
+from template import cross_spectrum_shifts
+from tim import chime_prefix, format_mjd
+from toa_cache import content_hash
+from toas import SITE, fdm_fit_cross, fit_harmonics, template_spectrum
+from xspec import aligned_spectra
+
+# Newton steps of the joint phase and DM fit
+NEWTON_STEPS = 10
+# Portrait harmonics are kept where the standard template has at least this
+# fraction of its largest harmonic's amplitude
+HARMONIC_FLOOR = 1e-3
+# Portrait and template spectrum shared by the workers of the pool
+_shared = None
+
+
+def _time_summed(data):
+    # Weighted mean spectrum of each channel over subints, and its noise
+    w = data["weights"]
+    wsum = w.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        spec = np.einsum("sc,sck->ck", w, data["spec"]) / wsum[:, None]
+        noise = np.sqrt(np.sum(w**2 * data["noise"] ** 2, axis=0)) / wsum
+    spec[wsum == 0] = 0.0
+    return spec, noise, wsum
+
+
+def aligned_portrait(fname, full_tspec):
+    """
+    Portrait of one file aligned with the standard template (spectrum
+    full_tspec): its subint-summed spectra (nchan, nharm) in units of the noise
+    of the frequency-summed profile, the channels' weights and frequencies,
+    the file's S/N and nbin.
+    """
+    data = aligned_spectra(fname)
+    nbin = data["nbin"]
+    tspec = fit_harmonics(full_tspec, nbin)
+    data["spec"] = data["spec"][..., : len(tspec)]
+    spec, noise, wsum = _time_summed(data)
+    total = wsum.sum()
+    if total == 0:
+        raise ValueError("every profile has zero weight")
+    profile = np.sum(wsum[:, None] * spec, axis=0) / total
+    profile_noise = np.sqrt(np.nansum((wsum * noise) ** 2)) / total
+    cross = (profile * np.conj(tspec))[None, :]
+    shift, _, snr = fdm_fit_cross(cross, tspec, np.array([profile_noise]), nbin)
+    spec = spec * np.exp(2j * np.pi * np.arange(len(tspec)) * shift[0])
+    w = data["weights"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        freqs = np.sum(w * data["freqs"], axis=0) / wsum
+    freqs = np.where(wsum > 0, freqs, data["freqs"].mean(axis=0))
+    return spec / profile_noise, wsum, freqs, float(snr[0]), nbin
+
+
+def _portrait_one(job):
+    fname, tspec = job
+    try:
+        return fname, aligned_portrait(fname, tspec), None
+    except Exception as err:
+        return fname, None, f"{type(err).__name__}: {err}"
+
+
+def build_portrait(files, template, nproc=1):
+    """
+    S/N-weighted sum of the aligned portraits of files. Returns a dict of the
+    portrait spectrum (nchan, nharm), the channels' frequencies, nbin, the
+    template's hash and the files used, and the list of (fname, error) for
+    files left out.
+    """
+    full = template_spectrum(template)
+    jobs = [(fname, full) for fname in files]
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=nproc) as pool:
+            results = list(pool.map(_portrait_one, jobs, chunksize=4))
+    else:
+        results = list(map(_portrait_one, jobs))
+
+    total, weight, freqs, nbin, used, failed = None, None, None, None, [], []
+    for fname, result, error in results:
+        if error:
+            failed.append((fname, error))
+            continue
+        spec, wsum, ffreqs, snr, fnbin = result
+        if total is None:
+            nbin = fnbin
+            tspec = fit_harmonics(full, nbin)
+            total = np.zeros((len(wsum), len(tspec)), dtype=np.complex128)
+            weight = np.zeros(len(wsum))
+            freqs = np.zeros(len(wsum))
+        if fnbin != nbin or len(wsum) != len(weight):
+            error = f"({len(wsum)}, {fnbin}) channels and bins, unlike the first file"
+            failed.append((fname, error))
+            continue
+        present = (wsum > 0) * max(snr, 0.0)
+        total += present[:, None] * spec
+        weight += present
+        freqs += present * ffreqs
+        used.append(fname)
+    if not used:
+        raise ValueError("no file could be added to the portrait")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        portrait = total / weight[:, None]
+        freqs = freqs / weight
+    portrait[weight == 0] = 0.0
+    # Keep only the harmonics the (smoothed) standard template has
+    amplitude = np.abs(tspec)
+    portrait[:, amplitude < HARMONIC_FLOOR * amplitude.max()] = 0.0
+    portrait[:, 0] = 0.0
+    return {
+        "portrait": portrait,
+        "freqs": np.where(weight > 0, freqs, np.nan),
+        "nbin": nbin,
+        "template_sha": content_hash(template),
+        "files": np.array(used, dtype=str),
+    }, failed
+
+
+def save_portrait(fname, portrait):
+    tmp = f"{fname}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, **portrait)
+    os.replace(tmp, fname)
+    return fname
+
+
+def load_portrait(fname):
+    with np.load(fname) as f:
+        return {key: f[key] for key in f.files}
+
+
+def fit_phase_dm(spec, noise, portrait, x, nbin):
+    """
+    Joint fit of a phase and a DM offset to the spectra (K, nchan, nharm) of
+    K subints, with per-channel noise (K, nchan), against a portrait (nchan,
+    nharm). x (K, nchan) is the delay, in turns, of each channel per unit DM.
+
+    Maximises sum_c C_c(tau_c)^2 / (noise_c^2 S_c) over the phase and the DM,
+    where tau_c = phase + DM x_c, C_c is the cross-correlation of channel c
+    with the portrait and S_c the portrait channel's power; this is chi^2
+    minimised over a free amplitude per channel. Returns the phases (turns)
+    and DM offsets, their covariance matrices (K, 2, 2) and the S/N.
+    """
+    cross = spec * np.conj(portrait)[None]
+    power = np.sum(np.abs(portrait) ** 2, axis=-1)
+    use = (power > 0)[None, :] & (noise > 0) & np.isfinite(noise)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w = np.where(use, 1.0 / (noise**2 * power[None, :]), 0.0)
+    cross = np.where(use[..., None], cross, 0.0)
+    k = 2.0 * np.pi * np.arange(portrait.shape[-1])
+
+    # Start from the phase of the noise-weighted, frequency-summed profile
+    start = np.sum(cross * (w * power[None, :])[..., None], axis=1)
+    phase = cross_spectrum_shifts(start, nbin)
+    ddm = np.zeros(len(phase))
+    # Largest DM step: half a bin of delay across the band
+    xspan = np.nanmax(np.where(use, x, np.nan), axis=1) - np.nanmin(
+        np.where(use, x, np.nan), axis=1
+    )
+    xspan = np.where(np.isfinite(xspan) & (xspan > 0), xspan, 1.0)
+    for _ in range(NEWTON_STEPS + 1):
+        tau = phase[:, None] + ddm[:, None] * x
+        terms = cross * np.exp(1j * k * tau[..., None])
+        c0 = np.sum(terms.real, axis=-1)
+        c1 = -np.sum((k * terms).imag, axis=-1)
+        c2 = -np.sum((k**2 * terms).real, axis=-1)
+        g = 2.0 * w * c0 * c1
+        h = 2.0 * w * (c1**2 + c0 * c2)
+        grad = np.stack([g.sum(axis=1), (g * x).sum(axis=1)], axis=-1)
+        hess = np.stack(
+            [
+                np.stack([h.sum(axis=1), (h * x).sum(axis=1)], axis=-1),
+                np.stack([(h * x).sum(axis=1), (h * x**2).sum(axis=1)], axis=-1),
+            ],
+            axis=-2,
+        )
+        if _ == NEWTON_STEPS:
+            break
+        det = hess[:, 0, 0] * hess[:, 1, 1] - hess[:, 0, 1] ** 2
+        # Only step where the surface is concave, i.e. near a maximum
+        ok = (det > 0) & (hess[:, 0, 0] < 0)
+        safe = np.where(ok, det, 1.0)
+        dphase = -(hess[:, 1, 1] * grad[:, 0] - hess[:, 0, 1] * grad[:, 1]) / safe
+        dddm = -(hess[:, 0, 0] * grad[:, 1] - hess[:, 0, 1] * grad[:, 0]) / safe
+        phase = phase + np.where(ok, np.clip(dphase, -0.5 / nbin, 0.5 / nbin), 0.0)
+        limit = 0.5 / nbin / xspan
+        ddm = ddm + np.where(ok, np.clip(dddm, -limit, limit), 0.0)
+
+    # chi^2 = const - F, and the covariance is twice the inverse Hessian of chi^2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cov = 2.0 * np.linalg.inv(-hess)
+    snr = np.sqrt(np.clip(np.sum(w * c0**2, axis=1), 0.0, None))
+    return phase, ddm, cov, snr
+
+
+def file_wideband_toas(fname, portrait, site=SITE, extra_flags=""):
+    """tempo2 .tim lines of fname, one wideband TOA per subint with non-zero weight."""
+    data = aligned_spectra(fname, portrait["portrait"].shape[-1])
+    nsub, nchan, _ = data["spec"].shape
+    nbin = int(data["nbin"])
+    if nchan != len(portrait["freqs"]) or nbin != int(portrait["nbin"]):
+        raise ValueError(
+            f"({nchan}, {nbin}) channels and bins but the portrait has "
+            f"({len(portrait['freqs'])}, {int(portrait['nbin'])})"
+        )
+    periods = data["periods"]
+    obsfreq = float(data["obsfreq"])
+    dm = float(data["dm"])
+    keep = data["weights"].sum(axis=1) > 0
+    if not keep.any():
+        return []
+    isub = np.nonzero(keep)[0]
+    noise = np.where(data["weights"][isub] > 0, data["noise"][isub], 0.0)
+    x = dispersion_turns(data["freqs"][isub], obsfreq, 1.0, periods[isub, None])
+    phase, ddm, cov, snr = fit_phase_dm(
+        data["spec"][isub], noise, portrait["portrait"], x, nbin
+    )
+
+    # Reference the TOA to the frequency where its error and the DM's are
+    # uncorrelated: tau(x0) with x0 = -cov[0, 1] / cov[1, 1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x0 = -cov[:, 0, 1] / cov[:, 1, 1]
+        inv_f2 = x0 * periods[isub] / DM_CONST + obsfreq**-2.0
+    valid = np.isfinite(inv_f2) & (inv_f2 > 0)
+    x0 = np.where(valid, x0, 0.0)
+    freqs = np.where(valid, np.abs(inv_f2) ** -0.5, obsfreq)
+    var = cov[:, 0, 0] + 2.0 * x0 * cov[:, 0, 1] + x0**2 * cov[:, 1, 1]
+    shifts = phase + ddm * x0 + dispersion_turns(freqs, obsfreq, dm, periods[isub])
+    if not data["dedispersed"]:
+        # Within half a turn of the fold, as for narrowband TOAs
+        shifts = (shifts + 0.5) % 1.0 - 0.5
+
+    # The epochs are at the predictor's phase zero (see xspec.aligned_spectra())
+    days = data["frac"][isub] + shifts * periods[isub] / 86400.0
+    carry = np.floor(days)
+    toa_imjd = data["imjd"][isub] + carry.astype(np.int64)
+    toa_frac = days - carry
+    errors_us = np.sqrt(var) * periods[isub] * 1e6
+    dm_errors = np.sqrt(cov[:, 1, 1])
+    wsum = data["weights"][isub].sum(axis=1)
+    extra = f" {extra_flags.strip()}" if extra_flags.strip() else ""
+    name = chime_prefix(fname)
+    return [
+        f"{name} {freqs[i]:.6f} {format_mjd(toa_imjd[i], toa_frac[i])} "
+        f"{errors_us[i]:.3f} {site} -subint {s} -snr {snr[i]:.3f} -wt {wsum[i]:g} "
+        f"-pp_dm {dm + ddm[i]:.7f} -pp_dme {dm_errors[i]:.7f}{extra}"
+        for i, s in enumerate(isub)
+        if np.isfinite(errors_us[i]) and np.isfinite(dm_errors[i])
+    ]
+
+
+def _init_worker(portrait):
+    global _shared
+    _shared = portrait
+
+
+def _wideband_one(job):
+    fname, site, extra_flags = job
+    try:
+        return fname, file_wideband_toas(fname, _shared, site, extra_flags), None
+    except Exception as err:
+        return fname, [], f"{type(err).__name__}: {err}"
+
+
+def iter_wideband_toas(files, portrait, nproc=1, site=SITE, extra_flags=""):
+    """Yield (fname, .tim lines, error) for every file, in the order of files."""
+    jobs = [(fname, site, extra_flags) for fname in files]
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=nproc, initializer=_init_worker, initargs=(portrait,)
+        ) as pool:
+            yield from pool.map(_wideband_one, jobs, chunksize=4)
+    else:
+        _init_worker(portrait)
+        yield from map(_wideband_one, jobs)
+
+
+def portrait_matches(portrait, template, fname):
+    # A saved portrait is reused for files of the same shape and the same template
+    from psrfits import open_archive
+
+    with open_archive(fname) as ar:
+        shape = (int(ar.nchan), int(ar.nbin))
+    return (
+        shape == (len(portrait["freqs"]), int(portrait["nbin"]))
+        and str(portrait["template_sha"]) == content_hash(template)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Wideband TOAs: one TOA and DM per subint from a joint phase and DM fit to a template portrait."
+    )
+    parser.add_argument("files", nargs="+", help="Archives to time.")
+    parser.add_argument(
+        "-s", "--template", type=str, required=True, help="Standard template profile."
+    )
+    parser.add_argument(
+        "--portrait",
+        type=str,
+        required=True,
+        help="Template portrait (.npz): built from the data and saved here if it does not exist or does not fit the files.",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Build the portrait again even if it exists.",
+    )
+    parser.add_argument(
+        "-M",
+        "--metafile",
+        type=str,
+        default=None,
+        help="File listing the archives to build the portrait from (the files to time by default).",
+    )
+    parser.add_argument(
+        "-X",
+        "--extra_flags",
+        type=str,
+        default="",
+        help="Flags appended to every TOA line, as with pat -X.",
+    )
+    parser.add_argument(
+        "--site",
+        type=str,
+        default=SITE,
+        help=f"Observatory code written to the .tim file ('{SITE}' by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes (1 by default).",
+    )
+    args = parser.parse_args()
+
+    portrait = None
+    if os.path.exists(args.portrait) and not args.rebuild:
+        portrait = load_portrait(args.portrait)
+        if not portrait_matches(portrait, args.template, args.files[0]):
+            print(
+                f"{args.portrait} does not fit the files or template; building it again.",
+                file=sys.stderr,
+            )
+            portrait = None
+    if portrait is None:
+        if args.metafile:
+            with open(args.metafile, "r") as f:
+                sources = [line.split()[0] for line in f if line.strip()]
+        else:
+            sources = args.files
+        portrait, failed = build_portrait(sources, args.template, nproc=args.nproc)
+        for fname, error in failed:
+            print(f"warning: {fname} left out of the portrait: {error}", file=sys.stderr)
+        save_portrait(args.portrait, portrait)
+        print(
+            f"Portrait of {len(portrait['files'])} files written to {args.portrait}.",
+            file=sys.stderr,
+        )
+
+    print("FORMAT 1")
+    ntoa, failed = 0, []
+    for fname, lines, error in iter_wideband_toas(
+        args.files,
+        portrait,
+        nproc=args.nproc,
+        site=args.site,
+        extra_flags=args.extra_flags,
+    ):
+        if error:
+            failed.append((fname, error))
+            continue
+        for line in lines:
+            print(line)
+        ntoa += len(lines)
+    for fname, error in failed:
+        print(f"warning: no TOAs from {fname}: {error}", file=sys.stderr)
+    print(f"{ntoa} TOAs from {len(args.files) - len(failed)} files.", file=sys.stderr)
+    if failed and len(failed) == len(args.files):
+        exit(1)
@@ -357,7 +357,21 @@ def write_beamWeight(force_overwrite=False):
         'echo "Pulsar name found: $pulsar_name"',
         "",
         "# Run beam weighting on each file",
-        "add_beam -vv -e bmwt CHIME*.clfd",
+        'stage_flag=""',
+        'if [ "$stage_files" = true ]; then',
+        '    stage_flag="--stage_dir=${stage_dir:-$SLURM_TMPDIR}"',
+        "fi",
+        'if [ -n "$stage_flag" ]; then',
+        "    # Through node-local disk, with read-ahead and bulk write-back",
+        "    staging.py $stage_flag -o .bmwt.clfd -c 'add_beam -vv -e bmwt {}' CHIME*.clfd",
+        "else",
+        "    add_beam -vv -e bmwt CHIME*.clfd",
+        "fi",
+        "",
+        "# Optionally store the beam-weighted files compressed",
+        'if [ "${compress_level:-0}" -gt 0 ]; then',
+        "    compress.py -l $compress_level -j ${SLURM_CPUS_PER_TASK:-1} CHIME*.bmwt.clfd",
+        "fi",
     ]
     write_script("beamWeight.sh", lines_beamWeight, force_overwrite=force_overwrite)
 
@@ -425,7 +439,12 @@ def write_clean(force_overwrite=False):
         'echo "Pulsar name found: $pulsar_name"',
         "",
         "# Run clfd",
-        "for f in $(ls CHIME*.zap); do clfd $f; done",
+        'if [ "$stage_files" = true ]; then',
+        "    # Through node-local disk, with read-ahead and bulk write-back",
+        "    staging.py --stage_dir=${stage_dir:-$SLURM_TMPDIR} -o .clfd -c 'clfd {}' CHIME*.zap",
+        "else",
+        "    for f in $(ls CHIME*.zap); do clfd $f; done",
+        "fi",
     ]
     write_script("clean.sh", lines_clean, force_overwrite=force_overwrite)
 
@@ -454,7 +473,12 @@ def write_clean5G(force_overwrite=False):
         'echo "Pulsar name found: $pulsar_name"',
         "",
         "# Zap known bad channels (5G zapping from Bradley plus list of commonly bad channels from Emmanuel)",
-        "for f in $(ls CHIME*.ar); do psrsh chime_zap.psh -e ar.zap $f; done",
+        'if [ "$stage_files" = true ]; then',
+        "    # Through node-local disk, with read-ahead and bulk write-back",
+        "    staging.py --stage_dir=${stage_dir:-$SLURM_TMPDIR} -o .zap -c 'psrsh chime_zap.psh -e ar.zap {}' CHIME*.ar",
+        "else",
+        "    for f in $(ls CHIME*.ar); do psrsh chime_zap.psh -e ar.zap $f; done",
+        "fi",
     ]
     write_script("clean5G.sh", lines_clean5G, force_overwrite=force_overwrite)
 
@@ -494,6 +518,62 @@ def write_config(force_overwrite=False):
         "# Desired number of subbands",
         "nsubbands=64",
         "",
+        "# Tool used to scrunch the data:",
+        '# "pam" (PSRCHIVE) or "native" (CHIRPP\'s in-process scrunch.py)',
+        'scrunch_engine="pam"',
+        "",
+        "# Minimum number of subbands to scrunch to",
+        "min_nchan=8",
+        "",
+        "# If true, the native scrunch engine also writes every power-of-two number of",
+        "# subbands down to min_nchan, so fewer subbands can be used without re-scrunching",
+        "scrunch_levels=false",
+        "",
+        "# Per-observation number of subbands (native scrunch engine only).",
+        "# If set, scrunch.py takes each file's number of subbands from this manifest,",
+        "# written by find_nchan.py --manifest from the file's S/N",
+        'nchan_manifest=""',
+        "",
+        "# Intermediate products to keep once every stage that reads them has succeeded:",
+        '# "all", or a list of extensions, e.g. ".ar .bmwt.clfd .ftp" to remove .zap and .zap.clfd files',
+        'keep_intermediates="all"',
+        "",
+        "# Disk budget for intermediate products, e.g. 500G (leave empty for no limit).",
+        "# If a stage's output would not fit, .bmwt.clfd files are compressed first (if",
+        "# compress_level is set), and the pipeline stops if it still does not fit.",
+        'disk_budget=""',
+        "",
+        "# If true, per-file steps (clean5G, clean, beamWeight and the native scrunch) copy their",
+        "# inputs to node-local disk ahead of processing and write outputs back in batches.",
+        "# stage_dir is the local directory to use; leave empty for each job's $SLURM_TMPDIR.",
+        "stage_files=false",
+        'stage_dir=""',
+        "",
+        "# zlib level (1-9) at which to store .bmwt.clfd files compressed, or 0 to leave them as is.",
+        "# Compressed files are only readable by CHIRPP (scrunch_engine=\"native\"), not by PSRCHIVE;",
+        "# restore them with compress.py -d. See compress.py --benchmark for the trade-off.",
+        "compress_level=0",
+        "",
+        "# Tool used to rank files by S/N for template creation:",
+        '# "psrstat", or "native" (CHIRPP\'s template_select.py, parallel and cached in file_metadata.json)',
+        'template_select="psrstat"',
+        "",
+        "# Tool used to align and add the template profiles:",
+        '# "autotoa", or "native" (CHIRPP\'s template.py, which needs far less memory)',
+        'template_engine="autotoa"',
+        "",
+        "# Tool used to smooth the template (wavelet denoising):",
+        '# "psrsmooth", or "native" (CHIRPP\'s smooth.py; try thresholds with smooth.py added.trimmed -f 1 0.5 2)',
+        'smooth_engine="psrsmooth"',
+        "",
+        "# Tool used to generate TOAs:",
+        '# "pat", or "pat_sharded" (pat on size-balanced shards of the files in parallel, via pat_shards.py)',
+        'toa_engine="pat"',
+        "",
+        "# If true, TOAs are cached per file in toa_cache/ (keyed by the file's and the template's",
+        "# contents), so only new or changed files are timed again",
+        "toa_cache=false",
+        "",
         "# What is the file extension to run template creation on?",
         'template_ext=".ftp" # ex: .zap or _trimmed.fits',
         "",
@@ -511,6 +591,7 @@ def write_config(force_overwrite=False):
         'echo "Template nbin: $template_nbin"',
         'echo "Maximum subint duration: $max_subint s"',
         'echo "Number of subbands: $nsubbands"',
+        'echo "Scrunching with: $scrunch_engine"',
         'echo "Template creation will use files with extension: $template_ext"',
         'echo "Your tim file will use these flags: $tim_flags"',
         'echo "---------------------------------------------"',
@@ -1071,6 +1152,12 @@ def write_processing_creation(force_overwrite=False):
         '# And convert to a psrfits format for compatibility downstream" >> "$ephem_txt"',
         "# Each text file is a list of arguments to run with parallel (don't include comments or blank spaces - everything will be ran as a job)",
         "",
+        "# Optionally run per-file steps through node-local disk ($SLURM_TMPDIR of each job by default)",
+        'stage_flag=""',
+        'if [ "$stage_files" = true ]; then',
+        '    stage_flag="--stage_dir=${stage_dir:-\\$SLURM_TMPDIR}"',
+        "fi",
+        "",
         "# Iterate through each unique beam variation",
         "for beam in $beam_variations; do",
         '    pulsarbeam="${pulsar_name}_${beam}"',
@@ -1084,9 +1171,17 @@ def write_processing_creation(force_overwrite=False):
         '        echo "for f in \\$(ls CHIME*${beam}*.ar); do pam -p -E ${par_file} -a PSRFITS -u . \\$f >> ephemNconvert_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>ephemNconvert_${pulsarbeam}-\\${SLURM_JOB_ID}.err; done" >> "$ephem_txt"',
         "    fi",
         "    # Zap known bad channels (5G zapping from Bradley plus list of commonly bad channels from Emmanuel)",
-        '    echo "for f in \\$(ls CHIME*${beam}*.ar); do psrsh chime_zap.psh -e ar.zap \\$f >> clean5G_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>clean5G_${pulsarbeam}-\\${SLURM_JOB_ID}.err; done" >> "$clean5G_txt"',
+        '    if [ -n "$stage_flag" ]; then',
+        "        echo \"staging.py $stage_flag -o .zap -c 'psrsh chime_zap.psh -e ar.zap {}' CHIME*${beam}*.ar >> clean5G_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>clean5G_${pulsarbeam}-\\${SLURM_JOB_ID}.err\" >> \"$clean5G_txt\"",
+        "    else",
+        '        echo "for f in \\$(ls CHIME*${beam}*.ar); do psrsh chime_zap.psh -e ar.zap \\$f >> clean5G_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>clean5G_${pulsarbeam}-\\${SLURM_JOB_ID}.err; done" >> "$clean5G_txt"',
+        "    fi",
         "    # Run clfd",
-        '    echo "for f in \\$(ls CHIME*${beam}*.zap); do clfd \\$f >> clean_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>clean_${pulsarbeam}-\\${SLURM_JOB_ID}.err; done" >> "$clean_txt"',
+        '    if [ -n "$stage_flag" ]; then',
+        "        echo \"staging.py $stage_flag -o .clfd -c 'clfd {}' CHIME*${beam}*.zap >> clean_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>clean_${pulsarbeam}-\\${SLURM_JOB_ID}.err\" >> \"$clean_txt\"",
+        "    else",
+        '        echo "for f in \\$(ls CHIME*${beam}*.zap); do clfd \\$f >> clean_${pulsarbeam}-\\${SLURM_JOB_ID}.out 2>>clean_${pulsarbeam}-\\${SLURM_JOB_ID}.err; done" >> "$clean_txt"',
+        "    fi",
         "done",
         "",
         "# Did it run?",
@@ -1101,11 +1196,26 @@ def write_processing_creation(force_overwrite=False):
         'remove_file_if_exists "$bmWt_txt"',
         '# Run beam weighting on each file > "$bmWt_txt"',
         "",
+        "# Optionally store the beam-weighted files compressed",
+        'compress_cmd=""',
+        'if [ "${compress_level:-0}" -gt 0 ]; then',
+        '    compress_cmd="compress.py -l $compress_level"',
+        "fi",
+        "",
         "# Iterate through each unique beam variation",
         "for beam in $beam_variations; do",
         '    outfile_base="beamWeight_${pulsar_name}_${beam}"',
         "    # Create a script for the specific beam variation",
-        '    echo "add_beam -vv -e bmwt CHIME*${beam}*.clfd >>${outfile_base}-\\${SLURM_JOB_ID}.out 2>>${outfile_base}-\\${SLURM_JOB_ID}.err" >> "$bmWt_txt"',
+        '    if [ -n "$stage_flag" ]; then',
+        "        line=\"staging.py $stage_flag -o .bmwt.clfd -c 'add_beam -vv -e bmwt {}' CHIME*${beam}*.clfd >>${outfile_base}-\\${SLURM_JOB_ID}.out 2>>${outfile_base}-\\${SLURM_JOB_ID}.err\"",
+        "    else",
+        '        line="add_beam -vv -e bmwt CHIME*${beam}*.clfd >>${outfile_base}-\\${SLURM_JOB_ID}.out 2>>${outfile_base}-\\${SLURM_JOB_ID}.err"',
+        "    fi",
+        "    # Compress in the same command, once add_beam has finished with this beam",
+        '    if [ -n "$compress_cmd" ]; then',
+        '        line="$line && $compress_cmd CHIME*${beam}*.bmwt.clfd >>${outfile_base}-\\${SLURM_JOB_ID}.out 2>>${outfile_base}-\\${SLURM_JOB_ID}.err"',
+        "    fi",
+        '    echo "$line" >> "$bmWt_txt"',
         "done",
         "",
         "# Did it run?",
@@ -1118,17 +1228,36 @@ def write_processing_creation(force_overwrite=False):
         'remove_file_if_exists "$scrunch_txt"',
         '# Scrunch files in time and frequency > "$scrunch.txt"',
         "",
+        "# Optionally write lower-resolution subband levels from the same read",
+        'levels_flag=""',
+        'if [ "$scrunch_levels" = true ]; then',
+        '    levels_flag="--min_nchan $min_nchan"',
+        "fi",
+        "# Optionally take the number of subbands for each observation from a manifest",
+        'manifest_flag=""',
+        'if [ -n "$nchan_manifest" ]; then',
+        '    manifest_flag="--manifest $nchan_manifest"',
+        "fi",
+        "",
         "# Iterate through each unique beam variation",
         "for beam in $beam_variations; do",
         '    outfile_base="scrunch_${pulsar_name}_${beam}"',
         "    # Create a script for the specific beam variation",
         "    # Use nsubbands value from config.sh",
-        '    echo "for f in \\$(ls CHIME*${0}*bmwt.clfd); do nsub=\\$(vap -nc length \\$f | awk {1}); pam --setnchn $nsubbands -e ftp --setnsub \\$nsub \\$f >> ${2}-\\${3}.out 2>>${2}-\\${3}.err; done" >> "$scrunch_txt"'.format(
+        '    if [ "$scrunch_engine" = "native" ]; then',
+        '        echo "scrunch.py --setnchn $nsubbands -e ftp --max_subint $max_subint $levels_flag $manifest_flag $stage_flag CHIME*${0}*bmwt.clfd >> ${1}-\\${2}.out 2>>${1}-\\${2}.err" >> "$scrunch_txt"'.format(
+            "{beam}",
+            "{outfile_base}",
+            "{SLURM_JOB_ID}",
+        ),
+        "    else",
+        '        echo "for f in \\$(ls CHIME*${0}*bmwt.clfd); do nsub=\\$(vap -nc length \\$f | awk {1}); pam --setnchn $nsubbands -e ftp --setnsub \\$nsub \\$f >> ${2}-\\${3}.out 2>>${2}-\\${3}.err; done" >> "$scrunch_txt"'.format(
             "{beam}",
             "'{print int(\\$2/$max_subint) + 1}'",
             "{outfile_base}",
             "{SLURM_JOB_ID}",
         ),
+        "    fi",
         "done",
         "",
         "# Did it run?",
@@ -1216,12 +1345,30 @@ def write_scrunch(force_overwrite=False):
         "",
         "# Scrunch files in time and frequency",
         "# Use nsubbands value from config.sh",
-        "for f in $(ls CHIME*bmwt.clfd); do",
-        '    nsub=$(vap -nc length $f | awk -v max_subint="$max_subint" {0})'.format(
+        'if [ "$scrunch_engine" = "native" ]; then',
+        '    levels_flag=""',
+        '    if [ "$scrunch_levels" = true ]; then',
+        '        levels_flag="--min_nchan $min_nchan"',
+        "    fi",
+        '    manifest_flag=""',
+        '    if [ -n "$nchan_manifest" ]; then',
+        "        # Choose the number of subbands for each new observation from its S/N",
+        "        find_nchan.py -e .bmwt.clfd -n $nsubbands -m $min_nchan --max_subint $max_subint --manifest $nchan_manifest -j ${SLURM_CPUS_PER_TASK:-1}",
+        '        manifest_flag="--manifest $nchan_manifest"',
+        "    fi",
+        '    stage_flag=""',
+        '    if [ "$stage_files" = true ]; then',
+        '        stage_flag="--stage_dir=${stage_dir:-$SLURM_TMPDIR}"',
+        "    fi",
+        "    scrunch.py --setnchn $nsubbands -e ftp --max_subint $max_subint $levels_flag $manifest_flag $stage_flag -j ${SLURM_CPUS_PER_TASK:-1} CHIME*bmwt.clfd",
+        "else",
+        "    for f in $(ls CHIME*bmwt.clfd); do",
+        '        nsub=$(vap -nc length $f | awk -v max_subint="$max_subint" {0})'.format(
             "'{print int($2/max_subint) + 1}'"
         ),
-        "    pam --setnchn $nsubbands -e ftp --setnsub $nsub $f",
-        "done",
+        "        pam --setnchn $nsubbands -e ftp --setnsub $nsub $f",
+        "    done",
+        "fi",
     ]
     write_script("scrunch.sh", lines_scrunch, force_overwrite=force_overwrite)
 
@@ -1249,46 +1396,51 @@ def write_template_creation(force_overwrite=False):
         "# The most recent nbin value is determined in allParamCheck.sh",
         'echo "Gathering 50 highest S/N files with the most recent nbin value (=${template_nbin})..."',
         "",
-        "# Use psrstat to get S/N and nbin for each file, sort by S/N descending,",
-        "# and only accept files that match the most recent nbin value stored as template_nbin in config.sh",
-        'sorted_files=$(for file in "$data_directory/"*${template_ext}; do',
-        "                    # Extract frequency-scrunched SNR snr and nbin values",
-        '                    data=$(psrstat -c snr,nbin -j DFTp -Q "$file")',
-        "                    snr=$(echo $data | awk '{print $2}')",
-        "                    nbin=$(echo $data | awk '{print $3}')",
-        "",
-        "                    # Convert snr and nbin to integers",
-        '                    snr=$(printf "%.0f" "$snr")',
-        '                    nbin=$(printf "%.0f" "$nbin")',
-        "",
-        "		    # Compare nbin with template_nbin",
-        '                    if [ "$nbin" -eq "$template_nbin" ]; then',
-        '                        echo "$file $snr $nbin"',
-        "                    fi",
-        "               done | sort -k2,2nr)",
-        "",
-        "",
-        "# Check if sorted_files is empty",
-        'if [ -z "$sorted_files" ]; then',
-        '    echo "No files found with nbin=${template_nbin}. Investigate files. Exiting..."',
-        "    exit 1",
-        "fi",
+        'if [ "$template_select" = "native" ]; then',
+        "    # Parallel S/N scan that reuses the metadata cache, keeping the top 50 with a heap",
+        '    template_select.py -d "$data_directory" -e "$template_ext" --nbin $template_nbin -n 50 -j ${SLURM_CPUS_PER_TASK:-1} || exit 1',
+        "else",
+        "    # Use psrstat to get S/N and nbin for each file, sort by S/N descending,",
+        "    # and only accept files that match the most recent nbin value stored as template_nbin in config.sh",
+        '    sorted_files=$(for file in "$data_directory/"*${template_ext}; do',
+        "                        # Extract frequency-scrunched SNR snr and nbin values",
+        '                        data=$(psrstat -c snr,nbin -j DFTp -Q "$file")',
+        "                        snr=$(echo $data | awk '{print $2}')",
+        "                        nbin=$(echo $data | awk '{print $3}')",
+        "",
+        "                        # Convert snr and nbin to integers",
+        '                        snr=$(printf "%.0f" "$snr")',
+        '                        nbin=$(printf "%.0f" "$nbin")',
+        "",
+        "                        # Compare nbin with template_nbin",
+        '                        if [ "$nbin" -eq "$template_nbin" ]; then',
+        '                            echo "$file $snr $nbin"',
+        "                        fi",
+        "                   done | sort -k2,2nr)",
+        "",
+        "",
+        "    # Check if sorted_files is empty",
+        '    if [ -z "$sorted_files" ]; then',
+        '        echo "No files found with nbin=${template_nbin}. Investigate files. Exiting..."',
+        "        exit 1",
+        "    fi",
         "",
-        "# Store all filenames, snr, and nbin values in template_allFiles.txt",
-        'echo "$sorted_files" > template_allFiles.txt',
+        "    # Store all filenames, snr, and nbin values in template_allFiles.txt",
+        '    echo "$sorted_files" > template_allFiles.txt',
         "",
-        "# Select the top 50 files with highest SNR and matching nbin",
-        'top_50_files=$(echo "$sorted_files" | head -n 50 | awk {0})'.format(
+        "    # Select the top 50 files with highest SNR and matching nbin",
+        '    top_50_files=$(echo "$sorted_files" | head -n 50 | awk {0})'.format(
             "'{print $1}'"
         ),
         "",
-        "# Check if top_50_files is empty or has fewer than 50 files",
-        'if [ -z "$top_50_files" ] || [ "$(echo "$top_50_files" | wc -l)" -lt 50 ]; then',
-        '    echo "Not enough top 50 files found with nbin=${template_nbin}. Investigate template_allFiles.txt. Continuing with current list..."',
-        "fi",
+        "    # Check if top_50_files is empty or has fewer than 50 files",
+        '    if [ -z "$top_50_files" ] || [ "$(echo "$top_50_files" | wc -l)" -lt 50 ]; then',
+        '        echo "Not enough top 50 files found with nbin=${template_nbin}. Investigate template_allFiles.txt. Continuing with current list..."',
+        "    fi",
         "",
-        "# Store the top 50 filenames in template_50.txt",
-        'echo "$top_50_files" > template_50.txt',
+        "    # Store the top 50 filenames in template_50.txt",
+        '    echo "$top_50_files" > template_50.txt',
+        "fi",
         "",
         "# Did it run?",
         "check_file_exists template_allFiles.txt",
@@ -1355,10 +1507,19 @@ def write_template_creation(force_overwrite=False):
         '        echo "# Inital model = Gaussian w/ width=0.1, max iterations=3, save output to add.trimmed, on *${0}s."'.format(
             "{template_ext}'"
         ),
-        "        echo 'autotoa -g0.1 -i3 -S added.trimmed -M template_50.txt'",
-        "        echo '# Rotate template so peak is centered.'",
-        "        echo 'pam -r0.5 -m added.trimmed'",
-        "        echo 'psrsmooth -W added.trimmed'",
+        '        if [ "$template_engine" = "native" ]; then',
+        "            echo '# Align and add in-process, iterating to convergence; the peak is centered at phase 0.5.'",
+        '            echo "template.py -g 0.1 -i 10 -S added.trimmed -M template_50.txt --nbin ${template_nbin} --state template_state.npz"',
+        "        else",
+        "            echo 'autotoa -g0.1 -i3 -S added.trimmed -M template_50.txt'",
+        "            echo '# Rotate template so peak is centered.'",
+        "            echo 'pam -r0.5 -m added.trimmed'",
+        "        fi",
+        '        if [ "$smooth_engine" = "native" ]; then',
+        "            echo 'smooth.py added.trimmed'",
+        "        else",
+        "            echo 'psrsmooth -W added.trimmed'",
+        "        fi",
         "        echo '# Rename the template to [JB]####+/-####.Rcvr_CHIME.CHIME.YYYY-MM-DD.sum.sm'"
         '        echo "mv added.trimmed ${template_base}"',
         '        echo "mv added.trimmed.sm ${template_base}.sm"',
@@ -1434,7 +1595,16 @@ def write_tim_creation(force_overwrite=False, timtype=""):
         "        echo '# Print the Job ID'",
         '        echo "echo Job ID: \\$SLURM_JOB_ID"',
         "        echo ''",
-        '        echo "pat -A FDM -e mcmc=0 -C chan -C subint -C snr -C wt -f \\"tempo2\\" -X \\"${tim_flags}\\" -s $template *$template_ext > ${tim}"',
+        "        # A failed run must not leave a stale or partial .tim behind: pat_shards.py",
+        "        # and toa_cache.py write to a temporary file, moved into place on success",
+        '        echo "rm -f ${tim}"',
+        '        if [ "$toa_cache" = "true" ]; then',
+        '            echo "toa_cache.py --engine ${toa_engine} -j \\${SLURM_CPUS_PER_TASK:-1} -e $template_ext -X \\"${tim_flags}\\" -s $template > ${tim}.tmp && mv ${tim}.tmp ${tim}"',
+        '        elif [ "$toa_engine" = "pat_sharded" ]; then',
+        '            echo "pat_shards.py -j \\${SLURM_CPUS_PER_TASK:-1} -e $template_ext -X \\"${tim_flags}\\" -s $template > ${tim}.tmp && mv ${tim}.tmp ${tim}"',
+        "        else",
+        '            echo "pat -A FDM -e mcmc=0 -C chan -C subint -C snr -C wt -f \\"tempo2\\" -X \\"${tim_flags}\\" -s $template *$template_ext > ${tim}"',
+        "        fi",
         # NB: adding a line containing any characters after the pat command will break the pipeline :) -Will
         '    } > "$tim_sh"',
         "",
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+"""
+#########################################################################
+##              Per-channel cross-spectrum cache for TOAs              ##
+#########################################################################
+
+In the Fourier-domain (FDM) fit, a subband's TOA only depends on the
+cross-spectrum of its profile with the template, and cross-spectra add across
+channels like the profiles do. So the cross-spectrum of every (subint,
+channel) profile of a file is computed once, aligned to the file's centre
+frequency, and stored next to the file as <file>.xspec.npz together with the
+channels' weights, frequencies and noise. TOAs for any power-of-two number of
+subbands are then made by summing the cached cross-spectra of each group of
+channels (weighted as scrunch.py weights them) and re-fitting the phase, as
+toas.py does, without reading the archive or scrunching it again.
+
+A cache is used as long as its file and template are unchanged (size and
+mtime of the file, content hash of the template), and is rebuilt otherwise.
+
+The channels are those of the files given, so only fewer subbands than they
+have can be made (a larger -n is capped at their number of channels). For
+.ftp files, already scrunched to nsubbands, the cache saves re-scrunching
+when nsubbands is lowered, but does not hold the archives' full channel
+resolution, and cannot give more subbands than the first scrunch made.
+
+The epochs and the fit are those of toas.py, so new_pulsar.py does not offer
+this engine until toas.py --check_pat agrees with pat on CHIME data.
+
+The noise of a subband is propagated from its channels' baseline noise, where
+pat (and toas.py) measure it on the scrunched profile, so S/N and TOA errors
+can differ slightly from those of a scrunched file.
+
+Run from the command line with:
+python xspec.py -n 16 -j 8 -X "-f CHIME -be CHIME -fe Rcvr_CHIME" -s template.sm *.ftp > toas.tim
+python xspec.py --sweep 64 32 16 8 -j 8 -s template.sm *.ftp  # 25th-percentile S/N per number of subbands
+"""
+
+import argparse
+import os
+import sys
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from psrfits import open_archive, zero_phase_epochs
+from scrunch import dispersion_turns, weighted_freqs
+from snr import baseline_stats, pscrunch
+from tim import chime_prefix, format_mjd
+from toa_cache import content_hash
+from toas import SITE, fdm_fit_cross, fit_harmonics, template_spectrum
+
+XSPEC_EXT = ".xspec.npz"
+# Bump to invalidate every cache, e.g. when what is stored changes
+XSPEC_VERSION = 2
+# Template spectrum and hash shared by the workers of the pool
+_template = None
+
+
+def cache_name(fname):
+    return f"{fname}{XSPEC_EXT}"
+
+
+def aligned_spectra(fname, nharm=None):
+    """
+    Spectra (nsub, nchan, nharm) of every total-intensity profile of fname,
+    aligned to the centre frequency, with the channels' baseline noise (per
+    real or imaginary Fourier component), weights, frequencies and the
+    file's timing columns, with the epochs at the predictor's phase zero (see
+    psrfits.zero_phase_epochs()). Empty profiles get zero weight.
+    """
+    with open_archive(fname) as ar:
+        cube = pscrunch(
+            np.asarray(ar.data, dtype=np.float64),
+            ar.subint.header.get("POL_TYPE", "AA+BB"),
+        )
+        weights = np.array(ar.weights, dtype=np.float64)
+        freqs = np.array(ar.freqs, dtype=np.float64)
+        periods = np.asarray(ar.periods, dtype=np.float64)
+        imjd, frac = zero_phase_epochs(ar)
+        dedispersed = ar.dedispersed
+        dm = ar.dm
+        obsfreq = float(ar.primary.get("OBSFREQ", 0.0))
+
+    nbin = cube.shape[-1]
+    spec = np.fft.rfft(cube, axis=-1)[..., :nharm]
+    noise = baseline_stats(cube)[1] * np.sqrt(nbin / 2.0)
+    if not dedispersed:
+        # Align every channel to the centre frequency, as if the file were dedispersed
+        turns = dispersion_turns(freqs, obsfreq, dm, periods[:, None])
+        spec *= np.exp(2j * np.pi * np.arange(spec.shape[-1]) * turns[..., None])
+    # Empty profiles give no TOA, so they do not count towards any subband
+    weights[np.ptp(cube, axis=-1) == 0] = 0.0
+    return {
+        "spec": spec,
+        "noise": noise,
+        "weights": weights,
+        "freqs": freqs,
+        "periods": periods,
+        "imjd": np.asarray(imjd, dtype=np.int64),
+        "frac": np.asarray(frac, dtype=np.float64),
+        "dm": dm,
+        "obsfreq": obsfreq,
+        "dedispersed": dedispersed,
+        "nbin": nbin,
+    }
+
+
+def file_cross_spectra(fname, tspec):
+    """
+    Cross-spectra (nsub, nchan, nharm) of every profile of fname with the
+    template harmonics tspec (see toas.fit_harmonics()), aligned to the
+    centre frequency, and what is needed to fit and sum them.
+    """
+    with open_archive(fname) as ar:
+        nbin = int(ar.nbin)
+    tspec = fit_harmonics(tspec, nbin)
+    xs = aligned_spectra(fname, len(tspec))
+    xs["cross"] = (xs.pop("spec") * np.conj(tspec)).astype(np.complex64)
+    return xs
+
+
+def cache_stamp(fname, template_sha):
+    # What a cache was made from: the file as it was, and the template
+    st = os.stat(fname)
+    return f"{XSPEC_VERSION} {st.st_size} {st.st_mtime} {template_sha}"
+
+
+def load_cross_spectra(fname, tspec, template_sha):
+    """The cached cross-spectra of fname, computed (and cached) if needed."""
+    stamp = cache_stamp(fname, template_sha)
+    cache = cache_name(fname)
+    if os.path.exists(cache):
+        with np.load(cache) as f:
+            if str(f["stamp"]) == stamp:
+                return {key: f[key] for key in f.files if key != "stamp"}
+    xs = file_cross_spectra(fname, tspec)
+    # Written under a temporary name, so a crash never leaves a partial cache
+    tmp = f"{cache}.{os.getpid()}.tmp.npz"
+    np.savez(tmp, stamp=stamp, **xs)
+    os.replace(tmp, cache)
+    return xs
+
+
+def subband_cross_spectra(xs, nsubbands):
+    """
+    Sum the cached cross-spectra of each group of adjacent channels into
+    nsubbands subbands. Returns the weighted mean cross-spectra, their noise,
+    the summed weights and the subbands' weighted centre frequencies.
+    """
+    nsub, nchan, nharm = xs["cross"].shape
+    nsubbands = min(nsubbands, nchan)
+    if nchan % nsubbands != 0:
+        raise ValueError(f"{nchan} channels cannot be summed into {nsubbands} subbands")
+    factor = nchan // nsubbands
+    weights = xs["weights"]
+    freqs, wsum = weighted_freqs(weights, xs["freqs"], factor)
+    w = weights.reshape(nsub, nsubbands, factor)
+    cross = (xs["cross"].reshape(nsub, nsubbands, factor, nharm) * w[..., None]).sum(
+        axis=2
+    )
+    var = (w**2 * xs["noise"].reshape(w.shape) ** 2).sum(axis=2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cross = cross / wsum[..., None]
+        noise = np.sqrt(var) / wsum
+    return cross, noise, wsum, freqs
+
+
+def subband_toas(fname, xs, tspec, nsubbands, site=SITE, extra_flags=""):
+    """
+    tempo2 .tim lines of fname at nsubbands subbands from its cross-spectra,
+    with CHIME TOAs renamed to chime.
+    """
+    cross, noise, wsum, freqs = subband_cross_spectra(xs, nsubbands)
+    isub, ichan = np.nonzero(wsum > 0)
+    if len(isub) == 0:
+        return []
+    nbin = int(xs["nbin"])
+    periods = xs["periods"]
+    shifts, errors, snr = fdm_fit_cross(
+        cross[isub, ichan].astype(np.complex128),
+        fit_harmonics(tspec, nbin),
+        noise[isub, ichan],
+        nbin,
+    )
+    # The cross-spectra are aligned at the centre frequency; put the TOAs back
+    # at their subband's frequency
+    shifts = shifts + dispersion_turns(
+        freqs[isub, ichan], float(xs["obsfreq"]), float(xs["dm"]), periods[isub]
+    )
+    if not xs["dedispersed"]:
+        # Within half a turn of the fold, as fitting a scrunched file would give
+        shifts = (shifts + 0.5) % 1.0 - 0.5
+
+    days = xs["frac"][isub] + shifts * periods[isub] / 86400.0
+    carry = np.floor(days)
+    toa_imjd = xs["imjd"][isub] + carry.astype(np.int64)
+    toa_frac = days - carry
+    errors_us = errors * periods[isub] * 1e6
+    extra = f" {extra_flags.strip()}" if extra_flags.strip() else ""
+    name = chime_prefix(fname)
+    return [
+        f"{name} {freqs[s, c]:.6f} {format_mjd(toa_imjd[i], toa_frac[i])} "
+        f"{errors_us[i]:.3f} {site} -chan {c} -subint {s} -snr {snr[i]:.3f} "
+        f"-wt {wsum[s, c]:g}{extra}"
+        for i, (s, c) in enumerate(zip(isub, ichan))
+        if np.isfinite(errors_us[i])
+    ]
+
+
+def _init_worker(tspec, template_sha):
+    global _template
+    _template = (tspec, template_sha)
+
+
+def _xspec_one(job):
+    fname, nsubbands_list, site, extra_flags = job
+    tspec, template_sha = _template
+    try:
+        xs = load_cross_spectra(fname, tspec, template_sha)
+        lines = {
+            n: subband_toas(fname, xs, tspec, n, site, extra_flags)
+            for n in nsubbands_list
+        }
+        return fname, lines, None
+    except Exception as err:
+        return fname, {}, f"{type(err).__name__}: {err}"
+
+
+def iter_xspec_toas(files, template, nsubbands_list, nproc=1, site=SITE, extra_flags=""):
+    """
+    Yield (fname, dict of nsubbands: .tim lines, error) for every file, in the
+    order of files, on nproc processes that share the template spectrum.
+    """
+    tspec = template_spectrum(template)
+    template_sha = content_hash(template)
+    jobs = [(fname, nsubbands_list, site, extra_flags) for fname in files]
+    if nproc > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(
+            max_workers=nproc, initializer=_init_worker, initargs=(tspec, template_sha)
+        ) as pool:
+            yield from pool.map(_xspec_one, jobs, chunksize=4)
+    else:
+        _init_worker(tspec, template_sha)
+        yield from map(_xspec_one, jobs)
+
+
+def snr_sweep(files, template, nsubbands_list, nproc=1, percentile=25):
+    """
+    Dict of nsubbands: (number of TOAs, {percentile}th-percentile S/N) for
+    every number of subbands, and the list of (fname, error) for failed files.
+    """
+    snrs = {n: [] for n in nsubbands_list}
+    failed = []
+    for fname, lines, error in iter_xspec_toas(files, template, nsubbands_list, nproc):
+        if error:
+            failed.append((fname, error))
+            continue
+        for n in nsubbands_list:
+            snrs[n] += [float(line.split(" -snr ")[1].split()[0]) for line in lines[n]]
+    return {
+        n: (len(x), np.percentile(x, percentile) if x else np.nan)
+        for n, x in snrs.items()
+    }, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="TOAs for any number of subbands from cached per-channel cross-spectra."
+    )
+    parser.add_argument("files", nargs="+", help="Archives to time.")
+    parser.add_argument(
+        "-s", "--template", type=str, required=True, help="Standard template profile."
+    )
+    parser.add_argument(
+        "-n",
+        "--nsubbands",
+        type=int,
+        default=None,
+        help="Number of subbands to sum the files' channels into (all channels by default). The cache holds the channels of the files given (e.g. .ftp files already scrunched to nsubbands), so a larger number is capped at theirs.",
+    )
+    parser.add_argument(
+        "--sweep",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Instead of writing TOAs, print the number of TOAs and their 25th-percentile S/N for each of these numbers of subbands.",
+    )
+    parser.add_argument(
+        "-X",
+        "--extra_flags",
+        type=str,
+        default="",
+        help="Flags appended to every TOA line, as with pat -X.",
+    )
+    parser.add_argument(
+        "--site",
+        type=str,
+        default=SITE,
+        help=f"Observatory code written to the .tim file ('{SITE}' by default).",
+    )
+    parser.add_argument(
+        "-j",
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes (1 by default).",
+    )
+    args = parser.parse_args()
+
+    if args.sweep:
+        results, failed = snr_sweep(args.files, args.template, args.sweep, args.nproc)
+        for fname, error in failed:
+            print(f"warning: no TOAs from {fname}: {error}", file=sys.stderr)
+        print("nsubbands  TOAs  25th-percentile S/N")
+        for n, (ntoa, snr_pct) in results.items():
+            print(f"{n:9d} {ntoa:5d} {snr_pct:20.2f}")
+        exit(0)
+
+    # Without -n, use every channel (nsubbands larger than nchan is capped)
+    nsubbands = args.nsubbands or sys.maxsize
+    print("FORMAT 1")
+    ntoa, failed = 0, []
+    for fname, lines, error in iter_xspec_toas(
+        args.files,
+        args.template,
+        [nsubbands],
+        nproc=args.nproc,
+        site=args.site,
+        extra_flags=args.extra_flags,
+    ):
+        if error:
+            failed.append((fname, error))
+            continue
+        for line in lines[nsubbands]:
+            print(line)
+        ntoa += len(lines[nsubbands])
+    for fname, error in failed:
+        print(f"warning: no TOAs from {fname}: {error}", file=sys.stderr)
+    print(f"{ntoa} TOAs from {len(args.files) - len(failed)} files.", file=sys.stderr)
+    if failed and len(failed) == len(args.files):
+        exit(1)